@@ -0,0 +1,483 @@
+"""
+Benchmarks each stage of the preprocessing pipeline across a matrix of page sizes and parameter settings, so that
+speedups can be measured and hardware sized for new collections.
+
+Runs offline on synthetic pages (text-like lines on a stained, noisy, slightly skewed background), so no source images
+are needed. Quality scoring and SBB binarisation are benchmarked only when their models are available: scoring needs
+pyiqa with the metric weights already downloaded, and SBB binarisation needs sbb_binarize and the model directory.
+These stages are skipped otherwise.
+
+Usage:
+
+python benchmark.py [--sizes a4_300dpi broadsheet_spread] [--stages preprocess_image rotate_image] [--repeats 3]
+                    [--output bench_results]
+
+Results are written to <output>.json (with machine details) and <output>.csv, one row per
+(stage, page size, parameter setting) with min/median/mean/max seconds and megapixels per second. Where the stage is
+instrumented with stage_timer, the median time spent in each sub-stage (e.g. denoise, sauvola) is included too.
+"""
+import argparse
+import csv
+import json
+import os
+import platform
+import shutil
+import statistics
+import tempfile
+import time
+
+import cv2
+import numpy as np
+from PIL import Image
+from skimage import filters, util, color
+
+import cpu_budget
+import dd_preprocess
+import dd_preprocessor
+import preclassifier
+import stage_timer
+
+# Page sizes in pixels (width, height)
+PAGE_SIZES = {
+    "microfiche_frame": (900, 1250),  # small scan, upscaled 2x by meet_upload_reqs
+    "a4_300dpi": (2480, 3508),
+    "a3_300dpi": (3508, 4961),
+    "broadsheet_300dpi": (4500, 6900),
+    "broadsheet_spread": (9000, 6900),
+}
+DEFAULT_SIZES = ["microfiche_frame", "a4_300dpi", "a3_300dpi"]
+
+# Parameter settings benchmarked for each stage
+SAUVOLA_SETTINGS = [{"k_val": 0.24, "window_size": 11, "contrast_enhance": False},
+                    {"k_val": 0.24, "window_size": 11, "contrast_enhance": True},
+                    {"k_val": 0.14, "window_size": 21, "contrast_enhance": False},
+                    {"k_val": 0.22, "window_size": 301, "contrast_enhance": False}]
+# Compression targets as fractions of the size of the page written as a JPEG at quality 95. Re-encoding at
+# compress_to_size's first quality (85) only brings a page down to a little over half its size, so both targets need
+# the binary search over qualities.
+COMPRESSION_TARGET_FRACTIONS = [0.5, 0.25]
+DENOISE_TILE_SIZES = [512, 1024, 2048]
+
+SCORING_METRIC = "maniqa-koniq"
+SBB_MODEL_DIR = "./saved_model_2020_01_16"
+
+
+def make_page(width, height, skew=1.5, seed=0):
+    """
+    Generates a synthetic greyscale newspaper-like page: lines of dark word-like blocks on an uneven, stained and noisy
+    background, rotated by a small skew angle.
+    :param width: [int] Page width in pixels.
+    :param height: [int] Page height in pixels.
+    :param skew: [float] Rotation applied to the page, in degrees.
+    :param seed: [int] Random seed, so every run benchmarks the same page.
+    :return: [np.ndarray] uint8 greyscale page.
+    """
+    rng = np.random.default_rng(seed)
+
+    # Uneven background with a few darker stains
+    page = np.full((height, width), 205, np.float32)
+    page += np.linspace(-15, 15, width, dtype=np.float32)[None, :]
+    for _ in range(6):
+        centre = (int(rng.integers(width)), int(rng.integers(height)))
+        axes = (int(rng.integers(width // 20, width // 6)), int(rng.integers(height // 20, height // 6)))
+        stain = np.zeros((height, width), np.float32)
+        cv2.ellipse(stain, centre, axes, 0, 0, 360, 40, -1)
+        page -= cv2.GaussianBlur(stain, (0, 0), max(axes) / 4)
+
+    # Lines of "words"
+    line_height = max(8, height // 120)
+    margin = width // 15
+    for top in range(margin, height - margin - line_height, int(line_height * 1.8)):
+        left = margin
+        while left < width - margin:
+            word_width = int(rng.integers(line_height, line_height * 6))
+            page[top:top + line_height, left:min(left + word_width, width - margin)] = rng.uniform(20, 70)
+            left += word_width + int(rng.integers(line_height // 2, line_height))
+
+    page += rng.normal(0, 12, page.shape).astype(np.float32)
+    page = np.clip(page, 0, 255).astype(np.uint8)
+
+    rotation = cv2.getRotationMatrix2D((width / 2, height / 2), skew, 1)
+    return cv2.warpAffine(page, rotation, (width, height), flags=cv2.INTER_LINEAR, borderValue=205)
+
+
+def write_source_image(page, path):
+    """
+    Writes a synthetic page as a 3-channel JPEG, as produced by meet_upload_reqs.
+    """
+    Image.fromarray(page).convert("RGB").save(path, quality=95, dpi=(300, 300))
+
+
+def bench_meet_upload_reqs(page, work_dir):
+    src_image_path = os.path.join(work_dir, "source.png")
+    Image.fromarray(page).convert("RGB").save(src_image_path)
+    dest_image_path = os.path.join(work_dir, "prepared.jpg")
+
+    def run():
+        dd_preprocess.meet_upload_reqs(src_image_path, dest_image_path, basic_only=False)
+
+    yield {}, None, run
+
+
+def bench_preprocess_image(page, work_dir):
+    src_image_path = os.path.join(work_dir, "prepared.jpg")
+    dest_image_path = os.path.join(work_dir, "sauvola.jpg")
+    write_source_image(page, src_image_path)
+
+    for setting in SAUVOLA_SETTINGS:
+        for sauvola_engine in ("skimage", "opencv"):
+            def run(setting=setting, sauvola_engine=sauvola_engine):
+                dd_preprocess.preprocess_image(src_image_path, dest_image_path, setting["contrast_enhance"],
+                                               setting["k_val"], setting["window_size"],
+                                               sauvola_engine=sauvola_engine)
+
+            yield dict(setting, sauvola_engine=sauvola_engine), None, run
+
+
+def bench_denoise(page, work_dir):
+    # Single call over the whole page, as used by default
+    def run_single():
+        dd_preprocess.denoise_image(page, contrast_enhance=False)
+
+    yield {"tile_size": None}, None, run_single
+
+    single = dd_preprocess.denoise_image(page, contrast_enhance=False)
+    for tile_size in DENOISE_TILE_SIZES:
+        def run_tiled(tile_size=tile_size):
+            dd_preprocess.denoise_image(page, contrast_enhance=False, tile_size=tile_size)
+
+        # Tiles are stitched without seams, so the output should match the single call exactly
+        differing = np.mean(dd_preprocess.denoise_image(page, contrast_enhance=False, tile_size=tile_size) != single)
+
+        yield {"tile_size": tile_size, "pixels_differing_from_single_call": float(differing)}, None, run_tiled
+
+
+def bench_sauvola(page, work_dir):
+    # Sauvola engines are compared on a denoised page, as in preprocess_image
+    denoised = dd_preprocess.denoise_image(page, contrast_enhance=False)
+
+    for setting in SAUVOLA_SETTINGS:
+        if setting["contrast_enhance"]:
+            continue
+        window_size, k_val = setting["window_size"], setting["k_val"]
+
+        # Reference output from skimage, used to report how many pixels the opencv engine binarises differently
+        greyscale = color.rgb2gray(cv2.cvtColor(denoised, cv2.COLOR_BGR2RGB))
+        reference = greyscale > filters.threshold_sauvola(greyscale, window_size=window_size, k=k_val)
+
+        def run_skimage(window_size=window_size, k_val=k_val):
+            image = color.rgb2gray(cv2.cvtColor(denoised, cv2.COLOR_BGR2RGB))
+            util.img_as_ubyte(image > filters.threshold_sauvola(image, window_size=window_size, k=k_val))
+
+        def run_opencv(window_size=window_size, k_val=k_val):
+            dd_preprocess.binarise_sauvola_opencv(denoised, window_size=window_size, k_val=k_val)
+
+        differing = np.mean((dd_preprocess.binarise_sauvola_opencv(denoised, window_size, k_val) > 0) != reference)
+
+        yield {"engine": "skimage", "window_size": window_size, "k_val": k_val}, None, run_skimage
+        yield {"engine": "opencv", "window_size": window_size, "k_val": k_val,
+               "pixels_differing_from_skimage": float(differing)}, None, run_opencv
+
+
+def bench_rotate_image(page, work_dir):
+    # rotate_image expects a binarised page
+    binarised = np.where(page < 128, 0, 255).astype(np.uint8)
+    dest_image_path = os.path.join(work_dir, "rotated.jpg")
+
+    for search in dd_preprocess.DESKEW_SEARCHES:
+        def run(search=search):
+            dd_preprocess.rotate_image(binarised, dest_image_path, search=search)
+
+        yield {"search": search, "backend": dd_preprocess.ROTATION_BACKEND}, None, run
+
+    # Other rotation backends, with the default angle search
+    for backend in dd_preprocess.ROTATION_BACKENDS:
+        if backend == dd_preprocess.ROTATION_BACKEND:
+            continue
+
+        def run_backend(backend=backend):
+            dd_preprocess.rotate_image(binarised, dest_image_path, backend=backend)
+
+        yield {"search": dd_preprocess.DESKEW_SEARCH, "backend": backend}, None, run_backend
+
+
+def bench_compress_under_size(page, work_dir):
+    src_image_path = os.path.join(work_dir, "uncompressed.jpg")
+    image_path = os.path.join(work_dir, "compressed.jpg")
+    write_source_image(page, src_image_path)
+
+    source_bytes = os.path.getsize(src_image_path)
+    for target_fraction in COMPRESSION_TARGET_FRACTIONS:
+        target_bytes = int(source_bytes * target_fraction)
+
+        def setup():
+            shutil.copyfile(src_image_path, image_path)
+
+        def run(target_bytes=target_bytes):
+            dd_preprocess.compress_under_size(target_bytes, image_path)
+
+        # Size the page is compressed to, so results show whether the target was met
+        setup()
+        run()
+        compressed_bytes = os.path.getsize(image_path) if os.path.exists(image_path) else None
+
+        yield {"target_fraction": target_fraction, "source_bytes": source_bytes, "target_bytes": target_bytes,
+               "compressed_bytes": compressed_bytes}, setup, run
+
+
+def bench_bilevel_encode(page, work_dir):
+    # Binarised pages written as a 1 bit PNG or G4 TIFF, compared with JPEG at the first quality compress_to_size tries
+    binarised = np.where(page < 128, 0, 255).astype(np.uint8)
+    encoded_sizes = {output_format: encoding["bytes"]
+                     for output_format, encoding in dd_preprocess.compare_bilevel_encodings(binarised).items()}
+
+    for output_format in dd_preprocess.BILEVEL_FORMATS:
+        def run(output_format=output_format):
+            dd_preprocess.encode_bilevel(binarised, output_format)
+
+        yield {"format": output_format, "bytes": encoded_sizes[output_format]}, None, run
+
+    def run_jpeg():
+        dd_preprocess.encode_jpeg(Image.fromarray(binarised), 85)
+
+    yield {"format": "jpeg", "bytes": encoded_sizes["jpeg"]}, None, run_jpeg
+
+
+def bench_process_before_sbb(page, work_dir):
+    src_image_path = os.path.join(work_dir, "prepared.jpg")
+    image_path = os.path.join(work_dir, "before_sbb.jpg")
+    write_source_image(page, src_image_path)
+
+    for contrast_enhance in (False, True):
+        def setup():
+            shutil.copyfile(src_image_path, image_path)
+
+        def run(contrast_enhance=contrast_enhance):
+            dd_preprocessor.process_before_sbb([image_path], contrast_enhance)
+
+        yield {"contrast_enhance": contrast_enhance}, setup, run
+
+
+def bench_preclassify(page, work_dir):
+    image_path = os.path.join(work_dir, "prepared.jpg")
+    write_source_image(page, image_path)
+
+    def run():
+        preclassifier.preclassify(image_path)
+
+    yield {"thumbnail_short_side": preclassifier.THUMBNAIL_SHORT_SIDE}, None, run
+
+
+def bench_iqa_score(page, work_dir):
+    # torch/pyiqa are only needed for this stage
+    import quality_scorer
+
+    image_path = os.path.join(work_dir, "prepared.jpg")
+    write_source_image(page, image_path)
+    iqa_metric = quality_scorer.get_metric(SCORING_METRIC)
+
+    def run():
+        float(quality_scorer.run_metric(iqa_metric, image_path))
+
+    yield {"metric": SCORING_METRIC, "device": str(quality_scorer.DEVICE)}, None, run
+
+
+def bench_iqa_score_cpu_profile(page, work_dir):
+    # torch/pyiqa are only needed for this stage
+    import torch
+    import quality_scorer
+
+    image_path = os.path.join(work_dir, "prepared.jpg")
+    write_source_image(page, image_path)
+    iqa_metric = quality_scorer.get_metric(SCORING_METRIC, device="cpu")
+    default_threads = torch.get_num_threads()
+
+    # torch's own defaults: one thread per physical core, contiguous memory format and autograd bookkeeping
+    def setup_default():
+        torch.set_num_threads(default_threads)
+        quality_scorer.configure_cpu_inference(default_threads, channels_last=False)
+
+    def run_default():
+        with torch.no_grad():
+            float(iqa_metric(image_path))
+
+    yield {"profile": "torch_default", "threads": default_threads}, setup_default, run_default
+
+    cpus = cpu_budget.available_cpus()
+    for threads in sorted({1, max(1, cpus // 2), cpus}):
+        for channels_last in (False, True):
+            def setup(threads=threads, channels_last=channels_last):
+                quality_scorer.configure_cpu_inference(threads, channels_last=channels_last)
+
+            def run():
+                float(quality_scorer.run_metric(iqa_metric, image_path))
+
+            yield {"profile": "cpu_inference", "threads": threads, "channels_last": channels_last}, setup, run
+
+    # Leave torch as it was for later stages
+    setup_default()
+
+
+def bench_sbb_binarise(page, work_dir):
+    from sbb_binarize.sbb_binarize import SbbBinarizer
+
+    if not os.path.isdir(SBB_MODEL_DIR):
+        raise FileNotFoundError(f"SBB model directory not found: {SBB_MODEL_DIR}")
+
+    image_path = os.path.join(work_dir, "before_sbb.jpg")
+    output_image_path = os.path.join(work_dir, "sbb.png")
+    write_source_image(page, image_path)
+    binarizer = SbbBinarizer(SBB_MODEL_DIR)
+
+    def run():
+        binarizer.run(image_path=image_path, save=output_image_path)
+
+    yield {}, None, run
+
+
+STAGES = {
+    "meet_upload_reqs": bench_meet_upload_reqs,
+    "preprocess_image": bench_preprocess_image,
+    "denoise": bench_denoise,
+    "sauvola": bench_sauvola,
+    "rotate_image": bench_rotate_image,
+    "compress_under_size": bench_compress_under_size,
+    "bilevel_encode": bench_bilevel_encode,
+    "process_before_sbb": bench_process_before_sbb,
+    "preclassify": bench_preclassify,
+    "iqa_score": bench_iqa_score,
+    "iqa_score_cpu_profile": bench_iqa_score_cpu_profile,
+    "sbb_binarise": bench_sbb_binarise,
+}
+
+
+def time_runs(setup, run, repeats, warmup):
+    """
+    Times repeated calls of run, calling setup (untimed) before each one.
+    :return: [tuple] (list of seconds per timed call, dict of median seconds per instrumented sub-stage)
+    """
+    durations = []
+    substage_durations = {}
+
+    for repeat in range(warmup + repeats):
+        if setup is not None:
+            setup()
+
+        stage_timer.drain()
+        start = time.perf_counter()
+        run()
+        duration = time.perf_counter() - start
+
+        if repeat < warmup:
+            continue
+
+        durations.append(duration)
+        repeat_substages = {}
+        for stage_name, image_path, seconds in stage_timer.drain():
+            repeat_substages[stage_name] = repeat_substages.get(stage_name, 0.0) + seconds
+        for stage_name, seconds in repeat_substages.items():
+            substage_durations.setdefault(stage_name, []).append(seconds)
+
+    return durations, {stage_name: statistics.median(seconds) for stage_name, seconds in substage_durations.items()}
+
+
+def run_benchmarks(sizes, stages, repeats=3, warmup=1):
+    """
+    Runs every requested stage on a synthetic page of every requested size, for each of the stage's parameter
+    settings.
+    :param sizes: [list] Names of page sizes in PAGE_SIZES.
+    :param stages: [list] Names of stages in STAGES.
+    :param repeats: [int] Number of timed runs per setting.
+    :param warmup: [int] Number of untimed runs per setting before the timed runs.
+    :return: [list] One result dict per (stage, page size, parameter setting).
+    """
+    stage_timer.enable()
+    results = []
+
+    for size_name in sizes:
+        width, height = PAGE_SIZES[size_name]
+        print(f"Generating {size_name} page ({width}x{height})")
+        page = make_page(width, height)
+        megapixels = width * height / 1e6
+
+        for stage_name in stages:
+            with tempfile.TemporaryDirectory() as work_dir:
+                try:
+                    for params, setup, run in STAGES[stage_name](page, work_dir):
+                        print(f"Benchmarking {stage_name} on {size_name} {params}")
+                        durations, substages = time_runs(setup, run, repeats, warmup)
+                        median = statistics.median(durations)
+
+                        results.append({"stage": stage_name,
+                                        "size": size_name,
+                                        "width": width,
+                                        "height": height,
+                                        "megapixels": round(megapixels, 2),
+                                        "params": json.dumps(params, sort_keys=True),
+                                        "repeats": repeats,
+                                        "min_s": min(durations),
+                                        "median_s": median,
+                                        "mean_s": statistics.mean(durations),
+                                        "max_s": max(durations),
+                                        "mpix_per_s": megapixels / median if median > 0 else None,
+                                        "substages_median_s": json.dumps(substages, sort_keys=True),
+                                        "skipped": ""})
+
+                except Exception as benchmark_error:
+                    # e.g. model weights not available offline
+                    print(f"Skipping {stage_name} on {size_name}: {benchmark_error}")
+                    results.append({"stage": stage_name, "size": size_name, "width": width, "height": height,
+                                    "megapixels": round(megapixels, 2), "skipped": str(benchmark_error)})
+
+    return results
+
+
+def machine_info():
+    """
+    :return: [dict] Details of the machine and library versions the benchmarks were run with.
+    """
+    return {"platform": platform.platform(),
+            "processor": platform.processor(),
+            "cpu_count": os.cpu_count(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "opencv": cv2.__version__,
+            "opencv_threads": cv2.getNumThreads()}
+
+
+def write_results(results, output):
+    """
+    Writes benchmark results to <output>.json and <output>.csv.
+    :param results: [list] Result dicts from run_benchmarks.
+    :param output: [string] Output path without extension.
+    """
+    with open(output + ".json", "w") as json_file:
+        json.dump({"machine": machine_info(), "results": results}, json_file, indent=2)
+
+    fieldnames = ["stage", "size", "width", "height", "megapixels", "params", "repeats", "min_s", "median_s",
+                  "mean_s", "max_s", "mpix_per_s", "substages_median_s", "skipped"]
+    with open(output + ".csv", "w", newline="") as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(results)
+
+    print(f"Benchmark results written to {output}.json and {output}.csv")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks each stage of the preprocessing pipeline on synthetic "
+                                                 "pages of different sizes.")
+    parser.add_argument("--sizes", nargs="+", choices=list(PAGE_SIZES), default=DEFAULT_SIZES,
+                        help=f"Page sizes to benchmark (default: {' '.join(DEFAULT_SIZES)})")
+    parser.add_argument("--stages", nargs="+", choices=list(STAGES), default=list(STAGES),
+                        help="Stages to benchmark (default: all)")
+    parser.add_argument("--repeats", "-n", type=int, default=3,
+                        help="Number of timed runs per setting (default: 3)")
+    parser.add_argument("--warmup", type=int, default=1,
+                        help="Number of untimed runs per setting before the timed runs (default: 1)")
+    parser.add_argument("--output", "-o", type=str, default="bench_results",
+                        help="Output path without extension (default: bench_results)")
+
+    args = parser.parse_args()
+
+    write_results(run_benchmarks(args.sizes, args.stages, args.repeats, args.warmup), args.output)
@@ -0,0 +1,41 @@
+"""
+Splits the CPU cores available to a run between quality scoring (torch threads, see
+quality_scorer.configure_cpu_inference) and the worker processes preparing and preprocessing images (OpenCV threads
+denoising each image, see dd_preprocess.denoise_image), so that the threads started by each never add up to more than
+the cores available. Only uses the standard library so it can be used without torch or OpenCV installed.
+"""
+import os
+
+
+def available_cpus():
+    """
+    :return: [int] Number of CPU cores this process may run on, which can be fewer than the machine has (e.g. in a
+    container or when limited with taskset).
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        # Not available on macOS
+        return os.cpu_count() or 1
+
+
+def split_cpus(pipeline_workers=1, scoring_alongside=False, scoring_threads=None):
+    """
+    Shares the available CPU cores between quality scoring and the pipeline's worker processes.
+    :param pipeline_workers: [int] Number of worker processes preprocessing images at the same time (--workers).
+    :param scoring_alongside: [bool] True if images are scored while the worker processes are busy (--pipelined).
+    Otherwise scoring and preprocessing take turns, so each may use every core.
+    :param scoring_threads: [int] Threads to give scoring, e.g. set with --cpu_threads. By default, alongside the
+    worker processes, scoring gets an equal share of the cores as one more worker.
+    :return: [tuple] (threads for quality scoring, threads for each worker process), each at least 1
+    """
+    cpus = available_cpus()
+    pipeline_workers = max(1, pipeline_workers)
+
+    if not scoring_alongside:
+        return scoring_threads or cpus, max(1, cpus // pipeline_workers)
+
+    if not scoring_threads:
+        scoring_threads = max(1, cpus // (pipeline_workers + 1))
+
+    return scoring_threads, max(1, (cpus - scoring_threads) // pipeline_workers)
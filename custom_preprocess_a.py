@@ -15,8 +15,16 @@ later versions.
 """
 import dd_preprocess # image preprocessing pipeline (mostly contains code for non-machine learning approach)
 import quality_scorer # scores images using pyiqa toolkit to determine whether images are good or bad quality.
-import pyiqa
 import dd_preprocessor # helper functions to perform the image preprocessing
+import sbb_worker # client for the long-lived SBB binarisation worker
+import run_journal # records each image's completed stages so interrupted runs can be resumed
+import stage_timer # optional per-stage timing instrumentation
+import discovery # single-pass discovery of the images in a run
+import pipeline # pipelined mode, overlapping preparation, scoring and preprocessing
+import score_store # SQLite store of image quality scores
+import page_handoff # hands denoised good quality images to custom_preprocess_b.py without a JPEG round trip
+import preclassifier # cheap statistical routing of clear-cut pages without the quality metric
+import cpu_budget # shares the CPU cores between quality scoring and the worker processes
 import os
 import argparse
 from tqdm import tqdm
@@ -26,9 +34,6 @@ import pickle
 # according to https://iqa-pytorch.readthedocs.io/en/latest/ModelCard.html
 SCORING_METRIC = "maniqa-koniq"
 
-# Common image file extensions
-IMAGE_EXTENSIONS = ['.png', '.jpg', '.jpeg', '.tiff', '.tif', '.bmp', '.gif', '.webp', '.ico', '.svg']
-
 # The threshold used to determine whether an image is good or bad quality. Update as appropriate for the metric and
 # source materials you are using.
 DEFAULT_GOODBAD_THRESHOLD = 0.335 # maniqa-koniq
@@ -54,80 +59,237 @@ if __name__ == "__main__":
     parser.add_argument("--goodbad_threshold", "-gb", type=float, default=DEFAULT_GOODBAD_THRESHOLD,
                         help=f"Image quality score to use as threshold between 'good' and 'bad' quality determination "
                              f"(default: {DEFAULT_GOODBAD_THRESHOLD})")
+    parser.add_argument("--sauvola_engine", "-se", type=str, choices=["skimage", "opencv"], default="skimage",
+                        help="Implementation of Sauvola binarisation to use. opencv computes the local statistics with "
+                             "box filters in float32, which is much faster and uses less memory, with near-identical "
+                             "output (default: skimage)")
+    parser.add_argument("--denoise_tile_size", "-dt", type=int, default=0,
+                        help="Denoise each image in overlapping tiles of this many pixels square, on a thread pool, "
+                             "rather than in a single call (which OpenCV already spreads over the cores). Output is "
+                             "unchanged. Not known to be faster: no speedup over a single call has been measured yet. "
+                             "Either way, each of the --workers processes denoises with an equal share of the CPU "
+                             "cores left by quality scoring (see --cpu_threads) (default: 0, denoise in a single call)")
+    parser.add_argument("--output_format", "-of", type=str, choices=["jpeg", "png"], default="jpeg",
+                        help="Format to write Sauvola binarised (bad quality) images in. png writes them losslessly at "
+                             "1 bit per pixel, which is much smaller and faster to encode than JPEG and needs no "
+                             "further compression (default: jpeg)")
+    parser.add_argument("--workers", "-j", type=int, default=1,
+                        help="Number of worker processes used to prepare images to meet Transkribus upload "
+                             "requirements and to preprocess bad quality images with the Sauvola pipeline. Use 1 to "
+                             "process images one at a time (default: 1)")
+    parser.add_argument("--score_batch_size", "-sb", type=int, default=1,
+                        help="Number of images quality-scored per batch. If greater than 1, images are resized to the "
+                             "input shape expected by the scoring metric and scored in batches, which is faster on CPU "
+                             "but can shift scores slightly, so the good/bad threshold may need re-tuning "
+                             "(default: 1, score each image at full size)")
+    parser.add_argument("--score_short_side", "-sss", type=int, default=0,
+                        help="Score a reduced copy of each image with this shorter side (e.g. "
+                             f"{quality_scorer.DEFAULT_SCORE_SHORT_SIDE}), decoded straight from the source image, "
+                             "instead of the full-size prepared image. Much faster on CPU. Check routing against "
+                             "full-size scoring with score_calibration.py first (default: 0, score at full size)")
+    parser.add_argument("--preclassify_confidence", "-pc", type=float, default=0,
+                        help="Route pages which a cheap statistical pre-classifier (brightness, contrast, noise and "
+                             "sharpness of a thumbnail) is at least this confident about (between 0 and 1, e.g. "
+                             f"{preclassifier.DEFAULT_CONFIDENCE}) without scoring them, so only ambiguous pages are "
+                             "scored. Check it against full-size scoring with score_calibration.py first "
+                             "(default: 0, score every page)")
+    parser.add_argument("--cpu_threads", "-ct", type=int, default=0,
+                        help="Number of threads used for quality scoring on CPU. By default, scoring uses every CPU "
+                             "core available to the run or, when --workers run at the same time (with --pipelined), "
+                             "an equal share of the cores as one more worker. Either way, the workers share the cores "
+                             "scoring leaves free (default: 0, automatic)")
+    parser.add_argument("--score_cache", "-sc", type=str, default=score_store.DEFAULT_SCORE_CACHE_PATH,
+                        help="Path of the persistent quality score cache shared between runs. Images whose contents "
+                             "are unchanged since they were scored in an earlier run (with the same metric and pyiqa "
+                             f"version) are not scored again (default: {score_store.DEFAULT_SCORE_CACHE_PATH})")
+    parser.add_argument("--score_cache_size", "-scs", type=int, default=score_store.DEFAULT_SCORE_CACHE_SIZE,
+                        help="Maximum number of scores kept in the score cache. The least recently used scores are "
+                             "evicted beyond this. Use 0 to disable the score cache "
+                             f"(default: {score_store.DEFAULT_SCORE_CACHE_SIZE})")
+    parser.add_argument("--sbb_socket", "-ss", type=str, default=None,
+                        help="Path of the Unix socket of a running SBB binarisation worker (sbb_worker.py). If given, "
+                             "good quality images are binarised by the worker as soon as they are ready instead of by "
+                             "custom_preprocess_b.py.")
+    parser.add_argument("--shared_memory_handoff", "-shm",
+                        help="Use flag to hand good quality images to SBB binarisation as uncompressed arrays in "
+                             f"shared memory ({page_handoff.DEFAULT_HANDOFF_DIR}) once denoised, instead of writing "
+                             "them as JPEG and reading them back. Images are written as JPEG as before if shared "
+                             "memory runs short.",
+                        action="store_true")
+    parser.add_argument("--pipelined", "-pl",
+                        help="Use flag to score each image as soon as it has been prepared and preprocess it as soon "
+                             "as it has been scored, so that preparation, quality scoring and binarisation run at the "
+                             "same time instead of one after another over the whole batch.",
+                        action="store_true")
+    parser.add_argument("--resume", "-rs",
+                        help="Use flag to resume a run which stopped midway. Stages each image completed in the "
+                             "earlier run (recorded in the run journal) are skipped.",
+                        action="store_true")
+    parser.add_argument("--timing_report", "-tr", type=str, default=None,
+                        help="Path of a JSON file to write per-stage timings (totals, per-image breakdown and "
+                             "p50/p95/p99 latencies) to at the end of the run.")
 
     args = parser.parse_args()
 
+    if args.timing_report:
+        stage_timer.enable()
+
     filename_pattern = args.regex
     goodbad_threshold = args.goodbad_threshold
 
-    shelvefilepath = os.path.join(args.source_folder, "image_scores")
+    score_store_path = os.path.join(args.source_folder, score_store.SCORE_STORE_FILENAME)
+    handoff_dir = page_handoff.DEFAULT_HANDOFF_DIR if args.shared_memory_handoff else None
+
+    # (saved to source folder rather than destination folder so it isn't mixed in with the preprocessed images)
 
-    # (saved to source folder rather than destination folder because code iterates through dest folder again later
-    # and .db file may complicate this)
+    # Run journal recording the stages each image has completed, saved to the source folder for the same reason.
+    # custom_preprocess_b.py records the SBB pipeline's stages in the same journal.
+    journal_path = os.path.join(args.source_folder, run_journal.JOURNAL_FILENAME)
+    if not args.resume and os.path.exists(journal_path):
+        # Stages recorded by a previous run don't apply to a new run
+        os.remove(journal_path)
+    journal = run_journal.RunJournal(journal_path)
 
     # Preprocess images using command-line arguments to meet Transkribus upload requirements
     print("Performing initial preprocessing")
-    file_count = dd_preprocess.count_files_in_directory_tree(args.source_folder, IMAGE_EXTENSIONS)
-
-    with tqdm(total=file_count, desc="Preprocessing images", unit="image") as pbar:
-        # Iterate through the source folder and its sub-folders
-        # root = current directory, dirs = subdirectories within current directory,
-        # files = filenames in current directory
-        for root, dirs, files in os.walk(args.source_folder):
-            for file in files:
-                try:
-                    # Check if the file is an image (any file with an image extension)
-                    if any(file.lower().endswith(image_ext) for image_ext in IMAGE_EXTENSIONS):
-
-                        # Build the full path for the source and destination images.
-                        # relpath is used to replicate source directory structure.
-                        src_image_path = os.path.join(root, file)
-                        dest_image_path = os.path.join(args.destination_folder,
-                                                       os.path.relpath(src_image_path, args.source_folder))
-
-                        # Create the destination folder if it doesn't exist
-                        os.makedirs(os.path.dirname(dest_image_path), exist_ok=True)
-                        # exist_ok ensures function doesn't raise error if directory already exists
-
-                        # Determine destination file path/name after conversion to jpg
-                        dest_image_path = os.path.splitext(dest_image_path)[0] + '.jpg'
 
+    # Walk the source folder once to find every image and the destination filepath it is written to (same relative
+    # path, converted to jpg). Every later stage works from this manifest rather than walking a folder again.
+    manifest = discovery.build_manifest(args.source_folder, args.destination_folder)
+    print(f"Found {len(manifest)} images ({sum(entry.size for entry in manifest) / 1e9:.2f} GB)")
+
+    # Create the destination folders (once each) before the work is shared between processes
+    discovery.make_destination_folders(manifest)
+
+    # If a long-lived SBB binarisation worker is running (sbb_worker.py), good quality images are submitted to it as
+    # soon as they are prepared rather than being left for custom_preprocess_b.py.
+    sbb_client = sbb_worker.SbbWorkerClient(args.sbb_socket) if args.sbb_socket else None
+
+    # Persistent cache of quality scores shared between runs (disabled with a size of 0)
+    score_cache_path = args.score_cache if args.score_cache_size > 0 else None
+
+    # Share the CPU cores between quality scoring and the worker processes, so that torch in this process and OpenCV
+    # (or the tile threads, with --denoise_tile_size) denoising in each worker don't each start a thread per core.
+    # Scoring only runs alongside the workers in pipelined mode - otherwise it runs once every image has been prepared.
+    scoring_threads, denoise_threads = cpu_budget.split_cpus(args.workers, scoring_alongside=args.pipelined,
+                                                             scoring_threads=args.cpu_threads)
+    quality_scorer.configure_cpu_inference(scoring_threads)
+
+    if args.score_short_side and args.score_batch_size > 1 and not args.pipelined:
+        print("Warning: --score_short_side is ignored with --score_batch_size above 1, images are resized to the "
+              "metric's input shape instead.")
+
+    if args.pipelined:
+        # Each image is scored as soon as it is prepared and preprocessed as soon as it is scored
+        if args.score_batch_size > 1:
+            print("Warning: --score_batch_size is ignored with --pipelined, images are scored one at a time as they "
+                  "are prepared.")
+        if not args.resume:
+            # remove scores saved during previous runs if exists.
+            score_store.remove_store(score_store_path)
+
+        treatment_dict, sbb_filepaths = pipeline.run_pipelined(manifest, journal,
+                                                               score_store_path=score_store_path,
+                                                               metric=SCORING_METRIC,
+                                                               goodbad_threshold=goodbad_threshold,
+                                                               sauvola_k_val=args.sauv_k_val,
+                                                               sauvola_window_size=args.sauv_window_size,
+                                                               contrast_enhance=args.contrast_enhance,
+                                                               workers=args.workers,
+                                                               filename_pattern=filename_pattern,
+                                                               sbb_client=sbb_client,
+                                                               sauvola_engine=args.sauvola_engine,
+                                                               denoise_tile_size=args.denoise_tile_size,
+                                                               denoise_threads=denoise_threads,
+                                                               score_cache_path=score_cache_path,
+                                                               score_cache_size=args.score_cache_size,
+                                                               output_format=args.output_format,
+                                                               handoff_dir=handoff_dir,
+                                                               score_short_side=args.score_short_side,
+                                                               preclassify_confidence=args.preclassify_confidence)
+
+    else:
+        # Skip images already prepared by an earlier run (when resuming)
+        upload_reqs_paths = [(entry.src, entry.dest) for entry in manifest
+                             if not journal.is_done(entry.dest, run_journal.PREPARED)]
+
+        if args.workers > 1:
+            # Fan the decode/upscale/re-encode step out over a pool of worker processes
+            dd_preprocessor.meet_upload_reqs_parallel(upload_reqs_paths, workers=args.workers, journal=journal)
+        else:
+            with tqdm(total=len(upload_reqs_paths), desc="Preprocessing images", unit="image") as pbar:
+                for src_image_path, dest_image_path in upload_reqs_paths:
+                    try:
                         pbar.set_description(f"Preprocessing image: {os.path.basename(src_image_path)}")
 
-                        dd_preprocess.meet_upload_reqs(src_image_path, dest_image_path, basic_only=False)
+                        if dd_preprocess.meet_upload_reqs(src_image_path, dest_image_path, basic_only=False):
+                            journal.record(dest_image_path, run_journal.PREPARED)
 
                         pbar.update(1)
 
-                except Exception as meet_upload_reqs_error:
-                    print(f"error preparing image: {file}", meet_upload_reqs_error)
-                    pbar.update(1)
-
-    # score to determine which preprocessing pipeline to use (non-ML, ML) - use pyiqa, maniqa-koniq
-    quality_scorer.run_pyiqa_for_all_files(args.destination_folder,
-                                           shelve_filepath=shelvefilepath,
-                                           metric=SCORING_METRIC,
-                                           filename_pattern=filename_pattern)
-
-    lower_better = pyiqa.create_metric(metric_name=SCORING_METRIC, device=quality_scorer.DEVICE).lower_better
-
-    # map image-wise scores to 'good'/'bad' quality class. If score is NA, assume image quality is 'bad'.
-    good_bad_dict = quality_scorer.map_to_qualityclass(shelvefilepath, goodbad_threshold, lower_better)
-
-    # map image-wise 'good'/'bad' quality classes to required preprocessing treatment. Keys: image filepaths, values:
-    # 'sbb' if 'good', 'sauvola' if 'bad'.
-    treatment_dict = quality_scorer.map_to_treatment(good_bad_dict)
-
-    # Map scores to method required. Create 2 lists of filepaths - one of images to be processed w/ pipeline 1, one
-    # of images to be processed w/ pipeline 2 (dd_preprocessor.process_images does this)
-
-    # preprocessing of both pipelines' (SBB/ML and Sauvola/non-ML)
+                    except Exception as meet_upload_reqs_error:
+                        print(f"error preparing image: {os.path.basename(src_image_path)}", meet_upload_reqs_error)
+                        pbar.update(1)
 
-    # preprocesses poor quality images using non-ML pipeline
-    # places images into new folder with same structure as had previously
-    sbb_filepaths = dd_preprocessor.process_images(treatment_dict,
-                                   sauvola_k_val=args.sauv_k_val,
-                                   sauvola_window_size=args.sauv_window_size,
-                                   contrast_enhance=args.contrast_enhance)
+        # score to determine which preprocessing pipeline to use (non-ML, ML) - use pyiqa, maniqa-koniq
+        quality_scorer.run_pyiqa_for_all_files(args.destination_folder,
+                                               score_store_path=score_store_path,
+                                               metric=SCORING_METRIC,
+                                               filename_pattern=filename_pattern,
+                                               manifest=manifest,
+                                               batch_size=args.score_batch_size,
+                                               journal=journal,
+                                               resume=args.resume,
+                                               score_cache_path=score_cache_path,
+                                               score_cache_size=args.score_cache_size,
+                                               short_side=args.score_short_side,
+                                               preclassify_confidence=args.preclassify_confidence)
+
+        # reuses the metric already loaded for scoring
+        lower_better = quality_scorer.get_metric(SCORING_METRIC).lower_better
+
+        # map image-wise scores to 'good'/'bad' quality class. If score is NA, assume image quality is 'bad'.
+        good_bad_dict = quality_scorer.map_to_qualityclass(score_store_path, goodbad_threshold, lower_better,
+                                                           metric=SCORING_METRIC)
+
+        # map image-wise 'good'/'bad' quality classes to required preprocessing treatment. Keys: image filepaths,
+        # values: 'sbb' if 'good', 'sauvola' if 'bad'.
+        treatment_dict = quality_scorer.map_to_treatment(good_bad_dict)
+
+        for filepath, treatment in treatment_dict.items():
+            if journal.value(filepath, run_journal.ROUTED) != treatment:
+                journal.record(filepath, run_journal.ROUTED, treatment)
+
+        # Map scores to method required. Create 2 lists of filepaths - one of images to be processed w/ pipeline 1,
+        # one of images to be processed w/ pipeline 2 (dd_preprocessor.process_images does this)
+
+        # preprocessing of both pipelines' (SBB/ML and Sauvola/non-ML)
+
+        # preprocesses poor quality images using non-ML pipeline
+        # places images into new folder with same structure as had previously
+        sbb_filepaths = dd_preprocessor.process_images(treatment_dict,
+                                       sauvola_k_val=args.sauv_k_val,
+                                       sauvola_window_size=args.sauv_window_size,
+                                       contrast_enhance=args.contrast_enhance,
+                                       workers=args.workers,
+                                       sbb_client=sbb_client,
+                                       journal=journal,
+                                       sauvola_engine=args.sauvola_engine,
+                                       denoise_tile_size=args.denoise_tile_size,
+                                       denoise_threads=denoise_threads,
+                                       output_format=args.output_format,
+                                       handoff_dir=handoff_dir)
+
+    if sbb_client is not None:
+        print("Waiting for SBB binarisation worker to finish good quality images")
+        binarised_filepaths, failed_filepaths = sbb_client.wait()
+        sbb_client.close()
+        for failed_filepath, sbb_binarisation_error in failed_filepaths.items():
+            print(f"Error binarising image {os.path.basename(failed_filepath)}: {sbb_binarisation_error}")
+        print(f"SBB binarisation worker binarised {len(binarised_filepaths)} good quality images")
+
+        # Nothing is left for custom_preprocess_b.py to do
+        sbb_filepaths = []
 
     # output list of good quality images to pass to next script custom_preprocess_b.py (different virtual environment
     # needed to use SBB binarisation code).
@@ -135,6 +297,18 @@ if __name__ == "__main__":
     with open('sbb_filepath_list.pkl', 'wb') as f:
         pickle.dump(sbb_filepaths, f)
 
+    # Tell custom_preprocess_b.py where the handed off images are
+    if handoff_dir is not None:
+        page_handoff.write_manifest(page_handoff.HANDOFF_MANIFEST_FILENAME, handoff_dir, sbb_filepaths)
+    elif os.path.exists(page_handoff.HANDOFF_MANIFEST_FILENAME):
+        # Left by an earlier run
+        os.remove(page_handoff.HANDOFF_MANIFEST_FILENAME)
+
+    journal.close()
+
+    if args.timing_report:
+        stage_timer.write_report(args.timing_report)
+
     # custom_preprocess_b.py performs the following remaining steps:
     # - Preprocess good quality images using ML pipeline via OCRD's SBB-binarisation script.
     # - Complete further preprocessing steps.
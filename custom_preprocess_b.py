@@ -24,54 +24,124 @@ from sbb_binarize.sbb_binarize import SbbBinarizer
 import os
 import dd_preprocess
 import cv2
+import page_handoff
+import argparse
+import run_journal
+import stage_timer
 
 # Define your model directory, input image, and output image paths
 model_dir = "./saved_model_2020_01_16"
 
-# load list of good quality image filepaths - these should be preprocessed using sbb_binarisation
-with open('sbb_filepath_list.pkl', 'rb') as f:
-    sbb_filepaths = pickle.load(f)
 
-# Instantiate the SbbBinarizer and run the binarization
-if len(sbb_filepaths) == 0:
-    pass
-else:
-    print("Preparing to binarise")
-    binarizer = SbbBinarizer(model_dir)
+@stage_timer.timed("binarise_image", image_arg="input_image_path")
+def binarise_image(binarizer, input_image_path, journal=None, handoff_dir=None):
+    """
+    Binarises a good quality image with SBB binarisation, then completes the final preprocessing steps (deskew,
+    compression). The input image is replaced by a binarised .png image.
+    :param binarizer: [SbbBinarizer] Loaded SBB binarisation model.
+    :param input_image_path: [string] Filepath to an image prepared by dd_preprocessor.process_before_sbb.
+    :param journal: [run_journal.RunJournal] If given, stages the image completed in an earlier, interrupted run are
+    skipped and each completed stage is recorded against input_image_path.
+    :param handoff_dir: [string] If given, and custom_preprocess_a.py handed the prepared image off in this folder
+    (see page_handoff.py), the handed off array is binarised instead of the image at input_image_path.
+    :return: [string] Filepath to the binarised image.
+    """
+    output_image_path = input_image_path.replace(".jpg", ".png")
+
+    if journal is None or not journal.is_done(input_image_path, run_journal.BINARISED):
+        print(f"Binarising image: {os.path.basename(input_image_path)}")
+        page = page_handoff.read_page(input_image_path, handoff_dir) if handoff_dir is not None else None
 
-    # Run the binarizer on each object in the filepath list
+        with stage_timer.stage("sbb_binarise"):
+            if page is not None:
+                # SBB binarisation expects a 3-channel image, as read from file by cv2.imread
+                binarizer.run(image=cv2.cvtColor(page, cv2.COLOR_GRAY2BGR), save=output_image_path)
+            else:
+                binarizer.run(image_path=input_image_path, save=output_image_path)
 
-    new_output_filepaths = [] # filepaths with new .png extensions (SBB binarisation only outputs .tif or .png)
+        if journal is not None:
+            journal.record(input_image_path, run_journal.BINARISED)
 
-    for input_image_path in sbb_filepaths:
-        output_image_path = input_image_path.replace(".jpg", ".png")
-        new_output_filepaths.append(output_image_path)
-        print(f"Binarising image: {os.path.basename(input_image_path)}")
-        binarizer.run(image_path=input_image_path, save=output_image_path)
+    if handoff_dir is not None:
+        page_handoff.remove_page(input_image_path, handoff_dir)
 
-        # delete input image (has now been replaced with binarised image)
+    # delete input image (has now been replaced with binarised image)
+    if os.path.exists(input_image_path):
         os.remove(input_image_path)
 
+    if journal is None or not journal.is_done(input_image_path, run_journal.DESKEWED):
         print("Final preprocessing steps - rotate, compress")
-        image = cv2.imread(output_image_path)
-        dd_preprocess.rotate_image(image, output_image_path)
+        # Read as a single channel, so only one channel is rotated and encoded
+        image = cv2.imread(output_image_path, cv2.IMREAD_GRAYSCALE)
+        # SBB binarisation outputs pure black and white images, so these are written losslessly as 1 bit PNGs
+        dd_preprocess.rotate_image(image, output_image_path, output_format="png")
+
+        if journal is not None:
+            journal.record(input_image_path, run_journal.DESKEWED)
 
+    if journal is None or not journal.is_done(input_image_path, run_journal.COMPRESSED):
         # If image is already smaller than target size, return the image
         img_size_bytes = os.path.getsize(output_image_path)
         if img_size_bytes <= dd_preprocess.max_image_bytes:
             pass
         else:
             # If image is larger than max allowed size, compress until allowable size
-            dd_preprocess.compress_under_size(dd_preprocess.bytes_in_mb, output_image_path)
+            dd_preprocess.compress_under_size(dd_preprocess.max_image_bytes, output_image_path)
+
+        if journal is not None:
+            journal.record(input_image_path, run_journal.COMPRESSED)
+
+    return output_image_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Binarises good quality images listed in sbb_filepath_list.pkl with "
+                                                 "SBB binarisation, then deskews and compresses them.")
+    parser.add_argument("--journal", type=str, default=None,
+                        help="Path to the run journal written by custom_preprocess_a.py. If given, stages completed "
+                             "by an earlier, interrupted run are skipped.")
+    parser.add_argument("--timing_report", type=str, default=None,
+                        help="Path of a JSON file to write per-stage timings to at the end of the run.")
+    args = parser.parse_args()
+
+    if args.timing_report:
+        stage_timer.enable()
+
+    journal = run_journal.RunJournal(args.journal) if args.journal else None
+
+    # load list of good quality image filepaths - these should be preprocessed using sbb_binarisation
+    with open('sbb_filepath_list.pkl', 'rb') as f:
+        sbb_filepaths = pickle.load(f)
 
-if len(sbb_filepaths) == 0:
-    pass
-else:
-    print("Finished binarising good quality images")
+    # Folder good quality images were handed off in by custom_preprocess_a.py, if it used --shared_memory_handoff
+    handoff_manifest = page_handoff.read_manifest(page_handoff.HANDOFF_MANIFEST_FILENAME)
+    handoff_dir = handoff_manifest["handoff_dir"] if handoff_manifest is not None else None
 
+    # Instantiate the SbbBinarizer and run the binarization
+    if len(sbb_filepaths) == 0:
+        pass
+    else:
+        print("Preparing to binarise")
+        with stage_timer.stage("sbb_model_load"):
+            binarizer = SbbBinarizer(model_dir)
 
+        # Run the binarizer on each object in the filepath list
 
+        new_output_filepaths = [] # filepaths with new .png extensions (SBB binarisation only outputs .tif or .png)
 
+        for input_image_path in sbb_filepaths:
+            if journal is not None and journal.is_done(input_image_path, run_journal.COMPRESSED):
+                # Fully processed by an earlier run
+                new_output_filepaths.append(input_image_path.replace(".jpg", ".png"))
+                continue
 
+            new_output_filepaths.append(binarise_image(binarizer, input_image_path, journal=journal,
+                                                       handoff_dir=handoff_dir))
 
+    if len(sbb_filepaths) == 0:
+        pass
+    else:
+        print("Finished binarising good quality images")
 
+    if args.timing_report:
+        stage_timer.write_report(args.timing_report)
@@ -27,6 +27,19 @@ After these, you can optionally include the following flags:
                       and do not want to do further preprocessing like binarisation (e.g. for evaluation
                       purposes). If you use this flag, the other optional flags are irrelevant as they apply
                       to the further preprocessing pipeline.
+* --sauvola_engine / -se [str] : Implementation of Sauvola binarisation to use: "skimage" (default) or "opencv",
+                                 which is much faster and uses less memory, with near-identical output.
+* --denoise_tile_size / -dt [int] : Denoise each image in overlapping tiles of this many pixels square, on a thread
+                                   pool of one thread per CPU core, rather than in a single call (which OpenCV
+                                   already spreads over the cores). Output is unchanged. Not known to be faster:
+                                   no speedup over a single call has been measured yet. Default is 0 (denoise in a
+                                   single call).
+* --output_format / -of [str] : Format to write binarised images in: "jpeg" (default) or "png", which writes them
+                                losslessly at 1 bit per pixel (with a .png extension), far smaller and faster to
+                                encode than JPEG, so they need no further compression.
+* --single_decode / -sd : Use flag to pass each image from the Transkribus upload requirements step straight to the
+                          further preprocessing steps in memory, rather than writing and re-reading an intermediate
+                          JPEG. Only the final output is written to disk.
 
 For example:
 
@@ -44,6 +57,9 @@ python dd_preprocess.py path/to/source/directory path/to/destination/directory -
 """
 
 import os  # Deals with path names
+import io  # For encoding images in memory
+import time  # For timing encoders in compare_bilevel_encodings
+from contextlib import contextmanager  # For limiting OpenCV's threads around a call
 import argparse  # Takes arguments from command line
 from PIL import Image  # For image preprocessing
 from tqdm import tqdm  # For progress loading bar
@@ -51,6 +67,11 @@ import cv2  # For image preprocessing
 from skimage import filters, util, color  # For image preprocessing
 import numpy as np  # For working with image data
 from scipy import ndimage  # For working with image data
+from concurrent.futures import ThreadPoolExecutor  # For denoising tiles concurrently
+import run_journal  # Records completed stages so interrupted runs can be resumed
+import stage_timer  # Optional per-stage timing instrumentation
+import discovery  # Single-pass discovery of images to process
+import cpu_budget  # Shares the CPU cores between the processes of a run
 
 
 bytes_in_mb = 1000000  # the number of bytes in a megabyte
@@ -59,8 +80,14 @@ max_image_mbs = 10
 # Determine maximum allowed image size (according to Transkribus upload requirements)
 max_image_bytes = max_image_mbs * bytes_in_mb
 
+# Fast non-local means denoising parameters
+denoise_h = 10
+denoise_template_window_size = 7
+denoise_search_window_size = 21
 
-def meet_upload_reqs(src_image_path, dest_image_path, basic_only):
+
+@stage_timer.timed("meet_upload_reqs", image_arg="dest_image_path")
+def meet_upload_reqs(src_image_path, dest_image_path, basic_only, return_array=False):
     """
     Performs the first preprocessing step, ensuring images meet basic upload requirements and are reasonable
     dimensions for OCR/HTR.
@@ -69,11 +96,21 @@ def meet_upload_reqs(src_image_path, dest_image_path, basic_only):
     :param basic_only: (bool) If true, user only wishes for this first (basic) preprocessing step to be
     performed, and no further steps like binarisation in function preprocess_image. In this case,
     image is compressed at function end. Otherwise, image is compressed at end of preprocess_image.
+    :param return_array: (bool) If true, nothing is written to dest_image_path. Instead, the resized image is
+    returned as a greyscale array to pass straight to preprocess_image, saving a JPEG encode/decode and a disk round
+    trip. Ignored if basic_only is true.
+    :return: (np.ndarray) greyscale uint8 image if return_array is true, otherwise (bool) True once the image has
+    been written. None if the image could not be prepared.
     """
     try:
         # Read the image
         img = Image.open(src_image_path)
 
+        if return_array and not basic_only:
+            # Greyscale before resizing, as preprocess_image greyscales the image first anyway and a single channel
+            # is cheaper to resize
+            img = img.convert("L")
+
         # Convert image to JPG
         img.convert("RGB")
 
@@ -89,10 +126,16 @@ def meet_upload_reqs(src_image_path, dest_image_path, basic_only):
         if factor > 1:
             # image_size[0] = width, [1] = height
             size = int(factor * img.size[0]), int(factor * img.size[1])
-            img = img.resize(size, resample=Image.LANCZOS)
+            with stage_timer.stage("lanczos_upscale"):
+                img = img.resize(size, resample=Image.LANCZOS)
+
+        if return_array and not basic_only:
+            # Hand the image straight to preprocess_image, which writes the final output
+            return np.asarray(img)
 
         # Write the image and set desired DPI (300)
-        img.save(dest_image_path, dpi=(300, 300))
+        with stage_timer.stage("upload_reqs_encode"):
+            img.save(dest_image_path, dpi=(300, 300))
 
         if basic_only:
             # If user only requires preparation for upload to Transkribus but no further preprocessing, perform
@@ -107,11 +150,15 @@ def meet_upload_reqs(src_image_path, dest_image_path, basic_only):
                 # If image is larger than max allowed size, compress until allowable size
                 compress_under_size(max_image_bytes, dest_image_path)
 
+        return True
+
     except Exception as image_prep_error:
         print(f"Error preprocessing image {os.path.basename(src_image_path)}: {image_prep_error}")
 
 
-def preprocess_image(src_image_path, dest_image_path, contrast_enhance, k_val, window_size):
+@stage_timer.timed("preprocess_image", image_arg="dest_image_path")
+def preprocess_image(src_image_path, dest_image_path, contrast_enhance, k_val, window_size, image=None, journal=None,
+                     sauvola_engine="skimage", denoise_tile_size=None, output_format="jpeg", denoise_threads=None):
     """
     Performs the second preprocessing step to prepare images for more accurate OCR/HTR. Includes: Greyscaling,
     denoising, (optional) constrast stretching and contrast enhancement, Sauvola binarisation, and deskewing.
@@ -122,119 +169,410 @@ def preprocess_image(src_image_path, dest_image_path, contrast_enhance, k_val, w
     :param k_val: (float) The K-value used during Sauvola binarisation (default: 0.14)
     :param window_size: (int) The window size used during Sauvola binarisation. Should not be an even value
     (default: 21)
+    :param image: (np.ndarray) Greyscale uint8 image already decoded by meet_upload_reqs(return_array=True). If given,
+    it is used instead of reading the image at src_image_path.
+    :param journal: (run_journal.RunJournal) If given, the binarised/deskewed and compressed stages are recorded
+    against dest_image_path as they complete.
+    :param sauvola_engine: (str) Implementation of Sauvola binarisation to use: "skimage" (skimage
+    filters.threshold_sauvola in float64) or "opencv" (binarise_sauvola_opencv, box filters in float32 on the uint8
+    image, much faster and lighter on memory with near-identical output).
+    :param denoise_tile_size: (int) If given, the image is denoised in overlapping tiles of this size on a thread pool
+    (see denoise_tiled), rather than in a single call.
+    :param output_format: (str) One of OUTPUT_FORMATS. With "png", the binarised image is written losslessly as a 1 bit
+    PNG next to dest_image_path (replacing it), which is normally well under the size limit so needs no compression.
+    :param denoise_threads: (int) Number of threads denoising the image, tiled or not (see cpu_budget.split_cpus).
     """
-    transk_image_extensions = ['.pdf', '.jpg', '.png']  # file types allowed by Transkribus
-
     try:
-        # Check if the file is an image (any file with an image extension)
-        if any(src_image_path.lower().endswith(image_ext) for image_ext in transk_image_extensions):
-            # Read the image
-            image = cv2.imread(src_image_path)
+        # Check if the file is an image of a type allowed by Transkribus
+        if discovery.has_extension(src_image_path, discovery.TRANSKRIBUS_IMAGE_EXTENSIONS):
             if image is None:
-                print(f"Error: Image not found or cannot be read: {src_image_path}")
-                pass
+                # Read the image
+                image = cv2.imread(src_image_path)
+                if image is None:
+                    print(f"Error: Image not found or cannot be read: {src_image_path}")
+                    pass
 
-            # Greyscale the image
-            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+                # Greyscale the image
+                image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
 
-            # Denoise image: Fast non-local means denoising (method for greyscale images):
-            image = cv2.fastNlMeansDenoising(image, None, h=10,
-                                             templateWindowSize=7,
-                                             searchWindowSize=21)
+            # Denoise and (optionally) enhance contrast
+            image = denoise_image(image, contrast_enhance, tile_size=denoise_tile_size, threads=denoise_threads)
 
-            # Enhance contrast (optional): Normalisation (contrast stretching) +
-            # adaptive histogram equalization (CLAHE)
-            if contrast_enhance:
-                clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-                image = clahe.apply(cv2.normalize(image, None, 0, 255, cv2.NORM_MINMAX))
+            with stage_timer.stage("sauvola"):
+                if sauvola_engine == "opencv":
+                    # Binarise: Sauvola (local) thresholding directly on the uint8 greyscale image
+                    image = binarise_sauvola_opencv(image, window_size=window_size, k_val=k_val)
 
-            # Convert between opencv's BGR format and skimage's RGB format for numpy arrays representing images
-            # Avoids overhead of writing to file with cv2 then reopening with skimage
-            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-            image = color.rgb2gray(image)  # Convert to greyscale with skimage for quicker processing
+                else:
+                    # Convert between opencv's BGR format and skimage's RGB format for numpy arrays representing images
+                    # Avoids overhead of writing to file with cv2 then reopening with skimage
+                    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+                    image = color.rgb2gray(image)  # Convert to greyscale with skimage for quicker processing
 
-            # Binarise: Sauvola (local) thresholding
-            sauvola_threshold = filters.threshold_sauvola(image, window_size=window_size, k=k_val)
-            image = image > sauvola_threshold
+                    # Binarise: Sauvola (local) thresholding
+                    sauvola_threshold = filters.threshold_sauvola(image, window_size=window_size, k=k_val)
+                    image = image > sauvola_threshold
 
-            # Write image to path
-            image = util.img_as_ubyte(image)  # Convert boolean image to uint8
+                    # Write image to path
+                    image = util.img_as_ubyte(image)  # Convert boolean image to uint8
 
             # Skew correction: Projection Profiling method from Susmith Reddy
             # https://towardsdatascience.com/pre-processing-in-ocr-fc231c6035a7
-            rotate_image(image, dest_image_path)
+            output_image_path = rotate_image(image, dest_image_path, output_format=output_format)
+
+            if journal is not None:
+                # The binarised image is only kept once the deskewed image has been written
+                journal.record(dest_image_path, run_journal.BINARISED)
+                journal.record(dest_image_path, run_journal.DESKEWED)
 
             # If image is already smaller than target size, return the image
-            img_size_bytes = os.path.getsize(dest_image_path)
+            img_size_bytes = os.path.getsize(output_image_path)
             if img_size_bytes <= max_image_bytes:
                 pass
             else:
                 # If image is larger than max allowed size, compress until allowable size
-                compress_under_size(max_image_bytes, dest_image_path)
+                compress_under_size(max_image_bytes, output_image_path)
+
+            if journal is not None:
+                journal.record(dest_image_path, run_journal.COMPRESSED)
 
     except Exception as image_preprocessing_error:
-        print(f"Error preprocessing image {file} when running preprocess_image function: {image_preprocessing_error}")
+        print(f"Error preprocessing image {os.path.basename(src_image_path)} when running preprocess_image function: "
+              f"{image_preprocessing_error}")
+
+
+def denoise_image(image, contrast_enhance, tile_size=None, threads=None):
+    """
+    Denoises a greyscale image ahead of binarisation, and optionally enhances its contrast.
+    :param image: (np.ndarray) uint8 greyscale image
+    :param contrast_enhance: (bool) If true, performs contrast stretching and contrast enhancement on the image
+    :param tile_size: (int) If given, the image is denoised in overlapping tiles of this size on a thread pool (see
+    denoise_tiled). Otherwise it is denoised in a single call.
+    :param threads: (int) number of threads denoising the image, as this process's share of the CPU cores (see
+    cpu_budget.split_cpus). Default: one per CPU core, through OpenCV's thread pool or, in tiles, see denoise_tiled.
+    :return: (np.ndarray) denoised uint8 greyscale image
+    """
+    # Denoise image: Fast non-local means denoising (method for greyscale images):
+    with stage_timer.stage("denoise"):
+        if tile_size:
+            image = denoise_tiled(image, tile_size, workers=threads)
+        else:
+            # A single call is spread over OpenCV's own thread pool
+            with opencv_threads(threads):
+                image = cv2.fastNlMeansDenoising(image, None, h=denoise_h,
+                                                 templateWindowSize=denoise_template_window_size,
+                                                 searchWindowSize=denoise_search_window_size)
+
+    # Enhance contrast (optional): Normalisation (contrast stretching) +
+    # adaptive histogram equalization (CLAHE)
+    if contrast_enhance:
+        clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+        image = clahe.apply(cv2.normalize(image, None, 0, 255, cv2.NORM_MINMAX))
+
+    return image
+
+
+def denoise_tiled(image, tile_size, workers=None):
+    """
+    Fast non-local means denoising of a large greyscale image in tiles, denoised concurrently on a thread pool (OpenCV
+    releases the GIL). OpenCV's own thread pool, which a single call is spread over, is limited to one thread while
+    the tiles are denoised, so the tile threads are the only threads denoising. Each tile is denoised together with a
+    margin of its neighbouring pixels at least as wide as the search window, and only the tile itself is kept, so the
+    tiles stitch back together without seams. The output is the same as denoising the whole image in a single call.
+    :param image: (np.ndarray) uint8 greyscale image
+    :param tile_size: (int) side length of each tile in pixels, excluding the margin
+    :param workers: (int) number of threads to use (default: every CPU core available to the process). When several
+    processes denoise images at once, pass their share of the cores (see cpu_budget.split_cpus) so they don't
+    oversubscribe the CPU.
+    :return: (np.ndarray) denoised uint8 greyscale image
+    """
+    if workers is None:
+        workers = cpu_budget.available_cpus()
+
+    # Each output pixel depends on pixels up to (search window + template window) / 2 away, so a margin of a whole
+    # search window is enough for tiles to be denoised exactly as they would be within the whole image
+    margin = denoise_search_window_size
+    height, width = image.shape[:2]
+    denoised = np.empty_like(image)
+
+    def denoise_tile(tile_origin):
+        top, left = tile_origin
+        bottom, right = min(top + tile_size, height), min(left + tile_size, width)
+
+        # Denoise the tile with its margin (clipped at the image edges), then keep only the tile itself
+        margin_top, margin_left = max(top - margin, 0), max(left - margin, 0)
+        tile = cv2.fastNlMeansDenoising(image[margin_top:min(bottom + margin, height),
+                                              margin_left:min(right + margin, width)],
+                                        None, h=denoise_h,
+                                        templateWindowSize=denoise_template_window_size,
+                                        searchWindowSize=denoise_search_window_size)
+        denoised[top:bottom, left:right] = tile[top - margin_top:bottom - margin_top,
+                                                left - margin_left:right - margin_left]
+
+    tile_origins = [(top, left) for top in range(0, height, tile_size) for left in range(0, width, tile_size)]
+    with opencv_threads(1), ThreadPoolExecutor(max_workers=workers) as executor:
+        # list() so any error raised while denoising a tile is raised here
+        list(executor.map(denoise_tile, tile_origins))
+
+    return denoised
+
+
+@contextmanager
+def opencv_threads(threads):
+    """
+    Limits the threads OpenCV spreads each call over (cv2.setNumThreads, which applies to the whole process) within the
+    with block, and restores the previous limit afterwards.
+    :param threads: (int) number of threads. If None, OpenCV's limit is left unchanged.
+    """
+    if threads is None:
+        yield
+        return
+
+    previous_threads = cv2.getNumThreads()
+    cv2.setNumThreads(threads)
+    try:
+        yield
+    finally:
+        cv2.setNumThreads(previous_threads)
+
+
+def sauvola_statistics(image, window_size):
+    """
+    Computes the local mean and standard deviation used by Sauvola binarisation, with OpenCV box filters in float32.
+    Borders are reflected in the same way as skimage's threshold_sauvola.
+    :param image: (np.ndarray) uint8 greyscale image
+    :param window_size: (int) side length of the square window. Should not be an even value.
+    :return: (tuple) (local mean, local standard deviation), both float32 arrays on the image's 0-255 scale
+    """
+    image = image.astype(np.float32)
+    window = (window_size, window_size)
+
+    mean = cv2.boxFilter(image, cv2.CV_32F, window, borderType=cv2.BORDER_REFLECT_101)
+    # Reuse the float32 copy of the image for the local mean of squares
+    std = cv2.sqrBoxFilter(image, cv2.CV_32F, window, dst=image, borderType=cv2.BORDER_REFLECT_101)
+
+    # Variance = E[x^2] - E[x]^2, clipped at 0 as float32 rounding can make it slightly negative in flat regions
+    std -= cv2.multiply(mean, mean)
+    np.maximum(std, 0, out=std)
+    np.sqrt(std, out=std)
+
+    return mean, std
+
+
+def threshold_sauvola_from_statistics(mean, std, k_val, dynamic_range=255):
+    """
+    Computes the Sauvola threshold T = m * (1 + k * (s / R - 1)) from precomputed local statistics.
+    :param mean: (np.ndarray) local mean, from sauvola_statistics
+    :param std: (np.ndarray) local standard deviation, from sauvola_statistics
+    :param k_val: (float) The K-value used during Sauvola binarisation
+    :param dynamic_range: (float) R, the dynamic range of standard deviation. 255 on the uint8 scale matches skimage's
+    default for the float images it thresholds (R = 1 on a 0-1 scale).
+    :return: (np.ndarray) float32 threshold for each pixel
+    """
+    threshold = std * np.float32(k_val / dynamic_range)
+    threshold += np.float32(1 - k_val)
+    threshold *= mean
+
+    return threshold
 
 
+def binarise_sauvola_opencv(image, window_size, k_val):
+    """
+    Sauvola binarisation on a uint8 greyscale image, using OpenCV box filters in float32. Alternative to converting
+    the image to float64 and using skimage's filters.threshold_sauvola, with near-identical output.
+    :param image: (np.ndarray) uint8 greyscale image
+    :param window_size: (int) The window size used during Sauvola binarisation. Should not be an even value
+    :param k_val: (float) The K-value used during Sauvola binarisation
+    :return: (np.ndarray) binarised uint8 image (0 or 255)
+    """
+    mean, std = sauvola_statistics(image, window_size)
+    threshold = threshold_sauvola_from_statistics(mean, std, k_val)
+
+    return np.where(image > threshold, np.uint8(255), np.uint8(0))
+
+
+@stage_timer.timed("compress_under_size", image_arg="src_img_path")
 def compress_under_size(desired_max_bytes, src_img_path):
     """
     Searches until function achieves an approximate compression quality value according to desired max bytes
     :param desired_max_bytes: (int) maximum desired size in bytes of image
     :param src_img_path: (str) path to the image file to be custom compressed
     """
-    quality = 85  # value of 90 usually increases size
-
     # current image size in bytes (not megabytes)
     img_size_bytes = os.path.getsize(src_img_path)
+    print(f"compressing further - current size: {img_size_bytes / bytes_in_mb}mb")
+
+    # Decode the image once. Every candidate quality is encoded from this same original image, rather than from the
+    # output of the previous attempt, so quality is only lost once.
+    with Image.open(src_img_path) as img:
+        img.load()
+
+    compress_to_size(img, desired_max_bytes, src_img_path)
+
+
+def compress_to_size(image, desired_max_bytes, dest_img_path, max_quality=85, min_quality=5):
+    """
+    Encodes an image as JPEG at the highest quality whose output fits within desired_max_bytes and writes it to disk
+    once. Candidate qualities are encoded into memory and chosen by binary search, so a page needs at most 8 encodes
+    and no intermediate writes.
+    :param image: (PIL.Image or np.ndarray) image to be compressed
+    :param desired_max_bytes: (int) maximum desired size in bytes of image
+    :param dest_img_path: (str) path at which to save the compressed image. If the image cannot be compressed below
+    desired_max_bytes, any existing file at this path is removed.
+    :param max_quality: (int) highest JPEG quality to consider (value of 90 usually increases size)
+    :param min_quality: (int) lowest JPEG quality to consider
+    :return: (int) size of resulting image in bytes, or None if it could not be compressed below desired_max_bytes
+    """
+    if isinstance(image, np.ndarray):
+        image = Image.fromarray(image)
+
+    # Highest quality tried first, as many images only need re-encoding once
+    best_encoding = encode_jpeg(image, max_quality)
+    if len(best_encoding) > desired_max_bytes:
+        best_encoding = None
+
+        # Binary search for the highest quality whose encoding fits within desired_max_bytes
+        low, high = min_quality, max_quality - 1
+        while low <= high:
+            quality = (low + high) // 2
+            encoding = encode_jpeg(image, quality)
+
+            if len(encoding) <= desired_max_bytes:
+                best_encoding = encoding
+                low = quality + 1
+            else:
+                high = quality - 1
+
+    if best_encoding is None:
+        if os.path.exists(dest_img_path):
+            os.remove(dest_img_path)
+        print("Error: File cannot be compressed below this size")
+        return None
 
-    while img_size_bytes > desired_max_bytes or quality == 0:
-        print(f"compressing further - current size: {img_size_bytes / bytes_in_mb}mb")
-        if quality == 0:
-            os.remove(src_img_path)
-            print("Error: File cannot be compressed below this size")
-            break
+    with open(dest_img_path, "wb") as compressed_file:
+        compressed_file.write(best_encoding)
 
-        compress_pic(src_img_path, quality)
-        img_size_bytes = os.path.getsize(src_img_path)
-        quality -= 5
+    print(f"final compressed size: {len(best_encoding) / bytes_in_mb}mb")
 
-    print(f"final compressed size: {img_size_bytes / bytes_in_mb}mb")
+    return len(best_encoding)
 
 
-def compress_pic(src_img_path, quality):
+def encode_jpeg(image, quality):
     """
-    Compressed image located at image path to given quality % while saving newly-compressed image. Helper function to
-    compress_under_size.
-    :param src_img_path: (str) A string to the image file to be custom compressed
-    :param quality: (int) The quality to be compressed down to.
-    :return: (int) size of resulting image in bytes
+    Encodes an image as JPEG in memory. Helper function to compress_to_size.
+    :param image: (PIL.Image) image to be encoded
+    :param quality: (int) JPEG quality to encode at
+    :return: (bytes) encoded image
     """
-    img = Image.open(src_img_path)
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", optimize=True, quality=quality)
 
-    img.save(src_img_path, "JPEG", optimize=True, quality=quality)
+    return buffer.getvalue()
 
-    processed_size = os.path.getsize(src_img_path)
 
-    return processed_size
+# Lossless formats binarised pages can be written in at 1 bit per pixel, and their file extensions. Transkribus accepts
+# PNG uploads but not TIFF, so TIFF (CCITT Group 4) is only offered by compare_bilevel_encodings.
+BILEVEL_FORMATS = {"png": ".png", "tiff": ".tif"}
 
+# Formats binarised pages can be output in. "jpeg" writes the page as an 8 bit JPEG, compressed until under size.
+OUTPUT_FORMATS = ["jpeg", "png"]
 
-def count_files_in_directory_tree(src_folder, extension_list=None):
+
+def as_bilevel(image):
     """
-    Counts the number of image files to be processed for use alongside tqdm progress bar.
-    :param src_folder: (str) path to directory containing image files to be processed
-    :param extension_list: (list) list of allowable file extensions - only count files with this extension
-    :return: (int) number of image files to be processed
+    Checks whether an image is pure black and white, so it can be encoded at 1 bit per pixel without loss.
+    :param image: (np.ndarray) greyscale or 3-channel image
+    :return: (np.ndarray) 2D uint8 image of 0s and 255s, or None if the image has any other values
     """
-    total_file_count = 0
-    for root, dirs, files in os.walk(src_folder):
-        if extension_list:
-            for file in files:
-                # Check if the file ends with one of the image extensions
-                if any(file.lower().endswith(ext) for ext in extension_list):
-                    total_file_count += 1
-        else:
-            total_file_count += len(files)
-    return total_file_count
+    array = np.asarray(image)
+    if array.dtype == bool:
+        return array.astype(np.uint8) * 255
+
+    if array.ndim == 3:
+        # e.g. a binarised image read back in colour, where every channel is the same
+        if not np.array_equal(array, np.broadcast_to(array[..., :1], array.shape)):
+            return None
+        array = array[..., 0]
+
+    # A histogram of the page avoids allocating full-page boolean masks
+    if array.dtype != np.uint8 or cv2.calcHist([array], [0], None, [256], [0, 256])[1:255].any():
+        return None
+
+    return array
+
+
+def encode_bilevel(image, output_format="png"):
+    """
+    Encodes a black and white image losslessly at 1 bit per pixel in memory.
+    :param image: (np.ndarray) 2D uint8 image of 0s and 255s, see as_bilevel
+    :param output_format: (str) "png", or "tiff" for a TIFF with CCITT Group 4 compression
+    :return: (bytes) encoded image
+    """
+    bilevel = Image.fromarray(image).point(lambda value: 255 if value > 127 else 0, mode="1")
+
+    buffer = io.BytesIO()
+    if output_format == "tiff":
+        bilevel.save(buffer, "TIFF", compression="group4", dpi=(300, 300))
+    else:
+        bilevel.save(buffer, "PNG", dpi=(300, 300))
+
+    return buffer.getvalue()
+
+
+def save_output_image(image, dest_image_path, output_format="jpeg"):
+    """
+    Writes a binarised page to disk. When output_format is one of BILEVEL_FORMATS and the page is pure black and
+    white, it is written losslessly at 1 bit per pixel, at dest_image_path with the format's extension (replacing any
+    image at dest_image_path). Otherwise, or if the bilevel encoding is over max_image_bytes, the page is written to
+    dest_image_path in the format given by its extension, to be compressed under size as before.
+    :param image: (np.ndarray) binarised page
+    :param dest_image_path: (str) Filepath at which to save the page.
+    :param output_format: (str) One of OUTPUT_FORMATS.
+    :return: (str) Filepath the page was written to.
+    """
+    if output_format in BILEVEL_FORMATS:
+        bilevel = as_bilevel(image)
+        if bilevel is not None:
+            encoding = encode_bilevel(bilevel, output_format)
+
+            if len(encoding) <= max_image_bytes:
+                output_image_path = os.path.splitext(dest_image_path)[0] + BILEVEL_FORMATS[output_format]
+                with open(output_image_path, "wb") as output_file:
+                    output_file.write(encoding)
+
+                # The prepared image at dest_image_path has now been replaced by the binarised image
+                if output_image_path != dest_image_path and os.path.exists(dest_image_path):
+                    os.remove(dest_image_path)
+
+                return output_image_path
+
+    Image.fromarray(np.asarray(image, np.uint8)).save(dest_image_path)
+
+    return dest_image_path
+
+
+def compare_bilevel_encodings(image, jpeg_quality=85):
+    """
+    Encodes a binarised page in every bilevel format and as JPEG, to compare their size and encode time.
+    :param image: (np.ndarray) binarised page of 0s and 255s
+    :param jpeg_quality: (int) JPEG quality to encode at (as the first attempt of compress_to_size)
+    :return: (dict) {format: {"bytes": size of encoding, "encode_s": seconds taken to encode}}
+    """
+    bilevel = as_bilevel(image)
+    if bilevel is None:
+        raise ValueError("Image is not pure black and white")
+
+    encoders = {output_format: (lambda output_format=output_format: encode_bilevel(bilevel, output_format))
+                for output_format in BILEVEL_FORMATS}
+    encoders["jpeg"] = lambda: encode_jpeg(Image.fromarray(bilevel), jpeg_quality)
+
+    report = {}
+    for output_format, encode in encoders.items():
+        start = time.perf_counter()
+        encoding = encode()
+        report[output_format] = {"bytes": len(encoding), "encode_s": time.perf_counter() - start}
+
+    return report
 
 
 def find_rotation_score(array, angle):
@@ -258,6 +596,17 @@ def find_rotation_angle(image):
     delta = 1
     limit = 5
     angles = np.arange(-limit, limit + delta, delta)
+
+    return find_best_rotation_angle(image, angles)
+
+
+def find_best_rotation_angle(image, angles):
+    """
+    Scores each candidate angle with find_rotation_score and returns the angle with the highest score.
+    :param image: (np.ndarray) greyscaled and binarised/thresholded image
+    :param angles: (np.ndarray) candidate rotation angles in degrees
+    :return: (float) best_rotation_angle
+    """
     scores = []
 
     for angle in angles:
@@ -270,27 +619,210 @@ def find_rotation_angle(image):
     return best_rotation_angle
 
 
-def rotate_image(image, dest_image_path):
+def find_rotation_angle_pyramid(image, limit=5, coarse_factor=4, fine_factor=2, fine_delta=0.1):
+    """
+    Coarse-to-fine version of find_rotation_angle. Searches a 1 degree grid of angles on a heavily downsampled copy of
+    the image, then refines the best angle to fine_delta precision on a less downsampled copy, searching only the band
+    of angles within half a degree of the coarse estimate. Finally the refined angle, its neighbours and 0 are scored
+    again at full resolution (see refinement_angles), as downsampling alone biases the search by a step on straight
+    pages.
+    :param image: (np.ndarray) greyscaled and binarised/thresholded image
+    :param limit: (int) maximum absolute rotation angle searched, in degrees
+    :param coarse_factor: (int) downsampling factor used for the coarse search
+    :param fine_factor: (int) downsampling factor used for the fine search (1 = full resolution)
+    :param fine_delta: (float) step between angles in the fine search, in degrees
+    :return: (float) best_rotation_angle
+    """
+    # Coarse search: 1 degree grid over the full range of angles
+    coarse_angles = np.arange(-limit, limit + 1, 1)
+    coarse_angle = find_best_rotation_angle(downscale_image(image, coarse_factor), coarse_angles)
+
+    # Fine search: fine_delta grid over the band around the coarse estimate, kept within the full range of angles
+    fine_angles = np.round(coarse_angle + np.arange(-0.5, 0.5 + fine_delta / 2, fine_delta), 2)
+    fine_angles = fine_angles[np.abs(fine_angles) <= limit]
+    best_rotation_angle = find_best_rotation_angle(downscale_image(image, fine_factor), fine_angles)
+
+    if fine_factor > 1:
+        best_rotation_angle = find_best_rotation_angle(image, refinement_angles(best_rotation_angle, fine_delta, limit))
+
+    # + 0.0 turns -0.0 into 0.0
+    return best_rotation_angle + 0.0
+
+
+def downscale_image(image, factor):
+    """
+    Shrinks an image by an integer factor using area interpolation, which averages pixels rather than dropping them
+    so that thin lines of text still contribute to the projection profile.
+    :param image: (np.ndarray) greyscale image
+    :param factor: (int) downsampling factor. If 1, the image is returned unchanged.
+    :return: (np.ndarray) downscaled image
+    """
+    if factor <= 1:
+        return image
+
+    height, width = image.shape[:2]
+    return cv2.resize(image, (max(1, width // factor), max(1, height // factor)), interpolation=cv2.INTER_AREA)
+
+
+def find_rotation_angle_shear(image, limit=5, delta=0.1, factor=2, max_indices=2 ** 20):
+    """
+    Projection profile search which approximates each small rotation as a vertical shear, so no image is rotated
+    during the search (see shear_scores). Searches every angle on a downsampled copy of the image, then re-scores the
+    best angle, its neighbours and 0 at full resolution (see refinement_angles), as downsampling alone biases the
+    search by a step on straight pages.
+    :param image: (np.ndarray) greyscaled and binarised/thresholded image
+    :param limit: (int) maximum absolute rotation angle searched, in degrees
+    :param delta: (float) step between angles, in degrees
+    :param factor: (int) downsampling factor of the copy searched (1 = full resolution)
+    :param max_indices: (int) maximum number of row indices counted at once (see shear_scores)
+    :return: (float) best_rotation_angle
+    """
+    angles = np.round(np.arange(-limit, limit + delta / 2, delta), 2)
+    scores = shear_scores(downscale_image(image, factor), angles, max_indices)
+    if scores is None:
+        return 0
+
+    best_rotation_angle = angles[np.argmax(scores)]
+    if factor > 1:
+        angles = refinement_angles(best_rotation_angle, delta, limit)
+        best_rotation_angle = angles[np.argmax(shear_scores(image, angles, max_indices))]
+
+    # + 0.0 turns -0.0 into 0.0
+    return best_rotation_angle + 0.0
+
+
+def shear_scores(image, angles, max_indices=2 ** 20):
+    """
+    Projection profile scores of small rotations, each approximated as a vertical shear. Each foreground (dark) pixel's
+    row is offset in proportion to its distance from the centre column, and the row histograms for all the angles are
+    counted together with np.bincount over the foreground pixel coordinates. Scores each angle as find_rotation_score
+    does (for a binarised image, the row sums of find_rotation_score are a constant minus 255 times the foreground count
+    of the row, so the best angle is the same).
+    :param image: (np.ndarray) greyscaled and binarised/thresholded image
+    :param angles: (np.ndarray) rotation angles in degrees
+    :param max_indices: (int) maximum number of row indices counted at once. Angles are counted in chunks to keep to
+    this, which bounds memory use on large pages and is faster than counting every angle at once.
+    :return: (np.ndarray) score of each angle, or None if the image has no foreground pixels
+    """
+    height, width = image.shape[:2]
+
+    rows, columns = np.nonzero(image < 128)
+    if rows.size == 0:
+        return None
+
+    # Rotating by ndimage.rotate's positive angle moves the right of the page up relative to the left
+    slopes = -np.tan(np.radians(angles))
+    centred_columns = (columns - (width - 1) / 2).astype(np.float32)
+    margin = int(np.ceil(np.abs(centred_columns).max() * np.abs(slopes).max())) + 1
+    bins = height + 2 * margin
+    rows = (rows + margin).astype(np.float32)
+
+    scores = np.empty(len(angles))
+    chunk = max(1, max_indices // rows.size)
+    for start in range(0, len(angles), chunk):
+        chunk_slopes = slopes[start:start + chunk, np.newaxis].astype(np.float32)
+        # Row of each foreground pixel after shearing, offset into a separate histogram for each angle
+        sheared_rows = np.rint(rows + centred_columns * chunk_slopes).astype(np.int64)
+        sheared_rows += np.arange(len(chunk_slopes))[:, np.newaxis] * bins
+        hists = np.bincount(sheared_rows.ravel(), minlength=len(chunk_slopes) * bins).reshape(-1, bins)
+        scores[start:start + len(chunk_slopes)] = np.sum(np.diff(hists, axis=1) ** 2, axis=1)
+
+    return scores
+
+
+def refinement_angles(angle, delta, limit):
+    """
+    Angles to re-score at full resolution after searching a downsampled copy of an image. Averaging pixels together
+    flattens the projection profile enough that, on a straight page, a neighbouring angle can outscore 0 by a hair,
+    so the best angle found is compared against its neighbours and 0 again without downsampling.
+    :param angle: (float) best angle found on the downsampled copy, in degrees
+    :param delta: (float) step between the angles searched, in degrees
+    :param limit: (int) maximum absolute rotation angle searched, in degrees
+    :return: (np.ndarray) 0 first (so it wins ties), then the angle and its neighbours within the searched range
+    """
+    angles = np.round([0, angle - delta, angle, angle + delta], 2)
+    angles = angles[np.abs(angles) <= limit]
+
+    # Drop repeats (e.g. 0 when the best angle is next to it), keeping the first occurrence
+    return angles[np.sort(np.unique(angles, return_index=True)[1])]
+
+
+# Angle search used by rotate_image to deskew images
+DESKEW_SEARCHES = {"grid": find_rotation_angle,
+                   "pyramid": find_rotation_angle_pyramid,
+                   "shear": find_rotation_angle_shear}
+DESKEW_SEARCH = "shear"
+
+
+def rotate_ndimage(array, angle):
+    """
+    Rotates an image about its centre with scipy, keeping its size. Areas rotated in from outside the image are black.
+    :param array: (np.ndarray) greyscaled and binarised/thresholded image
+    :param angle: (float) rotation angle in degrees (counter-clockwise)
+    :return: (np.ndarray) rotated image
+    """
+    return ndimage.rotate(array, angle, reshape=False, order=0)
+
+
+def rotate_opencv(array, angle):
+    """
+    Rotates a single-channel uint8 image about its centre with cv2.warpAffine (nearest neighbour, so a binarised image
+    stays black and white), keeping its size. Areas rotated in from outside the image are white, like the page
+    background. Only the rotated image is allocated.
+    :param array: (np.ndarray) greyscaled and binarised/thresholded uint8 image
+    :param angle: (float) rotation angle in degrees (counter-clockwise, as rotate_ndimage)
+    :return: (np.ndarray) rotated image
+    """
+    height, width = array.shape[:2]
+    # Same centre as ndimage.rotate
+    matrix = cv2.getRotationMatrix2D(((width - 1) / 2, (height - 1) / 2), float(angle), 1.0)
+
+    return cv2.warpAffine(array, matrix, (width, height), flags=cv2.INTER_NEAREST, borderMode=cv2.BORDER_CONSTANT,
+                          borderValue=255)
+
+
+# Implementation used by rotate_image to apply the deskew rotation
+ROTATION_BACKENDS = {"ndimage": rotate_ndimage,
+                     "opencv": rotate_opencv}
+ROTATION_BACKEND = "opencv"
+
+
+@stage_timer.timed("rotate_image", image_arg="dest_image_path")
+def rotate_image(image, dest_image_path, search=None, output_format=None, backend=None):
     """
     Projection Profile method code taken from https://towardsdatascience.com/pre-processing-in-ocr-fc231c6035a7.
     Saves image to same location it was sourced from.
-    :param image: (np.ndarray) greyscaled and binarised/thresholded image
-    :return: rotated image
+    :param image: (np.ndarray) greyscaled and binarised/thresholded image. A single-channel uint8 image is used as it
+    is, without being copied (it is not modified). 3-channel images are greyscaled first.
+    :param dest_image_path: (str) Filepath at which to save the rotated image.
+    :param search: (str) Angle search to use, one of DESKEW_SEARCHES. Defaults to DESKEW_SEARCH.
+    :param output_format: (str) One of OUTPUT_FORMATS, see save_output_image. If None, the image is saved in the format
+    given by the extension of dest_image_path.
+    :param backend: (str) Rotation to use, one of ROTATION_BACKENDS. Defaults to ROTATION_BACKEND.
+    :return: (str) Filepath the rotated image was saved to
     """
-    # # Read image with Pillow
-    array = np.array(image, np.uint8)
+    array = np.asarray(image)
+    if array.dtype == bool:
+        array = array.view(np.uint8) * 255
+    elif array.dtype != np.uint8:
+        array = array.astype(np.uint8)
 
-    # Find the best rotation angle
-    rotation_angle = find_rotation_angle(array)
+    if array.ndim == 3:
+        # e.g. a binarised image read back in colour - rotate (and encode) one channel rather than three
+        array = cv2.cvtColor(array, cv2.COLOR_BGR2GRAY)
 
-    # Rotate the image according to the best/most likely angle
-    data = ndimage.rotate(array, rotation_angle, reshape=False, order=0)
+    # Find the best rotation angle
+    with stage_timer.stage("find_rotation_angle"):
+        rotation_angle = DESKEW_SEARCHES[search or DESKEW_SEARCH](array)
 
-    # Convert the rotated array back to PIL Image
-    image = Image.fromarray(data.astype("uint8"))
+    # Rotate the image according to the best/most likely angle. Skipped when the image is already straight.
+    if rotation_angle != 0:
+        with stage_timer.stage("rotate"):
+            array = ROTATION_BACKENDS[backend or ROTATION_BACKEND](array, rotation_angle)
 
     # Save rotated image
-    image.save(dest_image_path)
+    with stage_timer.stage("rotate_image_encode"):
+        return save_output_image(array, dest_image_path, output_format)
 
 
 if __name__ == "__main__":
@@ -311,66 +843,87 @@ if __name__ == "__main__":
                              "and do not want to do further preprocessing like binarisation (e.g. for evaluation "
                              "purposes).",
                         action="store_true")
+    parser.add_argument("--sauvola_engine", "-se", type=str, choices=["skimage", "opencv"], default="skimage",
+                        help="Implementation of Sauvola binarisation to use. opencv is much faster and uses less "
+                             "memory, with near-identical output (default: skimage)")
+    parser.add_argument("--denoise_tile_size", "-dt", type=int, default=0,
+                        help="Denoise each image in overlapping tiles of this many pixels square, on a thread pool, "
+                             "of one thread per CPU core, rather than in a single call (which OpenCV already spreads "
+                             "over the cores). Output is unchanged. Not known to be faster: no speedup over a single "
+                             "call has been measured yet (default: 0, denoise in a single call)")
+    parser.add_argument("--output_format", "-of", type=str, choices=OUTPUT_FORMATS, default="jpeg",
+                        help="Format to write binarised images in. png writes them losslessly at 1 bit per pixel, "
+                             "which is much smaller and faster to encode than JPEG and needs no further "
+                             "compression (default: jpeg)")
+    parser.add_argument("--single_decode", "-sd",
+                        help="Use flag to keep each image in memory between meeting Transkribus upload requirements "
+                             "and further preprocessing, instead of saving it as an intermediate JPEG and reading it "
+                             "back. Only the final output is written to disk.",
+                        action="store_true")
 
     args = parser.parse_args()
 
-    file_count = count_files_in_directory_tree(args.source_folder)
+    # Walk the source folder once to find every image and the destination filepath it is written to (same relative
+    # path, converted to jpg)
+    manifest = discovery.build_manifest(args.source_folder, args.destination_folder)
+    discovery.make_destination_folders(manifest)
 
     if args.basic_only:
         if any((args.k_val != 0.14, args.window_size != 21, args.contrast_enhance)):
             print("Warning: --basic_only is specified, other arguments (k_val, window_size, contrast_enhance) "
                   "are irrelevant and will not be used.")
 
-    # Common image file extensions
-    image_extensions = ['.png', '.jpg', '.jpeg', '.tiff', '.tif', '.bmp', '.gif', '.webp', '.ico', '.svg']
-
-    with tqdm(total=file_count, desc="Preprocessing images", unit="image") as pbar:
-        # Iterate through the source folder and its sub-folders
-        # root = current directory, dirs = subdirectories within current directory,
-        # files = filenames in current directory
-        for root, dirs, files in os.walk(args.source_folder):
-            for file in files:
-                try:
-                    # Check if the file is an image (any file with an image extension)
-                    if any(file.lower().endswith(image_ext) for image_ext in image_extensions):
-
-                        # Build the full path for the source and destination images.
-                        # relpath is used to replicate source directory structure.
-                        src_image_path = os.path.join(root, file)
-                        dest_image_path = os.path.join(args.destination_folder,
-                                                       os.path.relpath(src_image_path, args.source_folder))
-
-                        # Create the destination folder if it doesn't exist
-                        os.makedirs(os.path.dirname(dest_image_path), exist_ok=True)
-                        # exist_ok ensures function doesn't raise error if directory already exists
-
-                        # Determine destination file path/name after conversion to jpg
-                        dest_image_path = os.path.splitext(dest_image_path)[0] + '.jpg'
-
-                        pbar.set_description(f"Preprocessing image: {os.path.basename(src_image_path)}")
-
-                        # Process images using command-line arguments to meet Transkribus upload requirements
-                        meet_upload_reqs(src_image_path, dest_image_path, args.basic_only)
-
-                        if args.basic_only:
-                            # Update tqdm progress bar
-                            pbar.update(1)
-                            continue
-
-                        else:
-                            # Pre-process images to prepare them for OCR/HTR (we use destination_folder as the source
-                            # folder as images in destination folder have already been partially prepared by
-                            # meet_upload_reqs).
-                            preprocess_image(dest_image_path,
-                                             dest_image_path,
-                                             args.contrast_enhance,
-                                             args.k_val,
-                                             args.window_size)
-
-                            # Update tqdm progress bar
-                            pbar.update(1)
-
-                except Exception as image_processing_error:
-                    print(f"Error preprocessing image {file}: {image_processing_error}")
+    with tqdm(total=len(manifest), desc="Preprocessing images", unit="image") as pbar:
+        for entry in manifest:
+            try:
+                src_image_path, dest_image_path = entry.src, entry.dest
+
+                pbar.set_description(f"Preprocessing image: {os.path.basename(src_image_path)}")
+
+                if args.single_decode and not args.basic_only:
+                    # Keep the prepared image in memory and pass it straight to preprocess_image, so the
+                    # only file written is the final output
+                    image = meet_upload_reqs(src_image_path, dest_image_path, False, return_array=True)
+                    if image is not None:
+                        preprocess_image(dest_image_path,
+                                         dest_image_path,
+                                         args.contrast_enhance,
+                                         args.k_val,
+                                         args.window_size,
+                                         image=image,
+                                         sauvola_engine=args.sauvola_engine,
+                                         denoise_tile_size=args.denoise_tile_size,
+                                         output_format=args.output_format)
+
+                    # Update tqdm progress bar
+                    pbar.update(1)
+                    continue
+
+                # Process images using command-line arguments to meet Transkribus upload requirements
+                meet_upload_reqs(src_image_path, dest_image_path, args.basic_only)
+
+                if args.basic_only:
+                    # Update tqdm progress bar
+                    pbar.update(1)
+                    continue
+
+                else:
+                    # Pre-process images to prepare them for OCR/HTR (we use destination_folder as the source
+                    # folder as images in destination folder have already been partially prepared by
+                    # meet_upload_reqs).
+                    preprocess_image(dest_image_path,
+                                     dest_image_path,
+                                     args.contrast_enhance,
+                                     args.k_val,
+                                     args.window_size,
+                                     sauvola_engine=args.sauvola_engine,
+                                     denoise_tile_size=args.denoise_tile_size,
+                                     output_format=args.output_format)
+
+                    # Update tqdm progress bar
+                    pbar.update(1)
+
+            except Exception as image_processing_error:
+                print(f"Error preprocessing image {os.path.basename(entry.src)}: {image_processing_error}")
 
     print("Preprocessing completed")
\ No newline at end of file
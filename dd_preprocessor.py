@@ -4,14 +4,51 @@ import os  # Deals with path names
 import dd_preprocess
 from tqdm import tqdm  # For progress loading bar
 import cv2  # For image preprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed  # For spreading work over CPU cores
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+import multiprocessing  # Tracks the progress of images in worker processes
+import run_journal  # Records completed stages so interrupted runs can be resumed
+import stage_timer  # Optional per-stage timing instrumentation
+import discovery  # Image file extensions
+import page_handoff  # Hands denoised pages to SBB binarisation without writing them as JPEG
 
+def meet_upload_reqs_parallel(image_paths, workers, journal=None):
+    """
+    Prepares images to meet Transkribus upload requirements using a pool of worker processes. Results are collected
+    in completion order so the progress bar keeps moving while slow images are still being processed.
+    :param image_paths: [list]
+        List of (source image filepath, destination image filepath) tuples. Destination folders must already exist.
+    :param workers: [int]
+        Number of worker processes to use.
+    :param journal: [run_journal.RunJournal]
+        If given, each image which is prepared successfully is recorded against its destination filepath.
+    """
+    with tqdm(total=len(image_paths), desc="Preprocessing images", unit="image") as pbar:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # Timings recorded in worker processes are returned alongside each result
+            futures = {executor.submit(stage_timer.call_with_timings, stage_timer.is_enabled(),
+                                       dd_preprocess.meet_upload_reqs, src_image_path, dest_image_path, False):
+                       (src_image_path, dest_image_path) for src_image_path, dest_image_path in image_paths}
+
+            for future in as_completed(futures):
+                src_image_path, dest_image_path = futures[future]
+                try:
+                    prepared, timings = future.result()
+                    stage_timer.merge(timings)
+                    if prepared and journal is not None:
+                        journal.record(dest_image_path, run_journal.PREPARED)
+                    pbar.set_description(f"Prepared image: {os.path.basename(src_image_path)}")
+                except Exception as meet_upload_reqs_error:
+                    print(f"error preparing image: {os.path.basename(src_image_path)}", meet_upload_reqs_error)
+
+                # Update tqdm progress bar
+                pbar.update(1)
 
-# Common image file extensions
-IMAGE_EXTENSIONS = ['.png', '.jpg', '.jpeg', '.tiff', '.tif', '.bmp', '.gif', '.webp', '.ico', '.svg']
-TRANSKRIBUS_IMAGE_EXTENSIONS = ['.pdf', '.jpg', '.png']
 
 def process_images(treatment_map, sauvola_k_val, sauvola_window_size,
-                   contrast_enhance):
+                   contrast_enhance, workers=1, sbb_client=None, journal=None, sauvola_engine="skimage",
+                   denoise_tile_size=None, output_format="jpeg", handoff_dir=None, denoise_threads=None):
     """
     Processes images based on their treatment type specified in treatment_map.
     :param treatment_map: [dict]
@@ -23,6 +60,27 @@ def process_images(treatment_map, sauvola_k_val, sauvola_window_size,
     :param contrast_enhance: [bool]
         True if user wishes to contrast stretch and enhance contrast of images within pipeline. Default is False,
         determined through argparse.
+    :param workers: [int]
+        Number of worker processes used for the Sauvola pipeline (default: 1, i.e. process images one at a time).
+    :param sbb_client: [sbb_worker.SbbWorkerClient]
+        If given, good quality images are submitted to a running SBB binarisation worker as soon as they are prepared.
+    :param journal: [run_journal.RunJournal]
+        If given, stages already completed by images in an earlier, interrupted run are skipped, and stages completed
+        in this run are recorded.
+    :param sauvola_engine: [string]
+        Implementation of Sauvola binarisation to use, "skimage" or "opencv" (see dd_preprocess.preprocess_image).
+    :param denoise_tile_size: [int]
+        If given, images are denoised in overlapping tiles of this size on a thread pool (see
+        dd_preprocess.denoise_tiled), rather than in a single call.
+    :param output_format: [string]
+        Format to write Sauvola binarised images in, one of dd_preprocess.OUTPUT_FORMATS. With "png", they are written
+        losslessly at 1 bit per pixel with a .png extension, replacing the prepared .jpg image.
+    :param handoff_dir: [string]
+        If given, good quality images are handed to SBB binarisation as arrays saved in this folder (see
+        page_handoff.py), rather than written as JPEG.
+    :param denoise_threads: [int]
+        Number of threads denoising each image in each process, tiled or not (see
+        cpu_budget.split_cpus).
     :return: [list]
         List of good quality image filepaths to pass to SBB binarisation pipeline.
     """
@@ -31,16 +89,21 @@ def process_images(treatment_map, sauvola_k_val, sauvola_window_size,
     sbb_filepaths = [filepath for filepath, treatment in treatment_map.items() if treatment == 'sbb']
 
     # Process files with Sauvola pipeline
-    process_sauvola(sauvola_filepaths, sauvola_k_val, sauvola_window_size, contrast_enhance)
+    process_sauvola(sauvola_filepaths, sauvola_k_val, sauvola_window_size, contrast_enhance, workers=workers,
+                    journal=journal, sauvola_engine=sauvola_engine, denoise_tile_size=denoise_tile_size,
+                    output_format=output_format, denoise_threads=denoise_threads)
 
     # Prepare files for preprocessing with SBB pipeline
-    process_before_sbb(sbb_filepaths, contrast_enhance)
+    process_before_sbb(sbb_filepaths, contrast_enhance, sbb_client=sbb_client, journal=journal,
+                       denoise_tile_size=denoise_tile_size, handoff_dir=handoff_dir, denoise_threads=denoise_threads)
 
     # Return list of good quality image filepaths to pass to SBB binarisation pipeline.
     return sbb_filepaths
 
 
-def process_sauvola(filepaths, sauvola_k_val, sauvola_window_size, contrast_enhance):
+def process_sauvola(filepaths, sauvola_k_val, sauvola_window_size, contrast_enhance, workers=1, chunksize=None,
+                    journal=None, sauvola_engine="skimage", denoise_tile_size=None, output_format="jpeg",
+                    denoise_threads=None):
     """
     Function for processing images with Sauvola (non-machine learning) pipeline.
 
@@ -53,36 +116,236 @@ def process_sauvola(filepaths, sauvola_k_val, sauvola_window_size, contrast_enha
     :param contrast_enhance: [bool]
         True if user wishes to contrast stretch and enhance contrast of images within pipeline. Default is False,
         determined through argparse.
+    :param workers: [int]
+        Number of worker processes to use. If 1, images are processed one at a time in this process (default: 1). An
+        image which kills its worker process (breaking the pool) is the only image reported as failed - the rest are
+        processed in a fresh pool (see _process_sauvola_parallel).
+    :param chunksize: [int]
+        Number of images sent to a worker process at a time when workers > 1. If None, chosen so that each worker
+        receives roughly 4 chunks.
+    :param journal: [run_journal.RunJournal]
+        If given, images which already completed the pipeline in an earlier run are skipped, and stages completed in
+        this run are recorded.
+    :param sauvola_engine: [string]
+        Implementation of Sauvola binarisation to use, "skimage" or "opencv" (see dd_preprocess.preprocess_image).
+    :param denoise_tile_size: [int]
+        If given, images are denoised in overlapping tiles of this size on a thread pool (see
+        dd_preprocess.denoise_tiled), rather than in a single call.
+    :param output_format: [string]
+        Format to write binarised images in, one of dd_preprocess.OUTPUT_FORMATS (see dd_preprocess.preprocess_image).
+    :param denoise_threads: [int]
+        Number of threads denoising each image in each process, tiled or not (see
+        cpu_budget.split_cpus).
     """
     print("Preprocessing bad quality images")
+
+    # Only images in a format accepted by Transkribus are processed
+    filepaths = [file for file in filepaths
+                 if discovery.has_extension(file, discovery.TRANSKRIBUS_IMAGE_EXTENSIONS)]
+
+    if journal is not None:
+        # Skip images which were fully processed by an earlier run
+        filepaths = [file for file in filepaths if not journal.is_done(file, run_journal.COMPRESSED)]
     file_count = len(filepaths)
 
     with tqdm(total=file_count, desc="Preprocessing bad quality images", unit="image") as pbar:
-        for file in filepaths:
-            try:
-                # Check if the file is an image (any file with an image extension)
-                if any(file.lower().endswith(image_ext) for image_ext in TRANSKRIBUS_IMAGE_EXTENSIONS):
-                    pbar.set_description(f"Preprocessing image: {os.path.basename(file)}")
-
-                    # Pre-process images to prepare them for OCR/HTR (we use destination_folder as the source
-                    # folder as images in destination folder have already been partially prepared by
-                    # meet_upload_reqs).
-                    dd_preprocess.preprocess_image(src_image_path = file,
-                                     dest_image_path = file,
-                                     contrast_enhance = contrast_enhance,
-                                     k_val = sauvola_k_val,
-                                     window_size = sauvola_window_size)
-
-                    # Update tqdm progress bar
-                    pbar.update(1)
-            except Exception as sauvola_processing_error:
-                print(f"Error preprocessing image {file}: {sauvola_processing_error}")
+        if workers > 1 and file_count > 1:
+            if chunksize is None:
+                chunksize = max(1, file_count // (workers * 4))
+
+            process_chunk = partial(_process_sauvola_chunk, sauvola_k_val=sauvola_k_val,
+                                    sauvola_window_size=sauvola_window_size, contrast_enhance=contrast_enhance,
+                                    sauvola_engine=sauvola_engine, denoise_tile_size=denoise_tile_size,
+                                    output_format=output_format, denoise_threads=denoise_threads)
+            failed_filepaths = _process_sauvola_parallel(filepaths, process_chunk, workers, chunksize, journal, pbar)
+
+            if failed_filepaths:
+                print(f"{len(failed_filepaths)} bad quality image(s) could not be preprocessed:")
+                for file in failed_filepaths:
+                    print(f"    {file}")
+        else:
+            for file in filepaths:
+                pbar.set_description(f"Preprocessing image: {os.path.basename(file)}")
+
+                file, sauvola_processing_error = _process_sauvola_image(file, sauvola_k_val, sauvola_window_size,
+                                                                        contrast_enhance, journal, sauvola_engine,
+                                                                        denoise_tile_size, output_format,
+                                                                        denoise_threads)
+                if sauvola_processing_error is not None:
+                    print(f"Error preprocessing image {file}: {sauvola_processing_error}")
+
+                # Update tqdm progress bar
                 pbar.update(1)
 
     print("Preprocessing of bad quality images completed")
 
 
-def process_before_sbb(filepaths, contrast_enhance=None):
+def _process_sauvola_parallel(filepaths, process_chunk, workers, chunksize, journal, pbar):
+    """
+    Processes images with the Sauvola pipeline in chunks on a pool of worker processes. Each image's progress is kept
+    in a manager process, so that if a worker process dies (e.g. killed for running out of memory), which breaks the
+    pool and every chunk still in it, the images which had not started are processed in a fresh pool. The images
+    which were in progress when the pool broke are then retried one at a time on their own, so only an image which
+    kills its worker process by itself is reported as failed.
+    :param filepaths: [list]
+        Filepaths of the images to process.
+    :param process_chunk: [functools.partial]
+        _process_sauvola_chunk with the Sauvola settings bound.
+    :param workers: [int]
+        Number of worker processes to use.
+    :param chunksize: [int]
+        Number of images sent to a worker process at a time.
+    :param journal: [run_journal.RunJournal]
+        If given, each chunk is sent with the stages of its own images.
+    :param pbar: [tqdm]
+        Progress bar, updated as each image is finished.
+    :return: [list]
+        Filepaths of the images which could not be processed.
+    """
+    failed_filepaths = []
+
+    def report(file, sauvola_processing_error):
+        if sauvola_processing_error is not None:
+            print(f"Error preprocessing image {file}: {sauvola_processing_error}")
+            failed_filepaths.append(file)
+        pbar.set_description(f"Preprocessed image: {os.path.basename(file)}")
+
+        # Update tqdm progress bar
+        pbar.update(1)
+
+    def run_pool(pool_filepaths, pool_workers, pool_chunksize):
+        """
+        Processes images on a new pool, reporting each image which finishes.
+        :return: [tuple] (images in progress when a worker process died, images which were never started). Both are
+        empty unless the pool broke.
+        """
+        chunks = [pool_filepaths[start:start + pool_chunksize]
+                  for start in range(0, len(pool_filepaths), pool_chunksize)]
+
+        with ProcessPoolExecutor(max_workers=pool_workers) as executor:
+            # Only each chunk's own stages are sent with it
+            futures = {executor.submit(stage_timer.call_with_timings, stage_timer.is_enabled(), process_chunk,
+                                       chunk, progress, journal.subset(chunk) if journal is not None else None): chunk
+                       for chunk in chunks}
+            broken_chunks = []
+
+            for future in as_completed(futures):
+                chunk = futures[future]
+                try:
+                    _, timings = future.result()
+                    stage_timer.merge(timings)
+                except BrokenProcessPool:
+                    # The chunk's unfinished images are sorted out once every chunk has stopped
+                    broken_chunks.append(chunk)
+                    continue
+                except Exception as worker_error:
+                    # e.g. the chunk could not be sent to the worker process
+                    for file in chunk:
+                        finished, sauvola_processing_error = progress.pop(file, (False, None))
+                        report(file, sauvola_processing_error if finished else
+                               f"{type(worker_error).__name__}: {worker_error}")
+                    continue
+
+                for file in chunk:
+                    report(file, progress.pop(file)[1])
+
+        states = progress.copy()
+        progress.clear()
+
+        in_progress, not_started = [], []
+        for file in (file for chunk in broken_chunks for file in chunk):
+            if file not in states:
+                not_started.append(file)
+            elif states[file][0]:
+                report(file, states[file][1])
+            else:
+                in_progress.append(file)
+
+        return in_progress, not_started
+
+    with multiprocessing.Manager() as manager:
+        # file -> (finished, error message or None), set by the worker processes as they go
+        progress = manager.dict()
+
+        remaining = list(filepaths)
+        while remaining:
+            in_progress, not_started = run_pool(remaining, workers, chunksize)
+            if not in_progress and not not_started:
+                break
+
+            print(f"A worker process died with {len(in_progress)} image(s) in progress - retrying them one at a time, "
+                  f"then the {len(not_started)} image(s) not yet started")
+
+            for file in in_progress:
+                # On its own, so if the pool breaks again this image broke it
+                if any(run_pool([file], 1, 1)):
+                    report(file, "worker process died while preprocessing the image")
+
+            if not in_progress:
+                # The pool broke before any image was started, so another pool would break the same way
+                for file in not_started:
+                    report(file, "worker process died before preprocessing the image")
+                break
+
+            remaining = not_started
+
+    return failed_filepaths
+
+
+def _process_sauvola_chunk(files, progress, journal=None, **sauvola_settings):
+    """
+    Processes a chunk of images with the Sauvola pipeline (see _process_sauvola_image) in a worker process, recording
+    in progress when each image is started and when it is finished. Defined at module level so it can be sent to
+    worker processes.
+    :param files: [list] Filepaths of the images.
+    :param progress: [multiprocessing.managers.DictProxy] Maps each image's filepath to (finished, error message or
+    None).
+    :param journal: [run_journal.RunJournal] If given, the journal holding the chunk's images' stages.
+    :param sauvola_settings: Keyword arguments passed on to _process_sauvola_image.
+    """
+    for file in files:
+        progress[file] = (False, None)
+        _, sauvola_processing_error = _process_sauvola_image(file, journal=journal, **sauvola_settings)
+        progress[file] = (True, sauvola_processing_error)
+
+def _process_sauvola_image(file, sauvola_k_val, sauvola_window_size, contrast_enhance, journal=None,
+                           sauvola_engine="skimage", denoise_tile_size=None, output_format="jpeg",
+                           denoise_threads=None):
+    """
+    Processes a single image with the Sauvola pipeline. Defined at module level so it can be sent to worker processes.
+    Errors are caught here so that a failure only affects the image it occurred on.
+    :return: [tuple] (image filepath, error message or None)
+    """
+    try:
+        if journal is not None and journal.is_done(file, run_journal.DESKEWED):
+            # An earlier run already wrote the binarised and deskewed image - only compression remains. Images written
+            # in a bilevel format (which replaces the .jpg) are always under the size limit.
+            if os.path.exists(file) and os.path.getsize(file) > dd_preprocess.max_image_bytes:
+                dd_preprocess.compress_under_size(dd_preprocess.max_image_bytes, file)
+            journal.record(file, run_journal.COMPRESSED)
+            return file, None
+
+        # Pre-process images to prepare them for OCR/HTR (we use destination_folder as the source
+        # folder as images in destination folder have already been partially prepared by
+        # meet_upload_reqs).
+        dd_preprocess.preprocess_image(src_image_path = file,
+                         dest_image_path = file,
+                         contrast_enhance = contrast_enhance,
+                         k_val = sauvola_k_val,
+                         window_size = sauvola_window_size,
+                         journal = journal,
+                         sauvola_engine = sauvola_engine,
+                         denoise_tile_size = denoise_tile_size,
+                         output_format = output_format,
+                         denoise_threads = denoise_threads)
+    except Exception as sauvola_processing_error:
+        return file, str(sauvola_processing_error)
+
+    return file, None
+
+
+def process_before_sbb(filepaths, contrast_enhance=None, sbb_client=None, journal=None, denoise_tile_size=None,
+                       handoff_dir=None, denoise_threads=None):
     """
     Function for completing preprocessing of good quality images BEFORE SBB binarisation (machine learning).
     Includes: Greyscale, denoise - non-local means [(2.5) contrast enhance)]
@@ -95,6 +358,19 @@ def process_before_sbb(filepaths, contrast_enhance=None):
     :param contrast_enhance: [bool]
         True if user wishes to contrast stretch and enhance contrast of images within pipeline. Default is False,
         determined through argparse.
+    :param sbb_client: [sbb_worker.SbbWorkerClient]
+        If given, each image is submitted to a running SBB binarisation worker as soon as it has been written, rather
+        than waiting for custom_preprocess_b.py to be run on the whole batch.
+    :param journal: [run_journal.RunJournal]
+        If given, images already denoised by an earlier run are not denoised again, and denoised images are recorded.
+    :param denoise_tile_size: [int]
+        If given, images are denoised in overlapping tiles of this size on a thread pool (see
+        dd_preprocess.denoise_tiled), rather than in a single call.
+    :param handoff_dir: [string]
+        If given, denoised images are handed to SBB binarisation as arrays saved in this folder (see page_handoff.py),
+        rather than written over the image as JPEG.
+    :param denoise_threads: [int]
+        Number of threads denoising each image, tiled or not (see cpu_budget.split_cpus).
     """
     file_count = len(filepaths)
 
@@ -110,35 +386,25 @@ def process_before_sbb(filepaths, contrast_enhance=None):
             for file in filepaths:
                 try:
                     # Check if the file is an image (any file with an image extension)
-                    if any(file.lower().endswith(image_ext) for image_ext in TRANSKRIBUS_IMAGE_EXTENSIONS):
+                    if discovery.has_extension(file, discovery.TRANSKRIBUS_IMAGE_EXTENSIONS):
                         pbar.set_description(f"Preparing image: {os.path.basename(file)}")
 
-                        # Read the image
-                        image = cv2.imread(file)
-                        if image is None:
-                            print(f"Error: Image not found or cannot be read: {os.path.basename(file)}")
-                            pass
-
-                        # Pre-process images to prepare them for OCR/HTR (we use destination_folder as the source
-                        # folder as images in destination folder have already been partially prepared by
-                        # meet_upload_reqs).
+                        if is_prepared_for_sbb(file, journal):
+                            # Already prepared by an earlier run - only needs binarising (if not already done)
+                            if sbb_client is not None and not journal.is_done(file, run_journal.COMPRESSED):
+                                sbb_client.submit(file, journal_path=journal.journal_path, handoff_dir=handoff_dir)
+                            pbar.update(1)
+                            continue
 
-                        # Greyscale the image
-                        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+                        file, sbb_processing_error = _process_before_sbb_image(file, contrast_enhance, journal,
+                                                                               denoise_tile_size, handoff_dir,
+                                                                               denoise_threads)
+                        if sbb_processing_error is not None:
+                            print(f"Error preprocessing image {file}: {sbb_processing_error}")
 
-                        # Denoise image: Fast non-local means denoising (method for greyscale images):
-                        image = cv2.fastNlMeansDenoising(image, None, h=10,
-                                                         templateWindowSize=7,
-                                                         searchWindowSize=21)
-
-                        # Enhance contrast (optional): Normalisation (contrast stretching) +
-                        # adaptive histogram equalization (CLAHE)
-                        if contrast_enhance:
-                            clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-                            image = clahe.apply(cv2.normalize(image, None, 0, 255, cv2.NORM_MINMAX))
-
-                        # Write image to path
-                        cv2.imwrite(file, image)
+                        elif sbb_client is not None:
+                            sbb_client.submit(file, journal_path=journal.journal_path if journal is not None else None,
+                                              handoff_dir=handoff_dir)
 
                         # Update tqdm progress bar
                         pbar.update(1)
@@ -151,3 +417,69 @@ def process_before_sbb(filepaths, contrast_enhance=None):
         pass
     else:
         print("Good quality images ready to be binarised with SBB pipeline")
+
+
+def is_prepared_for_sbb(file, journal):
+    """
+    :param file: [string] Filepath of a good quality image.
+    :param journal: [run_journal.RunJournal] Run journal, or None.
+    :return: [bool] True if an earlier run prepared the image for SBB binarisation and the prepared image is still
+    available. Pages handed off in shared memory do not survive a reboot, so these are prepared again.
+    """
+    if journal is None or not journal.is_done(file, run_journal.DENOISED):
+        return False
+
+    # The handoff folder is recorded when the image was handed off rather than written over the image
+    handoff_dir = journal.value(file, run_journal.DENOISED)
+
+    return handoff_dir is None or page_handoff.has_page(file, handoff_dir)
+
+
+def _process_before_sbb_image(file, contrast_enhance, journal=None, denoise_tile_size=None, handoff_dir=None,
+                              denoise_threads=None):
+    """
+    Prepares a single image for SBB binarisation: greyscale, denoise and (optionally) contrast enhance, overwriting the
+    image (or handing it off in handoff_dir, see page_handoff.py). Defined at module level so it can be sent to worker
+    processes. Errors are caught here so that a failure only affects the image it occurred on.
+    :return: [tuple] (image filepath, error message or None)
+    """
+    try:
+        with stage_timer.current_image(file), stage_timer.stage("process_before_sbb"):
+            # Read the image
+            image = cv2.imread(file)
+            if image is None:
+                return file, "Image not found or cannot be read"
+
+            # Pre-process images to prepare them for OCR/HTR (we use destination_folder as the source
+            # folder as images in destination folder have already been partially prepared by
+            # meet_upload_reqs).
+
+            # Greyscale the image
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+            # Denoise image: Fast non-local means denoising (method for greyscale images), then
+            # (optionally) contrast stretching + adaptive histogram equalization (CLAHE)
+            image = dd_preprocess.denoise_image(image, contrast_enhance, tile_size=denoise_tile_size,
+                                                threads=denoise_threads)
+
+            handed_off = False
+            if handoff_dir is not None:
+                # Hand the denoised array to SBB binarisation as it is, without a lossy JPEG round trip. Falls back
+                # to writing the image when the handoff folder is short of space.
+                handed_off = page_handoff.write_page(image, file, handoff_dir) is not None
+
+            if not handed_off:
+                if handoff_dir is not None:
+                    # Don't leave a page handed off by an earlier run in place of the image written now
+                    page_handoff.remove_page(file, handoff_dir)
+
+                # Write image to path
+                cv2.imwrite(file, image)
+
+        if journal is not None:
+            journal.record(file, run_journal.DENOISED, handoff_dir if handed_off else None)
+
+    except Exception as sbb_processing_error:
+        return file, str(sbb_processing_error)
+
+    return file, None
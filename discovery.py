@@ -0,0 +1,124 @@
+"""
+Finds the images in a run with a single os.scandir walk of the source folder and holds them in an in-memory manifest,
+which every stage then works from instead of walking the folder (or the destination folder) again. On network storage
+each directory listing is a round trip, so on trees with hundreds of thousands of files repeated walks take minutes.
+
+Each manifest entry records the source image filepath, the filepath it is written to in the destination folder, its
+size in bytes and its (lower case) extension. Only uses the standard library so it can be used from both the
+custom_preprocess_a and custom_preprocess_b environments.
+"""
+import os
+import re
+from collections import namedtuple
+
+# Common image file extensions
+IMAGE_EXTENSIONS = frozenset(['.png', '.jpg', '.jpeg', '.tiff', '.tif', '.bmp', '.gif', '.webp', '.ico', '.svg'])
+
+# File types allowed by Transkribus
+TRANSKRIBUS_IMAGE_EXTENSIONS = frozenset(['.pdf', '.jpg', '.png'])
+
+# One image in a run. dest is the filepath the image is written to (src itself when images are processed in place).
+ManifestEntry = namedtuple("ManifestEntry", ["src", "dest", "size", "ext"])
+
+
+def file_extension(filepath):
+    """
+    :param filepath: [string] Filepath or filename.
+    :return: [string] Lower case extension of the file, including the dot (e.g. ".jpg").
+    """
+    return os.path.splitext(filepath)[1].lower()
+
+
+def has_extension(filepath, extensions):
+    """
+    :param filepath: [string] Filepath or filename.
+    :param extensions: [frozenset] Lower case extensions, e.g. IMAGE_EXTENSIONS.
+    :return: [bool] True if the file has one of the extensions.
+    """
+    return file_extension(filepath) in extensions
+
+
+def scan_files(folder, extensions=IMAGE_EXTENSIONS):
+    """
+    Walks folder and its sub-folders once with os.scandir, which reads the type of each entry along with its name so
+    no extra system call is needed to tell files from folders. Symlinked folders are not followed, as with os.walk.
+    :param folder: [string] Path to the folder to walk.
+    :param extensions: [frozenset] Only files with one of these lower case extensions are returned. If None, all
+    files are returned.
+    :return: [generator] (filepath, size in bytes, extension) for each file found.
+    """
+    pending_folders = [folder]
+    while pending_folders:
+        current_folder = pending_folders.pop()
+        try:
+            with os.scandir(current_folder) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending_folders.append(entry.path)
+                        continue
+
+                    extension = file_extension(entry.name)
+                    if extensions is None or extension in extensions:
+                        yield entry.path, entry.stat().st_size, extension
+
+        except OSError as scan_error:
+            print(f"Error reading folder {current_folder}: {scan_error}")
+
+
+def compile_filename_pattern(filename_pattern):
+    """
+    Compiles a filename regex pattern once, so it isn't looked up for every file it is matched against.
+    :param filename_pattern: [string] Regex pattern, or None/empty.
+    :return: [re.Pattern] Compiled pattern, or None if no pattern was given.
+    """
+    return re.compile(filename_pattern) if filename_pattern else None
+
+
+def build_manifest(source_folder, destination_folder=None, dest_extension=".jpg", extensions=IMAGE_EXTENSIONS):
+    """
+    Builds the manifest of images in source_folder with a single walk.
+    :param source_folder: [string] Path to the folder containing the images (including sub-folders).
+    :param destination_folder: [string] Folder the images are written to, replicating the source directory structure.
+    If None, images are processed in place and each entry's dest is its src.
+    :param dest_extension: [string] Extension of the images written to destination_folder (images are converted to
+    JPEG by dd_preprocess.meet_upload_reqs).
+    :param extensions: [frozenset] Only files with one of these lower case extensions are included.
+    :return: [list] ManifestEntry for each image.
+    """
+    manifest = []
+    for src_image_path, size, extension in scan_files(source_folder, extensions):
+        if destination_folder is None:
+            dest_image_path = src_image_path
+        else:
+            # relpath is used to replicate source directory structure
+            dest_image_path = os.path.join(destination_folder, os.path.relpath(src_image_path, source_folder))
+            dest_image_path = os.path.splitext(dest_image_path)[0] + dest_extension
+
+        manifest.append(ManifestEntry(src_image_path, dest_image_path, size, extension))
+
+    return manifest
+
+
+def filter_manifest(manifest, filename_pattern=None, extensions=None):
+    """
+    :param manifest: [list] ManifestEntry for each image, from build_manifest.
+    :param filename_pattern: [string or re.Pattern] If given, only entries whose destination filename matches it.
+    :param extensions: [frozenset] If given, only entries whose destination has one of these lower case extensions.
+    :return: [list] Matching entries.
+    """
+    if not isinstance(filename_pattern, re.Pattern):
+        filename_pattern = compile_filename_pattern(filename_pattern)
+
+    return [entry for entry in manifest
+            if (filename_pattern is None or filename_pattern.search(os.path.basename(entry.dest)))
+            and (extensions is None or file_extension(entry.dest) in extensions)]
+
+
+def make_destination_folders(manifest):
+    """
+    Creates each destination folder in the manifest once, rather than once per image.
+    :param manifest: [list] ManifestEntry for each image, from build_manifest.
+    """
+    for folder in {os.path.dirname(entry.dest) for entry in manifest}:
+        # exist_ok ensures function doesn't raise error if directory already exists
+        os.makedirs(folder, exist_ok=True)
@@ -0,0 +1,122 @@
+"""
+Hands pages prepared for SBB binarisation from custom_preprocess_a.py to custom_preprocess_b.py (or the SBB
+binarisation worker) as uncompressed .npy arrays, rather than as JPEGs written to the destination folder.
+
+Without a handoff, each good quality page is greyscaled and denoised, encoded as JPEG and written over the prepared
+image, then decoded again by SBB binarisation in the other environment - a lossy round trip. With a handoff, the
+denoised greyscale array is saved as a .npy file in a shared memory folder (/dev/shm, where available) and memory
+mapped by the binarisation step, so the page crosses between the environments unchanged. Only a small JSON manifest,
+sbb_handoff.json, is passed alongside sbb_filepath_list.pkl to tell custom_preprocess_b.py where the pages are.
+
+Pages are named by a hash of the absolute filepath of the image they belong to, so either environment can find a page
+from the image filepath alone. A page is removed once it has been binarised. /dev/shm is backed by memory, so pages
+are only handed off while the folder has room to spare - otherwise the page is written as a JPEG as before.
+
+Only uses the standard library and numpy, so it can be used from both the custom_preprocess_a and custom_preprocess_b
+environments.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+HANDOFF_MANIFEST_FILENAME = "sbb_handoff.json"
+
+# Shared memory where available, so handing off a page never touches the disk
+DEFAULT_HANDOFF_DIR = os.path.join("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(),
+                                   "dd_custom_preprocess_handoff")
+
+# Space always left free in the handoff folder (/dev/shm shares memory with the rest of the system)
+MIN_FREE_BYTES = 2 * 1024 ** 3
+
+
+def page_path(image_path, handoff_dir=DEFAULT_HANDOFF_DIR):
+    """
+    :param image_path: [string] Filepath of the image the page belongs to.
+    :param handoff_dir: [string] Folder pages are handed off in.
+    :return: [string] Filepath of the image's .npy page in handoff_dir.
+    """
+    name = hashlib.blake2b(os.path.abspath(image_path).encode(), digest_size=16).hexdigest()
+    return os.path.join(handoff_dir, name + ".npy")
+
+
+def write_page(image, image_path, handoff_dir=DEFAULT_HANDOFF_DIR, min_free_bytes=MIN_FREE_BYTES):
+    """
+    Saves a prepared page to the handoff folder.
+    :param image: [np.ndarray] Denoised greyscale page.
+    :param image_path: [string] Filepath of the image the page belongs to.
+    :param handoff_dir: [string] Folder to hand the page off in.
+    :param min_free_bytes: [int] The page is not saved if it would leave less than this much free space.
+    :return: [string] Filepath of the saved page, or None if there was not enough space to save it.
+    """
+    os.makedirs(handoff_dir, exist_ok=True)
+    if shutil.disk_usage(handoff_dir).free - image.nbytes < min_free_bytes:
+        return None
+
+    output_page_path = page_path(image_path, handoff_dir)
+
+    # Written under a temporary name first, so a page is never read half-written
+    temp_page_path = output_page_path + ".tmp"
+    with open(temp_page_path, "wb") as page_file:
+        np.save(page_file, image)
+    os.replace(temp_page_path, output_page_path)
+
+    return output_page_path
+
+
+def read_page(image_path, handoff_dir=DEFAULT_HANDOFF_DIR):
+    """
+    :param image_path: [string] Filepath of the image the page belongs to.
+    :param handoff_dir: [string] Folder pages are handed off in.
+    :return: [np.ndarray] Read-only memory map of the page, or None if no page was handed off for the image.
+    """
+    try:
+        return np.load(page_path(image_path, handoff_dir), mmap_mode="r")
+    except FileNotFoundError:
+        return None
+
+
+def has_page(image_path, handoff_dir=DEFAULT_HANDOFF_DIR):
+    """
+    :return: [bool] True if a page has been handed off for the image.
+    """
+    return os.path.exists(page_path(image_path, handoff_dir))
+
+
+def remove_page(image_path, handoff_dir=DEFAULT_HANDOFF_DIR):
+    """
+    Removes the page handed off for an image, if there is one.
+    """
+    try:
+        os.remove(page_path(image_path, handoff_dir))
+    except FileNotFoundError:
+        pass
+
+
+def write_manifest(manifest_path, handoff_dir, image_paths):
+    """
+    Writes the handoff manifest read by custom_preprocess_b.py.
+    :param manifest_path: [string] Path of the JSON manifest.
+    :param handoff_dir: [string] Folder the pages were handed off in.
+    :param image_paths: [list] Filepaths of the good quality images. Only those with a handed off page are listed.
+    """
+    pages = {image_path: page_path(image_path, handoff_dir) for image_path in image_paths
+             if has_page(image_path, handoff_dir)}
+
+    with open(manifest_path, "w") as manifest_file:
+        json.dump({"handoff_dir": handoff_dir, "pages": pages}, manifest_file, indent=1)
+
+
+def read_manifest(manifest_path):
+    """
+    :param manifest_path: [string] Path of the JSON manifest written by write_manifest.
+    :return: [dict] {"handoff_dir": folder, "pages": {image filepath: page filepath}}, or None if there is no manifest.
+    """
+    try:
+        with open(manifest_path) as manifest_file:
+            return json.load(manifest_file)
+    except FileNotFoundError:
+        return None
@@ -0,0 +1,324 @@
+"""
+Pipelined mode for custom_preprocess_a.py (--pipelined). Instead of preparing every image, then scoring every image,
+then preprocessing every image, each image moves on to the next stage as soon as it is ready:
+
+    prepare (meet_upload_reqs, process pool)
+        -> score (quality scoring thread)
+            -> route: Sauvola pipeline or preparation for SBB binarisation (process pool)
+                -> SBB binarisation worker (if --sbb_socket is given)
+
+so that resizing, quality scoring and binarisation run at the same time, and the first pages are finished within
+seconds of the run starting. The stages are joined by bounded queues and each stage keeps a bounded number of images in
+flight, so a slow stage holds back the stages before it rather than letting prepared images pile up in memory.
+
+Scores, routes and completed stages are saved to the same score store and run journal as the sequential mode, so a
+pipelined run can be resumed with --resume.
+"""
+import os
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from tqdm import tqdm
+
+import dd_preprocess
+import dd_preprocessor
+import discovery
+import quality_scorer
+import run_journal
+import score_store
+import stage_timer
+
+# Marks the end of the images passed between stages
+_DONE = None
+
+# Number of images each worker process is given ahead of time, and the size of the queues between stages (per worker)
+IMAGES_IN_FLIGHT_PER_WORKER = 2
+
+
+def run_pipelined(manifest, journal, score_store_path, metric, goodbad_threshold, sauvola_k_val, sauvola_window_size,
+                  contrast_enhance, workers=1, filename_pattern=None, sbb_client=None, sauvola_engine="skimage",
+                  denoise_tile_size=None, score_cache_path=None, score_cache_size=score_store.DEFAULT_SCORE_CACHE_SIZE,
+                  output_format="jpeg", handoff_dir=None, score_short_side=None, preclassify_confidence=None,
+                  denoise_threads=None):
+    """
+    Prepares, scores and preprocesses every image in the manifest, with each image moving on to the next stage as soon
+    as it is ready.
+    :param manifest: [list] discovery.ManifestEntry for each image in the run. Destination folders must already exist.
+    :param journal: [run_journal.RunJournal] Run journal. Stages completed in an earlier, interrupted run are skipped.
+    :param score_store_path: [string] Path to the SQLite score store to save scores to.
+    :param metric: [string] Name of the pyiqa metric used to score images.
+    :param goodbad_threshold: [float] Threshold used as score boundary between 'good' and 'bad' quality.
+    :param sauvola_k_val: [float] K-value when Sauvola binarisation is used.
+    :param sauvola_window_size: [int] Window size when Sauvola binarisation is used.
+    :param contrast_enhance: [bool] True to contrast stretch and enhance contrast of images within pipeline.
+    :param workers: [int] Number of worker processes preparing and preprocessing images.
+    :param filename_pattern: [string] If given, only images whose filename matches this regex pattern are scored and
+    preprocessed. Remaining images only meet basic Transkribus upload requirements.
+    :param sbb_client: [sbb_worker.SbbWorkerClient] If given, good quality images are submitted to a running SBB
+    binarisation worker as soon as they are prepared for it.
+    :param sauvola_engine: [string] Implementation of Sauvola binarisation to use, "skimage" or "opencv".
+    :param denoise_tile_size: [int] If given, images are denoised in overlapping tiles of this size on a thread pool.
+    :param score_cache_path: [string] Path to a persistent score cache (see score_store.ScoreCache).
+    :param score_cache_size: [int] Maximum number of scores kept in the score cache.
+    :param output_format: [string] Format to write Sauvola binarised images in, one of dd_preprocess.OUTPUT_FORMATS.
+    :param handoff_dir: [string] If given, good quality images are handed to SBB binarisation as arrays saved in this
+    folder (see page_handoff.py), rather than written as JPEG.
+    :param score_short_side: [int] If given, each image is scored from a reduced copy with this shorter side, decoded
+    from its source image (see quality_scorer.load_reduced_image), rather than from the full-size prepared image.
+    :param preclassify_confidence: [float] If given, images the statistical pre-classifier (see preclassifier.py) is at
+    least this confident about are routed without being scored by the metric.
+    :param denoise_threads: [int] Number of threads denoising each image in each worker process, tiled or not (see
+    cpu_budget.split_cpus).
+    :return: [tuple] (dict mapping image filepaths to their treatment ('sbb' or 'sauvola'), list of good quality image
+    filepaths to pass to the SBB binarisation pipeline)
+    """
+    in_flight = max(2, IMAGES_IN_FLIGHT_PER_WORKER * workers)
+    score_queue = queue.Queue(maxsize=in_flight)  # manifest entries of prepared images waiting to be scored
+    route_queue = queue.Queue(maxsize=in_flight)  # (image, treatment) waiting to be preprocessed
+    scoring_errors = []
+
+    filename_pattern = discovery.compile_filename_pattern(filename_pattern)
+
+    treatment_dict = {}
+    sbb_filepaths = []
+
+    with tqdm(total=len(manifest), desc="Preprocessing images (pipelined)", unit="image") as pbar, \
+            ProcessPoolExecutor(max_workers=workers) as executor:
+
+        preparing = threading.Thread(target=_prepare_images,
+                                     args=(executor, manifest, journal, in_flight, score_queue, filename_pattern,
+                                           pbar),
+                                     daemon=True)
+        scoring = threading.Thread(target=_score_images,
+                                   args=(score_queue, route_queue, score_store_path, metric, goodbad_threshold,
+                                         journal, score_cache_path, score_cache_size, score_short_side,
+                                         preclassify_confidence, scoring_errors),
+                                   daemon=True)
+        preparing.start()
+        scoring.start()
+
+        # Route each scored image to its pipeline on this thread
+        pending = {}  # future -> (image filepath, treatment)
+        scoring_finished = False
+        while not scoring_finished or pending:
+            if pending:
+                # Collect finished images, waiting for one if as many images as allowed are in flight
+                done, _ = wait(pending, timeout=None if scoring_finished or len(pending) >= in_flight else 0,
+                               return_when=FIRST_COMPLETED)
+                for future in done:
+                    file, treatment = pending.pop(future)
+                    _finish_image(future, file, treatment, journal, sbb_client, handoff_dir, pbar)
+
+            if scoring_finished or len(pending) >= in_flight:
+                continue
+
+            try:
+                routed = route_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+            if routed is _DONE:
+                scoring_finished = True
+                continue
+
+            file, treatment = routed
+            treatment_dict[file] = treatment
+            future = _start_preprocessing(executor, file, treatment, journal, sbb_client, sbb_filepaths,
+                                          sauvola_k_val, sauvola_window_size, contrast_enhance, sauvola_engine,
+                                          denoise_tile_size, output_format, handoff_dir, denoise_threads)
+            if future is None:
+                pbar.update(1)
+            else:
+                pending[future] = (file, treatment)
+
+        preparing.join()
+        scoring.join()
+
+    if scoring_errors:
+        raise scoring_errors[0]
+
+    return treatment_dict, sbb_filepaths
+
+
+def _prepare_images(executor, manifest, journal, in_flight, score_queue, filename_pattern, pbar):
+    """
+    Runs on its own thread. Prepares images to meet Transkribus upload requirements on the process pool, with at most
+    in_flight images submitted at a time, and queues each image for scoring as soon as it is prepared.
+    """
+    pending = {}  # future -> manifest entry
+    entries = iter(manifest)
+    all_submitted = False
+
+    def queue_for_scoring(entry):
+        if filename_pattern is not None and not filename_pattern.search(os.path.basename(entry.dest)):
+            # Only meets basic Transkribus upload requirements
+            pbar.update(1)
+        else:
+            # Blocks while the scoring queue is full
+            score_queue.put(entry)
+
+    try:
+        while pending or not all_submitted:
+            while not all_submitted and len(pending) < in_flight:
+                entry = next(entries, None)
+                if entry is None:
+                    all_submitted = True
+                elif journal.is_done(entry.dest, run_journal.PREPARED):
+                    # Prepared by an earlier run (when resuming)
+                    queue_for_scoring(entry)
+                else:
+                    future = executor.submit(stage_timer.call_with_timings, stage_timer.is_enabled(),
+                                             dd_preprocess.meet_upload_reqs, entry.src, entry.dest, False)
+                    pending[future] = entry
+
+            if not pending:
+                continue
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                entry = pending.pop(future)
+                try:
+                    prepared, timings = future.result()
+                    stage_timer.merge(timings)
+                except Exception as meet_upload_reqs_error:
+                    print(f"error preparing image: {os.path.basename(entry.src)}", meet_upload_reqs_error)
+                    prepared = False
+
+                if prepared:
+                    journal.record(entry.dest, run_journal.PREPARED)
+                    queue_for_scoring(entry)
+                else:
+                    pbar.update(1)
+
+    finally:
+        score_queue.put(_DONE)
+
+
+def _score_images(score_queue, route_queue, score_store_path, metric, goodbad_threshold, journal, score_cache_path,
+                  score_cache_size, score_short_side, preclassify_confidence, scoring_errors):
+    """
+    Runs on its own thread. Scores each prepared image as it arrives, saves its score and queues it for the Sauvola or
+    SBB pipeline according to its quality. If scoring cannot continue (e.g. the metric fails to load), the error is
+    added to scoring_errors and the remaining images are drained so the other stages can finish.
+    """
+    scores, score_cache = None, None
+    try:
+        # SQLite connections can only be used on the thread which opened them
+        scores = score_store.ScoreStore(score_store_path)
+        if score_cache_path:
+            score_cache = score_store.ScoreCache(score_cache_path, score_cache_size,
+                                                 pyiqa_version=quality_scorer.pyiqa.__version__)
+
+        iqa_metric = quality_scorer.get_metric(metric)
+        cache_metric = quality_scorer.cache_metric_name(metric, short_side=score_short_side)
+
+        while True:
+            entry = score_queue.get()
+            if entry is _DONE:
+                break
+
+            file_path = entry.dest
+            # Downscaled scoring decodes the source image rather than the prepared image
+            scored_path = entry.src if score_short_side else entry.dest
+
+            quality = None
+            if journal.is_done(file_path, run_journal.SCORED) and file_path in scores:
+                # Scored (or pre-classified) by an earlier run (when resuming)
+                quality = scores.get_preclass(file_path)
+                score_nr = scores.get_score(file_path)
+            else:
+                image_hash, score_nr = None, None
+                if score_cache is not None:
+                    try:
+                        image_hash = score_store.image_hash(scored_path)
+                        score_nr = score_cache.get_many([image_hash], cache_metric).get(image_hash)
+                    except OSError:
+                        pass
+
+                if score_nr is not None:
+                    # Unchanged since it was scored in an earlier run
+                    scores.save(file_path, score_nr, metric, image_hash)
+                else:
+                    if preclassify_confidence:
+                        quality = quality_scorer.preclassify_file(file_path, scores, preclassify_confidence)
+                    if quality is None:
+                        score_nr = quality_scorer.score_file(file_path, iqa_metric, scores, metric, score_cache,
+                                                             image_hash, entry.src, score_short_side)
+                journal.record(file_path, run_journal.SCORED)
+
+            if quality is None:
+                quality = quality_scorer.quality_class(score_nr, goodbad_threshold, iqa_metric.lower_better)
+            treatment = quality_scorer.TREATMENTS[quality]
+            if journal.value(file_path, run_journal.ROUTED) != treatment:
+                journal.record(file_path, run_journal.ROUTED, treatment)
+
+            # Blocks while the routing queue is full
+            route_queue.put((file_path, treatment))
+
+    except Exception as scoring_error:
+        print(f"Error: Quality scoring stopped: {scoring_error}")
+        scoring_errors.append(scoring_error)
+        # Keep taking prepared images so the preparation thread is not blocked on a full queue
+        while score_queue.get() is not _DONE:
+            pass
+
+    finally:
+        if scores is not None:
+            scores.close()
+        if score_cache is not None:
+            score_cache.close()
+        route_queue.put(_DONE)
+
+
+def _start_preprocessing(executor, file, treatment, journal, sbb_client, sbb_filepaths, sauvola_k_val,
+                         sauvola_window_size, contrast_enhance, sauvola_engine, denoise_tile_size, output_format,
+                         handoff_dir, denoise_threads=None):
+    """
+    Submits a scored image to the process pool for its pipeline.
+    :return: [Future] The submitted job, or None if the image needs no further preprocessing in this run.
+    """
+    if treatment == "sbb":
+        sbb_filepaths.append(file)
+
+    if not discovery.has_extension(file, discovery.TRANSKRIBUS_IMAGE_EXTENSIONS) or \
+            journal.is_done(file, run_journal.COMPRESSED):
+        return None
+
+    # Only this image's stages are sent to the worker process
+    image_journal = journal.subset([file])
+
+    if treatment == "sauvola":
+        return executor.submit(stage_timer.call_with_timings, stage_timer.is_enabled(),
+                               dd_preprocessor._process_sauvola_image, file, sauvola_k_val, sauvola_window_size,
+                               contrast_enhance, image_journal, sauvola_engine, denoise_tile_size, output_format,
+                               denoise_threads)
+
+    if dd_preprocessor.is_prepared_for_sbb(file, journal):
+        # Already prepared for SBB binarisation by an earlier run - only needs binarising
+        if sbb_client is not None:
+            sbb_client.submit(file, journal_path=journal.journal_path, handoff_dir=handoff_dir)
+        return None
+
+    return executor.submit(stage_timer.call_with_timings, stage_timer.is_enabled(),
+                           dd_preprocessor._process_before_sbb_image, file, contrast_enhance, image_journal,
+                           denoise_tile_size, handoff_dir, denoise_threads)
+
+
+def _finish_image(future, file, treatment, journal, sbb_client, handoff_dir, pbar):
+    """
+    Collects the result of a Sauvola or SBB preparation job, and submits images prepared for SBB binarisation to the
+    SBB binarisation worker.
+    """
+    try:
+        (file, processing_error), timings = future.result()
+        stage_timer.merge(timings)
+    except Exception as worker_error:
+        processing_error = str(worker_error)
+
+    if processing_error is not None:
+        print(f"Error preprocessing image {os.path.basename(file)}: {processing_error}")
+
+    elif treatment == "sbb" and sbb_client is not None:
+        sbb_client.submit(file, journal_path=journal.journal_path, handoff_dir=handoff_dir)
+
+    pbar.update(1)
@@ -0,0 +1,142 @@
+"""
+Cheap statistical pre-classifier which routes clear-cut pages straight to the 'good' or 'bad' quality pipeline, so
+that only ambiguous pages are scored with the neural quality metric (maniqa-koniq).
+
+Features are computed with numpy on a small greyscale thumbnail of the prepared image (a JPEG, which is reduced while
+it is decoded):
+
+- brightness: 1st, 5th, 50th, 95th and 99th percentiles of the histogram
+- contrast: spread between the 5th and 95th percentiles, and RMS contrast (standard deviation)
+- noise: Immerkaer's fast noise estimate (standard deviation of the noise)
+- sharpness: variance of the Laplacian
+
+A page is clearly bad when it is dark with crushed contrast (e.g. underexposed microfiche), and clearly good when it
+has a bright background, wide contrast, little noise and sharp edges (e.g. a clean scan). Each rule gives a soft score
+between 0 and 1 according to how far a feature is past its threshold, and the page's confidence combines them. Pages
+whose confidence is below the level asked for are left for the neural metric.
+
+The thresholds below were chosen by hand for 8-bit newspaper scans. Check them against full-size scoring on a sample
+of a new collection with score_calibration.py before relying on them.
+
+Only uses numpy and Pillow.
+"""
+import math
+from collections import namedtuple
+
+import numpy as np
+from PIL import Image
+
+# Name saved as the metric of pages routed by the pre-classifier in the score store
+PRECLASSIFIER_NAME = "preclassifier"
+
+# Shorter side of the thumbnail features are computed on, in pixels
+THUMBNAIL_SHORT_SIDE = 512
+
+DEFAULT_CONFIDENCE = 0.95
+
+# Clearly bad: dark page, or crushed contrast. (threshold, softness) - the rule's score is 0.5 at the threshold and
+# about 0.95 three softness values past it.
+DARK_MEDIAN = (80, 8)  # median brightness below this
+CRUSHED_CONTRAST = (70, 8)  # 5th-95th percentile spread below this
+
+# Clearly good: all of bright background, wide contrast, little noise and sharp edges
+BRIGHT_BACKGROUND = (190, 8)  # 95th percentile brightness above this
+WIDE_CONTRAST = (130, 10)  # 5th-95th percentile spread above this
+LOW_NOISE = (8, 1.5)  # noise standard deviation below this
+SHARP_EDGES = (2.5, 0.2)  # log10 of the variance of the Laplacian above this
+
+# Features of a page, see page_features
+PageFeatures = namedtuple("PageFeatures", ["p1", "p5", "p50", "p95", "p99", "contrast_spread", "rms_contrast",
+                                           "noise_sigma", "laplacian_variance"])
+
+
+def load_thumbnail(image_path, short_side=THUMBNAIL_SHORT_SIDE):
+    """
+    Decodes a greyscale thumbnail of an image, with its shorter side short_side pixels (smaller images are not
+    enlarged). JPEGs are reduced while they are decoded, so the full-size image is never decoded.
+    :param image_path: [string] Filepath of the image.
+    :param short_side: [int] Shorter side of the thumbnail, in pixels.
+    :return: [np.ndarray] uint8 greyscale thumbnail.
+    """
+    with Image.open(image_path) as img:
+        scale = short_side / min(img.size)
+        if scale >= 1:
+            return np.asarray(img.convert("L"))
+
+        size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+        img.draft("L", size)
+        thumbnail = img.convert("L")
+
+    if thumbnail.size != size:
+        thumbnail = thumbnail.resize(size, resample=Image.BOX)
+
+    return np.asarray(thumbnail)
+
+
+def page_features(thumbnail):
+    """
+    :param thumbnail: [np.ndarray] uint8 greyscale thumbnail, see load_thumbnail.
+    :return: [PageFeatures] Histogram, contrast, noise and sharpness features of the page.
+    """
+    p1, p5, p50, p95, p99 = np.percentile(thumbnail, [1, 5, 50, 95, 99])
+    image = thumbnail.astype(np.float32)
+    height, width = image.shape
+
+    if height < 3 or width < 3:
+        noise_sigma, laplacian_variance = 0.0, 0.0
+    else:
+        # Immerkaer (1996): the mask cancels out image structure up to second order, leaving mostly noise
+        # [[1, -2, 1], [-2, 4, -2], [1, -2, 1]]
+        noise_response = (image[:-2, :-2] - 2 * image[:-2, 1:-1] + image[:-2, 2:]
+                          - 2 * image[1:-1, :-2] + 4 * image[1:-1, 1:-1] - 2 * image[1:-1, 2:]
+                          + image[2:, :-2] - 2 * image[2:, 1:-1] + image[2:, 2:])
+        noise_sigma = math.sqrt(math.pi / 2) * np.abs(noise_response).sum() / (6 * (width - 2) * (height - 2))
+
+        # 4-neighbour Laplacian
+        laplacian = image[:-2, 1:-1] + image[2:, 1:-1] + image[1:-1, :-2] + image[1:-1, 2:] - 4 * image[1:-1, 1:-1]
+        laplacian_variance = float(laplacian.var())
+
+    return PageFeatures(p1=float(p1), p5=float(p5), p50=float(p50), p95=float(p95), p99=float(p99),
+                        contrast_spread=float(p95 - p5), rms_contrast=float(image.std()),
+                        noise_sigma=float(noise_sigma), laplacian_variance=laplacian_variance)
+
+
+def _above(value, rule):
+    """
+    :return: [float] Soft score between 0 and 1 of value being above the rule's threshold.
+    """
+    threshold, softness = rule
+    return 1 / (1 + math.exp(-(value - threshold) / softness))
+
+
+def classify_features(features):
+    """
+    Classifies a page from its features.
+    :param features: [PageFeatures] Features of the page, see page_features.
+    :return: [tuple] ('good' or 'bad', confidence between 0 and 1)
+    """
+    bad = max(1 - _above(features.p50, DARK_MEDIAN),
+              1 - _above(features.contrast_spread, CRUSHED_CONTRAST))
+
+    good = min(_above(features.p95, BRIGHT_BACKGROUND),
+               _above(features.contrast_spread, WIDE_CONTRAST),
+               1 - _above(features.noise_sigma, LOW_NOISE),
+               _above(math.log10(features.laplacian_variance + 1), SHARP_EDGES))
+
+    # Confident only when the evidence for one class is strong and the evidence for the other is weak
+    if good >= bad:
+        return "good", good * (1 - bad)
+
+    return "bad", bad * (1 - good)
+
+
+def preclassify(image_path, min_confidence=DEFAULT_CONFIDENCE):
+    """
+    Pre-classifies a page from a thumbnail of the image.
+    :param image_path: [string] Filepath of the image.
+    :param min_confidence: [float] Confidence a page needs to be routed without the neural metric.
+    :return: [tuple] ('good', 'bad' or None if the page is ambiguous, confidence between 0 and 1)
+    """
+    quality, confidence = classify_features(page_features(load_thumbnail(image_path)))
+
+    return (quality if confidence >= min_confidence else None), confidence
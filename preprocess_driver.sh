@@ -12,6 +12,20 @@ usage() {
     echo "  -ce, --contrast_enhance      Enable contrast enhancement (flag)"
     echo "  -re, --regex                 Regex pattern used to select which image files to preprocess (default: False)"
     echo "  -gb, --goodbad_threshold     Image quality score to use as threshold between 'good' and 'bad' quality determination (default: 0.335)"
+    echo "  -se, --sauvola_engine        Sauvola implementation: skimage or opencv (faster, near-identical output) (default: skimage)"
+    echo "  -dt, --denoise_tile_size     Denoise in overlapping tiles of this size on a thread pool (default: 0, single call)"
+    echo "  -of, --output_format         Format of Sauvola binarised images: jpeg or png (lossless 1 bit, no compression needed) (default: jpeg)"
+    echo "  -sss, --score_short_side     Score a reduced copy of each image with this shorter side, e.g. 768 (default: 0, full size)"
+    echo "  -pc, --preclassify_confidence  Route clear-cut pages without quality scoring at this confidence, e.g. 0.95 (default: 0, score every page)"
+    echo "  -ct, --cpu_threads           Threads used for quality scoring on CPU (default: 0, a share of the cores alongside the workers)"
+    echo "  -sc, --score_cache           Path of the persistent quality score cache (default: ~/.cache/dd_custom_preprocess/score_cache.sqlite)"
+    echo "  -scs, --score_cache_size     Maximum number of cached quality scores, 0 to disable the cache (default: 500000)"
+    echo "  -j, --workers                Number of worker processes used to prepare and Sauvola-binarise images (default: 1)"
+    echo "  -shm, --shared_memory_handoff Hand denoised good quality images to SBB binarisation in shared memory, not as JPEG (flag)"
+    echo "  -pl, --pipelined             Overlap preparation, quality scoring and preprocessing of images (flag)"
+    echo "  -rs, --resume                Resume a run which stopped midway, skipping work already completed (flag)"
+    echo "  -tr, --timing_report         Write per-stage timings to this JSON file (SBB stages go to <name>_sbb.json)"
+    echo "  -sw, --sbb_worker            Binarise good quality images with a long-lived SBB worker, started if not already running (flag)"
     echo ""
     echo "Example: $0 source_folder destination_folder -k 0.5 -w 15 --contrast_enhance"
     exit 1
@@ -22,6 +36,16 @@ usage() {
   sauv_window_size=11
   countrast_enhance=''
   goodbad_threshold=0.335
+  workers=1
+  sauvola_engine=skimage
+  denoise_tile_size=0
+  output_format=jpeg
+  score_short_side=0
+  preclassify_confidence=0
+  cpu_threads=0
+  score_cache=""
+  score_cache_size=500000
+  sbb_socket="/tmp/dd_sbb_worker.sock"
 
 # Parse arguments
 while [[ "$#" -gt 0 ]]; do
@@ -46,6 +70,62 @@ while [[ "$#" -gt 0 ]]; do
             goodbad_threshold="$2"
             shift 2
             ;;
+        -se|--sauvola_engine)
+            sauvola_engine="$2"
+            shift 2
+            ;;
+        -dt|--denoise_tile_size)
+            denoise_tile_size="$2"
+            shift 2
+            ;;
+        -of|--output_format)
+            output_format="$2"
+            shift 2
+            ;;
+        -sss|--score_short_side)
+            score_short_side="$2"
+            shift 2
+            ;;
+        -pc|--preclassify_confidence)
+            preclassify_confidence="$2"
+            shift 2
+            ;;
+        -ct|--cpu_threads)
+            cpu_threads="$2"
+            shift 2
+            ;;
+        -sc|--score_cache)
+            score_cache="$2"
+            shift 2
+            ;;
+        -scs|--score_cache_size)
+            score_cache_size="$2"
+            shift 2
+            ;;
+        -j|--workers)
+            workers="$2"
+            shift 2
+            ;;
+        -shm|--shared_memory_handoff)
+            shared_memory_handoff_flag="--shared_memory_handoff"
+            shift 1
+            ;;
+        -pl|--pipelined)
+            pipelined_flag="--pipelined"
+            shift 1
+            ;;
+        -rs|--resume)
+            resume_flag="--resume"
+            shift 1
+            ;;
+        -tr|--timing_report)
+            timing_report="$2"
+            shift 2
+            ;;
+        -sw|--sbb_worker)
+            sbb_worker_flag="--sbb_socket"
+            shift 1
+            ;;
         -h|--help)
             usage
             ;;
@@ -107,6 +187,26 @@ else
     echo "Environment 'custom_preprocess_b' already exists. Skipping creation."
 fi
 
+# Start a long-lived SBB binarisation worker (keeps the model loaded between runs) if requested and not already running
+if [[ -n "$sbb_worker_flag" ]]; then
+    source ~/.zshrc
+    conda activate custom_preprocess_b
+    if ! python sbb_worker.py --socket "$sbb_socket" --ping; then
+        echo "Starting SBB binarisation worker..."
+        nohup python sbb_worker.py --socket "$sbb_socket" > sbb_worker.log 2>&1 &
+        sbb_worker_pid=$!
+        until python sbb_worker.py --socket "$sbb_socket" --ping; do
+            if ! kill -0 "$sbb_worker_pid" 2>/dev/null; then
+                echo "Error: SBB binarisation worker failed to start, see sbb_worker.log"
+                exit 1
+            fi
+            sleep 2
+        done
+    fi
+    source ~/.zshrc
+    conda deactivate
+fi
+
 source ~/.zshrc
 conda activate custom_preprocess_a
 python custom_preprocess_a.py "$source_folder" "$destination_folder" \
@@ -114,12 +214,27 @@ python custom_preprocess_a.py "$source_folder" "$destination_folder" \
     --sauv_window_size "$sauv_window_size" \
     $contrast_enhance_flag \
     --regex "$regex" \
-    --goodbad_threshold "$goodbad_threshold"
+    --goodbad_threshold "$goodbad_threshold" \
+    --workers "$workers" \
+    --sauvola_engine "$sauvola_engine" \
+    --denoise_tile_size "$denoise_tile_size" \
+    --output_format "$output_format" \
+    --score_short_side "$score_short_side" \
+    --preclassify_confidence "$preclassify_confidence" \
+    --cpu_threads "$cpu_threads" \
+    --score_cache_size "$score_cache_size" \
+    ${score_cache:+--score_cache "$score_cache"} \
+    $shared_memory_handoff_flag \
+    $pipelined_flag \
+    $resume_flag \
+    ${timing_report:+--timing_report "$timing_report"} \
+    ${sbb_worker_flag:+--sbb_socket "$sbb_socket"}
 source ~/.zshrc
 conda deactivate
 
 source ~/.zshrc
 conda activate custom_preprocess_b
-python custom_preprocess_b.py
+python custom_preprocess_b.py --journal "$source_folder/run_journal.jsonl" \
+    ${timing_report:+--timing_report "${timing_report%.json}_sbb.json"}
 source ~/.zshrc
 conda deactivate
@@ -6,10 +6,18 @@ Uses the Pyiqa toolkit (and specifically maniqa-koniq which can be changed) to g
 import pyiqa
 import os
 from tqdm import tqdm
-import shelve
+import io
 import torch
-import custom_preprocess_a
-import re
+import numpy as np
+from PIL import Image
+import discovery
+import score_store
+import time
+import run_journal
+import stage_timer
+import preclassifier
+import cpu_budget
+from collections import OrderedDict
 
 if torch.cuda.is_available():
     DEVICE = "cuda"
@@ -21,149 +29,561 @@ else:
     DEVICE = torch.device("cpu")
     print("mps is not available, using CPU instead")
 
-def run_pyiqa_for_all_files(img_directory_path, shelve_filepath, metric="maniqa-koniq", filename_pattern=False):
+# (height, width) images are resized to when they are scored in batches. maniqa-koniq was trained on KonIQ-10k images
+# (1024x768) and takes random 224x224 crops from its input, so pages are resized to a portrait shape of the same area.
+METRIC_INPUT_SIZES = {"maniqa-koniq": (1024, 768)}
+DEFAULT_METRIC_INPUT_SIZE = (512, 512)
+
+# Shorter side, in pixels, of the reduced copy of each image scored when scoring downscaled inputs (--score_short_side).
+# Matches the shorter side of the KonIQ-10k images maniqa-koniq was trained on.
+DEFAULT_SCORE_SHORT_SIDE = 768
+
+# Preprocessing treatment for each quality class: 'good' quality images are binarised with SBB binarisation (machine
+# learning), 'bad' quality images with Sauvola binarisation (non-machine learning).
+TREATMENTS = {'good': 'sbb', 'bad': 'sauvola'}
+
+# Maximum number of IQA models kept loaded at once. When more metrics are requested, the least recently used model is
+# dropped from memory.
+MAX_LOADED_METRICS = 2
+
+# Process-wide registry of loaded IQA metrics, keyed by (metric name, device). Ordered from least to most recently used.
+_loaded_metrics = OrderedDict()
+
+# True when metric networks and inputs use the channels_last memory format (see configure_cpu_inference)
+_channels_last = False
+
+
+def get_metric(metric="maniqa-koniq", device=None):
+    """
+    Returns a pyiqa metric, loading it only the first time it is requested in this process. Building a metric loads its
+    network weights, which takes far longer than scoring a single image, so the same metric object is reused for every
+    image. At most MAX_LOADED_METRICS models are kept in memory.
+    :param metric: [string] For available metrics, see https://github.com/chaofengc/IQA-PyTorch and
+    https://iqa-pytorch.readthedocs.io/
+    :param device: [string or torch.device] Device to load the metric on. Defaults to DEVICE.
+    :return: pyiqa metric object
+    """
+    if device is None:
+        device = DEVICE
+
+    key = (metric, str(device))
+    if key in _loaded_metrics:
+        _loaded_metrics.move_to_end(key)
+        return _loaded_metrics[key]
+
+    with stage_timer.stage("iqa_model_load"):
+        iqa_metric = pyiqa.create_metric(metric_name=metric, device=device)
+        if _channels_last:
+            _set_memory_format(iqa_metric)
+    _loaded_metrics[key] = iqa_metric
+
+    # Evict least recently used metrics beyond the limit
+    while len(_loaded_metrics) > MAX_LOADED_METRICS:
+        _loaded_metrics.popitem(last=False)
+
+    return iqa_metric
+
+
+def configure_cpu_inference(threads=None, pipeline_workers=0, channels_last=True):
     """
-    Takes path to a directory containing images to score. Returns a shelf object whereby keys are individual image
-    filepaths and values are quality scores according to the selected PYIQA metric.
+    CPU execution profile for quality scoring. torch starts one thread per physical core of the machine, whatever the
+    cores available to this process and however many worker processes are preparing and preprocessing images at the
+    same time, so scoring either oversubscribes the cores or leaves them idle. This gives scoring the cores the
+    pipeline's workers leave free, a single inter-op thread (one image or batch is scored at a time) and, optionally,
+    the channels_last memory format for metric networks and inputs. Does nothing unless scoring on CPU.
+    :param threads: [int] Number of threads torch uses within each operation. Defaults to scoring's share of the cores
+    available to this process alongside pipeline_workers (see cpu_budget.split_cpus), or all of them if there are none.
+    :param pipeline_workers: [int] Number of worker processes busy at the same time as scoring.
+    :param channels_last: [bool] True to use the channels_last memory format, which suits convolutions on CPU.
+    :return: [int] Number of threads used, or None if not scoring on CPU.
+    """
+    global _channels_last
+
+    if str(DEVICE) != "cpu":
+        return None
+
+    if not threads:
+        threads, _ = cpu_budget.split_cpus(pipeline_workers, scoring_alongside=pipeline_workers > 0)
+
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # Can only be set before torch first runs work on its inter-op thread pool
+        pass
+
+    _channels_last = channels_last
+    for iqa_metric in _loaded_metrics.values():
+        _set_memory_format(iqa_metric)
+
+    print(f"Quality scoring on CPU with {threads} threads")
+    return threads
+
+
+def _set_memory_format(iqa_metric):
+    """
+    Converts the network of a loaded metric to the memory format set by configure_cpu_inference.
+    """
+    network = getattr(iqa_metric, "net", None)
+    if network is not None:
+        network.to(memory_format=torch.channels_last if _channels_last else torch.contiguous_format)
+
+
+def run_metric(iqa_metric, metric_input):
+    """
+    Scores an image or batch of images under torch.inference_mode, which skips the autograd bookkeeping torch.no_grad
+    still does.
+    :param iqa_metric: pyiqa metric object, see get_metric.
+    :param metric_input: [string or torch.Tensor] Filepath of an image, or NCHW batch of images.
+    :return: [torch.Tensor] Score(s) returned by the metric.
+    """
+    if _channels_last and isinstance(metric_input, torch.Tensor) and metric_input.dim() == 4:
+        metric_input = metric_input.contiguous(memory_format=torch.channels_last)
+
+    with torch.inference_mode():
+        return iqa_metric(metric_input)
+
+
+def run_pyiqa_for_all_files(img_directory_path, score_store_path, metric="maniqa-koniq", filename_pattern=False,
+                            batch_size=1, loader_workers=2, journal=None, resume=False, manifest=None,
+                            score_cache_path=None, score_cache_size=score_store.DEFAULT_SCORE_CACHE_SIZE,
+                            short_side=None, preclassify_confidence=None):
+    """
+    Takes path to a directory containing images to score. Saves the quality score of each image according to the
+    selected PYIQA metric to a score store (see score_store.py), keyed by image filepath.
     :param img_directory_path: [string] path to directory containing images to score
-    :param shelve_filepath: [string] path to shelve file
+    :param score_store_path: [string] path to the SQLite score store
     :param metric: [string] For available metrics, see https://github.com/chaofengc/IQA-PyTorch and
     https://iqa-pytorch.readthedocs.io/
     :param filename_pattern: [string] Preprocess only image files which include this regex pattern in the name.
+    :param batch_size: [int] Number of images scored per forward pass. If 1, each image is passed to the metric by
+    filepath at its full size. If greater than 1, images are decoded by a prefetching data loader, resized to the input
+    shape in METRIC_INPUT_SIZES and scored in batches.
+    :param loader_workers: [int] Number of data loader processes decoding images ahead of scoring when batch_size > 1.
+    :param journal: [run_journal.RunJournal] If given, only images recorded as prepared in the journal are scored,
+    images already scored are skipped, and each score saved is recorded.
+    :param resume: [bool] If True, scores saved to the score store by an earlier, interrupted run are kept.
+    :param manifest: [list] discovery.ManifestEntry for each image in the run. If given, the destination filepaths of
+    its entries are scored rather than walking img_directory_path to find the images.
+    :param score_cache_path: [string] Path to a persistent score cache (see score_store.ScoreCache). If given, images
+    whose contents, metric and pyiqa version match a cached score are not scored again, and new scores are cached.
+    :param score_cache_size: [int] Maximum number of scores kept in the score cache.
+    :param short_side: [int] If given (and batch_size is 1), each image is scored from a reduced copy with this shorter
+    side, decoded straight from its source image in the manifest (see load_reduced_image), rather than from the
+    full-size prepared image.
+    :param preclassify_confidence: [float] If given, images the statistical pre-classifier (see preclassifier.py) is at
+    least this confident about are routed as 'good' or 'bad' quality without being scored by the metric.
     """
 
-    if os.path.exists(shelve_filepath):
+    if not resume:
         # remove file created during previous runs if exists.
-        os.remove(shelve_filepath)
+        score_store.remove_store(score_store_path)
 
-    shelve_file = shelve.open(shelve_filepath, writeback=True)
+    scores = score_store.ScoreStore(score_store_path)
 
-    # Iterate through all files in the given directory:
-    file_count = 0
-    for root, dirs, filenames in os.walk(img_directory_path):
-        for filename in filenames:
-            if filename.lower().endswith(tuple(custom_preprocess_a.IMAGE_EXTENSIONS)):
-                if filename_pattern:
-                    if re.search(filename_pattern, filename):
-                        file_count += 1
-                else:
-                    file_count += 1
+    if manifest is None:
+        # Not told which images are in the run - walk the given directory (once) to find them
+        manifest = discovery.build_manifest(img_directory_path)
 
-    # for item in progress_bar:
-    with tqdm(total=file_count, desc="Quality-scoring images", unit="file") as pbar:
+    if batch_size > 1:
+        # Batched scoring already scores a reduced copy, at the metric's input shape
+        short_side = None
 
-        for root, dirs, filenames in os.walk(img_directory_path):
+    # Reduced copies are decoded from the source image, which is never larger than the prepared image
+    source_paths = {entry.dest: entry.src for entry in manifest} if short_side else {}
 
-            for filename in filenames:
+    # If there is a filename regex pattern to identify specific image files to preprocess (and leave others
+    # preprocessed just to meet basic Transkribus upload requirements), only score images which match it.
+    file_paths = []
+    for entry in discovery.filter_manifest(manifest, filename_pattern, discovery.IMAGE_EXTENSIONS):
+        file_path = entry.dest
 
-                file_path = os.path.join(root, filename)
+        if journal is not None:
+            # Only score images prepared by this run, once each
+            if not journal.is_done(file_path, run_journal.PREPARED) or \
+                    (journal.is_done(file_path, run_journal.SCORED) and file_path in scores):
+                continue
 
-                if file_path == os.path.join(root, '.DS_Store'):
-                    pass
+        file_paths.append(file_path)
 
-                # If there is a filename regex pattern to identify specific image files to preprocess (and leave others
-                # preprocessed just to meet basic Transkribus upload requirements), preprocess as follows. Otherwise, leave images.
-                elif filename_pattern:
-                    # Check if pattern is in the filename:
-                    if re.search(filename_pattern, filename):
+    score_cache, image_hashes = None, {}
+    if score_cache_path:
+        score_cache = score_store.ScoreCache(score_cache_path, score_cache_size, pyiqa_version=pyiqa.__version__)
+        # Reuse the scores of images which are unchanged since they were scored in an earlier run
+        file_paths, image_hashes = use_cached_scores(file_paths, score_cache, scores, metric,
+                                                     cache_metric_name(metric, batch_size, short_side), journal,
+                                                     source_paths)
 
-                        pbar.set_description(f"Scoring {filename}")
+    if preclassify_confidence:
+        # Only ambiguous pages are left for the (much slower) metric
+        file_paths = use_preclassifier(file_paths, scores, preclassify_confidence, journal)
 
-                        try:
-                            # create metric with default setting
-                            iqa_metric = pyiqa.create_metric(metric_name=metric, device=DEVICE)
+    # metric with default setting, loaded once and reused for every image
+    iqa_metric = get_metric(metric)
 
-                            # img path as inputs.
-                            score_nr = float(iqa_metric(file_path))
-                            print(f"score for {filename} is: {score_nr}")
+    with tqdm(total=len(file_paths), desc="Quality-scoring images", unit="file") as pbar:
+        if batch_size > 1:
+            score_files_batched(file_paths, iqa_metric, scores, pbar, metric, batch_size, loader_workers,
+                                journal=journal, score_cache=score_cache)
+        else:
+            for file_path in file_paths:
+                filename = os.path.basename(file_path)
+                pbar.set_description(f"Scoring {filename}")
 
-                            # Update shelve object so we save the scores as we go along in case of midway errors
-                            shelve_file[file_path] = score_nr
-                            shelve_file.sync()
+                score_file(file_path, iqa_metric, scores, metric, score_cache, image_hashes.get(file_path),
+                           source_paths.get(file_path), short_side)
 
-                            # Update tqdm progress bar
-                            pbar.update(1)
+                if journal is not None:
+                    journal.record(file_path, run_journal.SCORED)
 
-                        except Exception as scoring_shelving_error:
-                            print(f"Error: Something went wrong running metric {metric}", scoring_shelving_error)
+                # Update tqdm progress bar
+                pbar.update(1)
 
-                            # Update shelve object so we save the scores as we go along in case of midway errors
-                            shelve_file[file_path] = "NA"
-                            shelve_file.sync()
+    scores.close()
+    if score_cache is not None:
+        score_cache.close()
 
-                            # Update tqdm progress bar
-                            pbar.update(1)
-                else:
 
-                    pbar.set_description(f"Scoring {filename}")
+def score_file(file_path, iqa_metric, scores, metric="maniqa-koniq", score_cache=None, image_hash=None,
+               source_path=None, short_side=None):
+    """
+    Scores a single image and saves its score to the score store (without a score if scoring fails).
+    :param file_path: [string] Filepath of the image to score, which its score is saved against.
+    :param iqa_metric: pyiqa metric object, see get_metric.
+    :param scores: [score_store.ScoreStore] Open score store to save the score to.
+    :param metric: [string] Name of the metric.
+    :param score_cache: [score_store.ScoreCache] If given, the new score is added to the score cache.
+    :param image_hash: [string] Hash of the contents of the image scored, if already computed.
+    :param source_path: [string] Filepath of the source image file_path was prepared from. Used with short_side.
+    :param short_side: [int] If given, a reduced copy of the image with this shorter side is scored, decoded straight
+    from source_path (if given) rather than file_path. Otherwise the image at file_path is scored at full size.
+    :return: [float] Quality score, or None if the image could not be scored.
+    """
+    filename = os.path.basename(file_path)
+    scored_path = source_path if short_side and source_path else file_path
+    score_nr = None
+    try:
+        if image_hash is None:
+            image_hash = score_store.image_hash(scored_path)
+
+        if short_side:
+            with stage_timer.stage("iqa_decode", file_path):
+                tensor = image_tensor(load_reduced_image(scored_path, short_side)).unsqueeze(0).to(DEVICE)
+            with stage_timer.stage("iqa_score", file_path):
+                score_nr = float(run_metric(iqa_metric, tensor))
+        else:
+            # img path as inputs.
+            with stage_timer.stage("iqa_score", file_path):
+                score_nr = float(run_metric(iqa_metric, file_path))
+        print(f"score for {filename} is: {score_nr}")
+
+        # Save the scores as we go along (committed in batches) in case of midway errors
+        scores.save(file_path, score_nr, metric, image_hash)
+        if score_cache is not None:
+            score_cache.put(image_hash, cache_metric_name(metric, short_side=short_side), score_nr)
+
+    except Exception as scoring_saving_error:
+        print(f"Error: Something went wrong running metric {metric}", scoring_saving_error)
+
+        # Saved without a score, so the image is classed as bad quality
+        score_nr = None
+        scores.save(file_path, None, metric, image_hash)
+
+    return score_nr
+
+
+def cache_metric_name(metric, batch_size=1, short_side=None):
+    """
+    Name under which scores are cached. Batched scoring resizes images to the input shape in METRIC_INPUT_SIZES, and
+    downscaled scoring reduces images to a shorter side, which give slightly different scores from scoring at full
+    size, so their scores are cached separately.
+    :param metric: [string] Name of the metric.
+    :param batch_size: [int] Number of images scored per forward pass.
+    :param short_side: [int] Shorter side of the reduced copies scored, if scoring downscaled inputs.
+    :return: [string] e.g. "maniqa-koniq", "maniqa-koniq@1024x768" or "maniqa-koniq@short768"
+    """
+    if batch_size > 1:
+        height, width = METRIC_INPUT_SIZES.get(metric, DEFAULT_METRIC_INPUT_SIZE)
+        return f"{metric}@{height}x{width}"
 
-                    try:
-                        # create metric with default setting
-                        iqa_metric = pyiqa.create_metric(metric_name=metric, device=DEVICE)
+    if short_side:
+        return f"{metric}@short{short_side}"
 
-                        # img path as inputs.
-                        score_nr = float(iqa_metric(file_path))
-                        print(f"score for {filename} is: {score_nr}")
+    return metric
 
-                        # Update shelve object so we save the scores as we go along in case of midway errors
-                        shelve_file[file_path] = score_nr
-                        shelve_file.sync()
 
-                        # Update tqdm progress bar
-                        pbar.update(1)
+def load_reduced_image(image_path, short_side):
+    """
+    Decodes a reduced RGB copy of an image, with its shorter side short_side pixels (smaller images are not enlarged).
+    JPEGs are reduced by 1/2, 1/4 or 1/8 while they are decoded (PIL draft mode), so the full-size image is never
+    decoded, then area averaged (box filter, as cv2.INTER_AREA) down to the exact size.
+    :param image_path: [string] Filepath of the image.
+    :param short_side: [int] Shorter side of the reduced copy, in pixels.
+    :return: [PIL.Image] RGB image.
+    """
+    with Image.open(image_path) as img:
+        scale = short_side / min(img.size)
+        if scale >= 1:
+            return img.convert("RGB")
 
-                    except Exception as scoring_shelving_error:
-                        print(f"Error: Something went wrong running metric {metric}", scoring_shelving_error)
+        size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+        # Only has an effect on JPEGs. Decodes at the smallest scale which is still at least size.
+        img.draft("RGB", size)
+        reduced = img.convert("RGB")
 
-                        # Update shelve object so we save the scores as we go along in case of midway errors
-                        shelve_file[file_path] = "NA"
-                        shelve_file.sync()
+    if reduced.size != size:
+        reduced = reduced.resize(size, resample=Image.BOX)
 
-                        # Update tqdm progress bar
-                        pbar.update(1)
+    return reduced
 
-    shelve_file.close()
 
-def map_to_qualityclass(shelvefilepath, goodbad_threshold, lower_better=False):
+def image_tensor(img):
     """
-    Takes a shelve file whereby keys are filepaths to images and values are quality scores. Returns a dictionary
+    :param img: [PIL.Image] RGB image.
+    :return: [torch.Tensor] CHW float tensor in [0, 1], as expected by pyiqa metrics.
+    """
+    # HWC uint8 -> CHW float in [0, 1]
+    return torch.from_numpy(np.asarray(img, dtype=np.float32) / 255.).permute(2, 0, 1)
+
+
+def use_cached_scores(file_paths, score_cache, scores, metric, cache_metric, journal=None, source_paths=None):
+    """
+    Saves the cached score of each image whose contents match a score in the score cache to the score store.
+    :param file_paths: [list] List of filepaths to images to score.
+    :param score_cache: [score_store.ScoreCache] Open score cache.
+    :param scores: [score_store.ScoreStore] Open score store to save scores to.
+    :param metric: [string] Name of the metric.
+    :param cache_metric: [string] Name the metric's scores are cached under, see cache_metric_name.
+    :param journal: [run_journal.RunJournal] If given, each image whose cached score is used is recorded as scored.
+    :param source_paths: [dict] If given, images are scored from their source image (see score_file), so the source
+    image listed here for each filepath is hashed instead.
+    :return: [tuple] (list of filepaths of images still to score, dict mapping filepaths to image hashes)
+    """
+    image_hashes = {}
+    for file_path in file_paths:
+        with stage_timer.stage("image_hash", file_path):
+            try:
+                image_hashes[file_path] = score_store.image_hash((source_paths or {}).get(file_path, file_path))
+            except OSError:
+                # Left to be scored, which records the image as unscored
+                pass
+
+    cached_scores = score_cache.get_many(list(image_hashes.values()), cache_metric)
+
+    remaining_file_paths = []
+    for file_path in file_paths:
+        image_hash = image_hashes.get(file_path)
+        if image_hash in cached_scores:
+            scores.save(file_path, cached_scores[image_hash], metric, image_hash)
+            if journal is not None:
+                journal.record(file_path, run_journal.SCORED)
+        else:
+            remaining_file_paths.append(file_path)
+
+    print(f"Reused {len(file_paths) - len(remaining_file_paths)} cached quality scores, "
+          f"{len(remaining_file_paths)} images left to score")
+
+    return remaining_file_paths, image_hashes
+
+
+def preclassify_file(file_path, scores, min_confidence=preclassifier.DEFAULT_CONFIDENCE):
+    """
+    Routes a single image with the statistical pre-classifier, saving its quality class to the score store if the
+    pre-classifier is confident enough.
+    :param file_path: [string] Filepath of the image.
+    :param scores: [score_store.ScoreStore] Open score store to save the quality class to.
+    :param min_confidence: [float] Confidence the pre-classifier needs to route the image.
+    :return: [string] 'good' or 'bad', or None if the image is left to be scored by the metric.
+    """
+    try:
+        with stage_timer.stage("preclassify", file_path):
+            quality, confidence = preclassifier.preclassify(file_path, min_confidence)
+    except Exception as preclassifying_error:
+        # Left to be scored, which records the image as unscored if it cannot be read
+        print(f"Error: Could not pre-classify image {os.path.basename(file_path)}", preclassifying_error)
+        return None
+
+    if quality is not None:
+        scores.save(file_path, None, preclassifier.PRECLASSIFIER_NAME, preclass=quality,
+                    preclass_confidence=confidence)
+
+    return quality
+
+
+def use_preclassifier(file_paths, scores, min_confidence, journal=None):
+    """
+    Routes the images the statistical pre-classifier is confident about, saving their quality class to the score store.
+    :param file_paths: [list] List of filepaths to images to score.
+    :param scores: [score_store.ScoreStore] Open score store to save quality classes to.
+    :param min_confidence: [float] Confidence the pre-classifier needs to route an image.
+    :param journal: [run_journal.RunJournal] If given, each image routed is recorded as scored.
+    :return: [list] Filepaths of the images still to score.
+    """
+    remaining_file_paths = []
+    for file_path in tqdm(file_paths, desc="Pre-classifying images", unit="file"):
+        if preclassify_file(file_path, scores, min_confidence) is None:
+            remaining_file_paths.append(file_path)
+        elif journal is not None:
+            journal.record(file_path, run_journal.SCORED)
+
+    print(f"Pre-classified {len(file_paths) - len(remaining_file_paths)} images, "
+          f"{len(remaining_file_paths)} images left to score")
+
+    return remaining_file_paths
+
+
+class ScoringDataset(torch.utils.data.Dataset):
+    """
+    Decodes images for batched quality scoring. Each image is converted to RGB and resized to a fixed input shape so
+    that images of different sizes can be stacked into one batch. Images which cannot be read are returned with a
+    tensor of None so that they can be saved without a score rather than stopping the batch. The hash of each image's
+    contents is computed from the same read as the decode.
+    """
+
+    def __init__(self, file_paths, input_size):
+        """
+        :param file_paths: [list] List of filepaths to images to score.
+        :param input_size: [tuple] (height, width) each image is resized to.
+        """
+        self.file_paths = file_paths
+        self.input_size = input_size
+
+    def __len__(self):
+        return len(self.file_paths)
+
+    def __getitem__(self, index):
+        file_path = self.file_paths[index]
+        height, width = self.input_size
+        tensor, image_hash = None, None
+        try:
+            with open(file_path, "rb") as image_file:
+                image_bytes = image_file.read()
+            image_hash = score_store.hash_bytes(image_bytes)
+
+            with Image.open(io.BytesIO(image_bytes)) as img:
+                img = img.convert("RGB").resize((width, height), resample=Image.BICUBIC)
+            tensor = image_tensor(img)
+        except Exception as decoding_error:
+            print(f"Error: Could not read image {os.path.basename(file_path)} for scoring", decoding_error)
+
+        return file_path, tensor, image_hash
+
+
+def collate_scoring_batch(items):
+    """
+    Collates (filepath, tensor, hash) items from ScoringDataset into a batch, setting aside images which could not be
+    read.
+    :param items: [list] List of (filepath, tensor or None, hash or None) tuples.
+    :return: [tuple] (list of filepaths in batch, stacked tensor or None, list of filepaths which could not be read,
+    dict mapping filepaths to image hashes)
+    """
+    batch_paths = [file_path for file_path, tensor, image_hash in items if tensor is not None]
+    failed_paths = [file_path for file_path, tensor, image_hash in items if tensor is None]
+    batch = torch.stack([tensor for file_path, tensor, image_hash in items if tensor is not None]) \
+        if batch_paths else None
+    image_hashes = {file_path: image_hash for file_path, tensor, image_hash in items}
+
+    return batch_paths, batch, failed_paths, image_hashes
+
+
+def score_files_batched(file_paths, iqa_metric, scores, pbar, metric="maniqa-koniq", batch_size=8,
+                        loader_workers=2, journal=None, score_cache=None):
+    """
+    Scores images in batches, saving one score per image filepath to the score store. Images are decoded and resized
+    by a DataLoader in background processes while the previous batch is being scored.
+    :param file_paths: [list] List of filepaths to images to score.
+    :param iqa_metric: pyiqa metric object, see get_metric.
+    :param scores: [score_store.ScoreStore] Open score store to save scores to.
+    :param pbar: [tqdm obj] Progress bar to update as images are scored.
+    :param metric: [string] Name of the metric, used to look up its input shape in METRIC_INPUT_SIZES.
+    :param batch_size: [int] Number of images per batch.
+    :param loader_workers: [int] Number of data loader processes decoding images ahead of scoring.
+    :param journal: [run_journal.RunJournal] If given, each image is recorded as scored once its batch is saved.
+    :param score_cache: [score_store.ScoreCache] If given, each new score is added to the score cache.
+    """
+    input_size = METRIC_INPUT_SIZES.get(metric, DEFAULT_METRIC_INPUT_SIZE)
+
+    # Each loader process keeps 2 batches decoded ahead of the batch being scored
+    prefetch_kwargs = {"prefetch_factor": 2} if loader_workers > 0 else {}
+    loader = torch.utils.data.DataLoader(ScoringDataset(file_paths, input_size),
+                                         batch_size=batch_size,
+                                         num_workers=loader_workers,
+                                         collate_fn=collate_scoring_batch,
+                                         **prefetch_kwargs)
+
+    for batch_paths, batch, failed_paths, image_hashes in loader:
+        for file_path in failed_paths:
+            scores.save(file_path, None, metric, image_hashes[file_path])
+
+        if batch is not None:
+            pbar.set_description(f"Scoring {os.path.basename(batch_paths[0])} and {len(batch_paths) - 1} more")
+            try:
+                batch_start = time.perf_counter()
+                batch_scores = run_metric(iqa_metric, batch.to(DEVICE)).flatten().tolist()
+
+                if stage_timer.is_enabled():
+                    # Share the batch's scoring time equally between its images
+                    batch_seconds = time.perf_counter() - batch_start
+                    for file_path in batch_paths:
+                        stage_timer.record("iqa_score", batch_seconds / len(batch_paths), file_path)
+
+                for file_path, score_nr in zip(batch_paths, batch_scores):
+                    scores.save(file_path, float(score_nr), metric, image_hashes[file_path])
+                    if score_cache is not None:
+                        score_cache.put(image_hashes[file_path], cache_metric_name(metric, batch_size),
+                                        float(score_nr))
+
+            except Exception as scoring_saving_error:
+                print(f"Error: Something went wrong running metric {metric}", scoring_saving_error)
+                for file_path in batch_paths:
+                    scores.save(file_path, None, metric, image_hashes[file_path])
+
+        if journal is not None:
+            for file_path in failed_paths + batch_paths:
+                journal.record(file_path, run_journal.SCORED)
+
+        # Update tqdm progress bar
+        pbar.update(len(batch_paths) + len(failed_paths))
+
+
+def map_to_qualityclass(score_store_path, goodbad_threshold, lower_better=False, metric=None):
+    """
+    Takes a score store whereby keys are filepaths to images and values are quality scores. Returns a dictionary
     whereby keys are filepaths to images and a given values is one of two classes - 'good' or 'bad' depending on
     whether the metric used for scoring returns a higher or lower score when it deems an image to be better quality,
     and what threshold to use to decide between 'good' and 'bad' classes.
-    :param shelvefilepath: [python shelve obj] Path to stored shelve file object.
+    :param score_store_path: [string] Path to the SQLite score store written by run_pyiqa_for_all_files.
     :param goodbad_threshold: [float] Threshold used as score boundary between 'good' and 'bad' classes.
     :param lower_better: [bool] True when lower score indicates better quality image for scoring metric being used.
+    :param metric: [string] If given, only images scored with this metric are classified.
     :return: [dict] Dictionary mapping 'good' or 'bad' classification to each image filepath based on quality score.
     """
-    with shelve.open(shelvefilepath) as db:
-        goodbad_dict = {}
-        for filepath, score in db.items():
-            if not lower_better: # i.e. if higher score is better
-                if score == "NA":
-                    goodbad_dict[filepath] = "bad" # take bad quality as default as, in general, the non-machine
-                    # learning approach results in better OCR accuracy for images from this source (dark, microfiche),
-                    # and we will use the non-machine learning approach for bad quality images
+    # Images which could not be scored are classed as 'bad' quality as, in general, the non-machine learning approach
+    # results in better OCR accuracy for images from this source (dark, microfiche), and we will use the non-machine
+    # learning approach for bad quality images
+    scores = score_store.ScoreStore(score_store_path)
+    goodbad_dict = scores.classify(goodbad_threshold, lower_better, metric)
+    scores.close()
 
-                elif score >= goodbad_threshold:
-                    goodbad_dict[filepath] = "good"
-
-                else:
-                    goodbad_dict[filepath] = "bad"
-
-            elif lower_better:
-                if score == "NA":
-                    goodbad_dict[filepath] = "bad"
+    print(f"\nImage quality assessment: {goodbad_dict}\n")
+    return goodbad_dict
 
-                elif score <= goodbad_threshold:
-                    goodbad_dict[filepath] = "good"
 
-                else:
-                    goodbad_dict[filepath] = "bad"
+def quality_class(score, goodbad_threshold, lower_better=False):
+    """
+    Classifies a single score as 'good' or 'bad' quality, in the same way as map_to_qualityclass.
+    :param score: [float] Quality score, or None if the image could not be scored (classed as 'bad').
+    :param goodbad_threshold: [float] Threshold used as score boundary between 'good' and 'bad' classes.
+    :param lower_better: [bool] True when lower score indicates better quality image for scoring metric being used.
+    :return: [string] 'good' or 'bad'
+    """
+    if score is None:
+        return "bad"
 
-        db.close()
+    if lower_better:
+        return "good" if score <= goodbad_threshold else "bad"
 
-    print(f"\nImage quality assessment: {goodbad_dict}\n")
-    return goodbad_dict
+    return "good" if score >= goodbad_threshold else "bad"
 
 
 def map_to_treatment(score_dict):
@@ -178,5 +598,4 @@ def map_to_treatment(score_dict):
     on quality class.
     """
 
-    treatment_map = {'good': 'sbb', 'bad': 'sauvola'}
-    return {filepath: treatment_map[quality] for filepath, quality in score_dict.items()}
\ No newline at end of file
+    return {filepath: TREATMENTS[quality] for filepath, quality in score_dict.items()}
\ No newline at end of file
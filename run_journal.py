@@ -0,0 +1,149 @@
+"""
+Per-file run journal which records the preprocessing stages each image has completed, so that a run which stops midway
+(e.g. killed for running out of memory on a huge scan) can be restarted with --resume and pick up each image at the
+stage it stopped at.
+
+The journal is an append-only file with one JSON record per completed stage. Each record is written with a single
+write and flushed to disk before the run moves on, so a crash loses at most the stage that was in progress. Only uses
+the standard library so it can be used from both the custom_preprocess_a and custom_preprocess_b environments.
+"""
+import json
+import os
+import threading
+
+# Stages recorded in the journal, in pipeline order
+PREPARED = "prepared"  # meet_upload_reqs has written the prepared image
+SCORED = "scored"  # image quality score saved
+ROUTED = "routed"  # image assigned to the Sauvola or SBB pipeline (value: treatment)
+DENOISED = "denoised"  # greyscaled and denoised ahead of SBB binarisation (value: handoff folder, see page_handoff.py)
+BINARISED = "binarised"
+DESKEWED = "deskewed"
+COMPRESSED = "compressed"  # final output written, no further work needed
+
+JOURNAL_FILENAME = "run_journal.jsonl"
+
+
+class RunJournal:
+    """
+    Records and looks up the completed stages of each image in a run. Filepaths are stored as absolute paths so the
+    same image is recognised whichever working directory it was recorded from.
+    """
+
+    def __init__(self, journal_path):
+        """
+        Loads any stages already recorded at journal_path.
+        :param journal_path: [string] Path to the journal file. Created when the first stage is recorded.
+        """
+        self.journal_path = journal_path
+        self.completed = {}  # filepath -> {stage: value}
+        self._fd = None
+        self._partial_line = False  # True if the journal ends with a partially written record
+        self._lock = threading.Lock()  # stages may be recorded from several threads (see pipeline.py)
+        self._identity = None  # (device, inode) of the journal file loaded, see is_stale
+        self._loaded_size = 0  # bytes of the journal file loaded
+
+        if os.path.exists(journal_path):
+            with open(journal_path, "r") as journal_file:
+                file_stat = os.fstat(journal_file.fileno())
+                self._identity = (file_stat.st_dev, file_stat.st_ino)
+                self._loaded_size = file_stat.st_size
+                for line in journal_file:
+                    self._partial_line = not line.endswith("\n")
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Partially written record from a run which stopped midway
+                        continue
+                    self.completed.setdefault(record["file"], {})[record["stage"]] = record.get("value")
+
+    def __getstate__(self):
+        # The open file descriptor can't be sent to worker processes - each process opens its own on first record
+        state = self.__dict__.copy()
+        state["_fd"] = None
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def is_stale(self):
+        """
+        A journal kept open for a long time (e.g. by the SBB binarisation worker, across runs) no longer describes the
+        run once its file has been deleted or replaced, as custom_preprocess_a.py does at the start of each run which
+        is not resumed.
+        :return: [bool] True if the journal file has been deleted, replaced or truncated since it was loaded (or, if
+        there was no file then, since this journal created it), so the journal should be loaded again.
+        """
+        try:
+            file_stat = os.stat(self.journal_path)
+        except FileNotFoundError:
+            return self._identity is not None
+
+        return (file_stat.st_dev, file_stat.st_ino) != self._identity or file_stat.st_size < self._loaded_size
+
+    def subset(self, filepaths):
+        """
+        Copy of the journal holding only the stages of the given images, which is much cheaper to send to a worker
+        process than the whole journal. Stages recorded with the copy are written to the same journal file.
+        :param filepaths: [list] Filepaths of the images.
+        :return: [RunJournal]
+        """
+        journal_subset = RunJournal.__new__(RunJournal)
+        journal_subset.__setstate__(self.__getstate__())
+        journal_subset.completed = {}
+        for filepath in filepaths:
+            filepath = os.path.abspath(filepath)
+            if filepath in self.completed:
+                journal_subset.completed[filepath] = dict(self.completed[filepath])
+
+        return journal_subset
+
+    def is_done(self, filepath, stage):
+        """
+        :param filepath: [string] Filepath of the image.
+        :param stage: [string] One of the stage constants in this module.
+        :return: [bool] True if the image has completed the stage.
+        """
+        return stage in self.completed.get(os.path.abspath(filepath), {})
+
+    def value(self, filepath, stage):
+        """
+        :return: Value recorded with the stage (e.g. the treatment for ROUTED), or None.
+        """
+        return self.completed.get(os.path.abspath(filepath), {}).get(stage)
+
+    def record(self, filepath, stage, value=None):
+        """
+        Records that an image has completed a stage and flushes the record to disk.
+        :param filepath: [string] Filepath of the image.
+        :param stage: [string] One of the stage constants in this module.
+        :param value: Optional JSON-serialisable value to store with the stage.
+        """
+        filepath = os.path.abspath(filepath)
+        line = json.dumps({"file": filepath, "stage": stage, "value": value}) + "\n"
+
+        with self._lock:
+            self.completed.setdefault(filepath, {})[stage] = value
+
+            if self._fd is None:
+                # O_APPEND so records from several worker processes are added whole, one after another
+                self._fd = os.open(self.journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                if self._identity is None:
+                    # Created the journal file (or another process did since this journal was loaded)
+                    file_stat = os.fstat(self._fd)
+                    self._identity = (file_stat.st_dev, file_stat.st_ino)
+
+            if self._partial_line:
+                # Start on a new line so the record isn't joined onto the end of the partial one
+                line = "\n" + line
+                self._partial_line = False
+
+            os.write(self._fd, line.encode())
+            os.fsync(self._fd)
+
+    def close(self):
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
@@ -0,0 +1,139 @@
+"""
+Sweeps a grid of Sauvola binarisation parameters (k-value and window size) over a sample of images, to help choose
+--sauv_k_val and --sauv_window_size for a new collection without rerunning the whole pipeline for every combination.
+
+Each sample image is prepared (meet_upload_reqs) and denoised once. The local mean and standard deviation used by
+Sauvola binarisation depend only on the window size, so they are computed once per window size and reused for every
+k-value. Each combination is then thresholded, deskewed and compressed as in dd_preprocess.preprocess_image, using the
+opencv Sauvola engine (near-identical to the skimage engine, see dd_preprocess.binarise_sauvola_opencv).
+
+Usage:
+
+python sauvola_sweep.py path/to/source/directory path/to/destination/directory --k_vals 0.1 0.14 0.22
+                        --window_sizes 11 21 301 [--sample 20] [--contrast_enhance]
+
+One output tree is written per combination, labelled with its parameters and replicating the source directory
+structure, e.g.
+
+destination/k0.14_w21/subfolder/page_001.jpg
+destination/k0.22_w301/subfolder/page_001.jpg
+
+"""
+import argparse
+import os
+from tqdm import tqdm
+
+import dd_preprocess
+import discovery
+
+DEFAULT_K_VALS = [0.1, 0.14, 0.22, 0.3]
+DEFAULT_WINDOW_SIZES = [11, 21, 51, 301]
+
+
+def combination_folder_name(k_val, window_size):
+    """
+    :return: [string] Name of the output folder for a parameter combination, e.g. "k0.14_w21".
+    """
+    return f"k{k_val:g}_w{window_size}"
+
+
+def find_sample_images(source_folder, sample=None):
+    """
+    Finds the images to sweep over.
+    :param source_folder: [string] Path to the folder containing the images (including sub-folders).
+    :param sample: [int] If given, only the first sample images (in sorted order) are returned.
+    :return: [list] Filepaths of the images.
+    """
+    image_paths = sorted(entry.src for entry in discovery.build_manifest(source_folder))
+
+    if sample is not None:
+        image_paths = image_paths[:sample]
+
+    return image_paths
+
+
+def sweep_image(src_image_path, source_folder, destination_folder, k_vals, window_sizes, contrast_enhance,
+                denoise_tile_size=None, output_format="jpeg"):
+    """
+    Binarises, deskews and compresses one image with every combination of k-value and window size.
+    :param src_image_path: [string] Filepath of the source image.
+    :param source_folder: [string] Source folder, used to replicate the directory structure in each output tree.
+    :param destination_folder: [string] Folder in which to write one output tree per combination.
+    :param k_vals: [list] K-values to use in Sauvola binarisation.
+    :param window_sizes: [list] Window sizes to use in Sauvola binarisation.
+    :param contrast_enhance: [bool] If True, contrast stretches and enhances the image after denoising.
+    :param denoise_tile_size: [int] If given, the image is denoised in overlapping tiles of this size on a thread pool.
+    :param output_format: [string] Format to write binarised images in, one of dd_preprocess.OUTPUT_FORMATS.
+    """
+    relative_path = os.path.splitext(os.path.relpath(src_image_path, source_folder))[0] + ".jpg"
+
+    # Prepare and denoise once, shared by every combination
+    image = dd_preprocess.meet_upload_reqs(src_image_path, None, False, return_array=True)
+    if image is None:
+        return
+    image = dd_preprocess.denoise_image(image, contrast_enhance, tile_size=denoise_tile_size)
+
+    for window_size in window_sizes:
+        # The local statistics depend only on the window size, so are shared by every k-value
+        mean, std = dd_preprocess.sauvola_statistics(image, window_size)
+
+        for k_val in k_vals:
+            dest_image_path = os.path.join(destination_folder, combination_folder_name(k_val, window_size),
+                                           relative_path)
+            os.makedirs(os.path.dirname(dest_image_path), exist_ok=True)
+
+            try:
+                threshold = dd_preprocess.threshold_sauvola_from_statistics(mean, std, k_val)
+                binarised = (image > threshold).astype("uint8") * 255
+
+                output_image_path = dd_preprocess.rotate_image(binarised, dest_image_path, output_format=output_format)
+
+                # Compress until allowable size, as in preprocess_image
+                if os.path.getsize(output_image_path) > dd_preprocess.max_image_bytes:
+                    dd_preprocess.compress_under_size(dd_preprocess.max_image_bytes, output_image_path)
+
+            except Exception as sweep_error:
+                print(f"Error binarising image {os.path.basename(src_image_path)} with k={k_val:g}, "
+                      f"window size={window_size}: {sweep_error}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Writes one Sauvola binarised copy of each sample image per "
+                                                 "combination of k-value and window size, to help tune "
+                                                 "--sauv_k_val and --sauv_window_size.")
+    parser.add_argument("source_folder", type=str, help="Path to the folder containing the sample images")
+    parser.add_argument("destination_folder", type=str,
+                        help="Path to the folder in which to write one output tree per parameter combination")
+    parser.add_argument("--k_vals", "-k", type=float, nargs="+", default=DEFAULT_K_VALS,
+                        help=f"K-values to sweep (default: {' '.join(str(k) for k in DEFAULT_K_VALS)})")
+    parser.add_argument("--window_sizes", "-w", type=int, nargs="+", default=DEFAULT_WINDOW_SIZES,
+                        help=f"Window sizes to sweep. Should not be even values "
+                             f"(default: {' '.join(str(w) for w in DEFAULT_WINDOW_SIZES)})")
+    parser.add_argument("--sample", "-n", type=int, default=None,
+                        help="Only sweep the first n images found in the source folder (default: all images)")
+    parser.add_argument("--contrast_enhance", "-ce",
+                        help="Use flag to contrast stretch and enhance contrast of images before binarisation.",
+                        action="store_true")
+    parser.add_argument("--denoise_tile_size", "-dt", type=int, default=0,
+                        help="Denoise each image in overlapping tiles of this many pixels square, on a thread pool "
+                             "of one thread per CPU core, rather than in a single call (which OpenCV already spreads "
+                             "over the cores). Not known to be faster (default: 0, denoise in a single call)")
+    parser.add_argument("--output_format", "-of", type=str, choices=dd_preprocess.OUTPUT_FORMATS, default="jpeg",
+                        help="Format to write binarised images in. png writes them losslessly at 1 bit per pixel "
+                             "(default: jpeg)")
+
+    args = parser.parse_args()
+
+    even_window_sizes = [window_size for window_size in args.window_sizes if window_size % 2 == 0]
+    if even_window_sizes:
+        parser.error(f"Window sizes should not be even values: {even_window_sizes}")
+
+    image_paths = find_sample_images(args.source_folder, args.sample)
+    print(f"Sweeping {len(args.k_vals) * len(args.window_sizes)} parameter combinations over "
+          f"{len(image_paths)} images")
+
+    for src_image_path in tqdm(image_paths, desc="Sweeping Sauvola parameters", unit="image"):
+        sweep_image(src_image_path, args.source_folder, args.destination_folder, args.k_vals, args.window_sizes,
+                    args.contrast_enhance, args.denoise_tile_size, args.output_format)
+
+    print(f"Sweep completed. Outputs written to {args.destination_folder}")
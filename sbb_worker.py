@@ -0,0 +1,311 @@
+"""
+Long-lived SBB binarisation worker. Runs in the custom_preprocess_b environment, loads the SBB binarisation model once
+and then binarises good quality images submitted over a Unix socket, so the model load and TensorFlow warmup are paid
+once rather than on every run of custom_preprocess_b.py.
+
+Start the worker (in the custom_preprocess_b environment) like this:
+
+python sbb_worker.py
+
+Then pass --sbb_socket to custom_preprocess_a.py (or --sbb_worker to preprocess_driver.sh) to submit good quality images
+to the worker as soon as they are ready for binarisation. The worker keeps running between runs until stopped with:
+
+python sbb_worker.py --stop
+
+Jobs are sent as one JSON object per line and each receives a one line JSON reply:
+
+{"cmd": "binarise", "path": "/path/to/image.jpg", "journal": "/path/to/run_journal.jsonl",
+ "handoff_dir": "/dev/shm/dd_custom_preprocess_handoff"}
+    ->  {"status": "queued"}
+{"cmd": "wait"}      ->  {"status": "done", "completed": [...], "failed": {...}}
+{"cmd": "ping"}      ->  {"status": "ok"}
+{"cmd": "shutdown"}  ->  {"status": "stopping"}
+
+"journal" is optional. If given, stages the image completed in an earlier, interrupted run are skipped and completed
+stages are recorded in the run journal (see run_journal.py). "handoff_dir" is optional. If given, the prepared image is
+read from the page handed off in that folder, where there is one (see page_handoff.py).
+
+"wait" blocks until every job queued so far has finished, and returns the results of all jobs finished since the
+previous "wait". The client side (SbbWorkerClient) only uses the standard library, so it can be used from the
+custom_preprocess_a environment.
+"""
+import argparse
+import json
+import os
+import queue
+import socket
+import socketserver
+import tempfile
+import threading
+import run_journal
+
+DEFAULT_SOCKET_PATH = os.path.join(tempfile.gettempdir(), "dd_sbb_worker.sock")
+
+
+class SbbWorker:
+    """
+    Holds the loaded SBB binarisation model and binarises queued images one at a time on a background thread.
+    """
+
+    def __init__(self, model_dir, warmup=True):
+        """
+        :param model_dir: [string] Path to the SBB binarisation model directory.
+        :param warmup: [bool] If True, binarises a small blank image after loading so that the first real job does
+        not pay for building the TensorFlow graph.
+        """
+        # Imported here so that SbbWorkerClient can be used without TensorFlow installed
+        from sbb_binarize.sbb_binarize import SbbBinarizer
+        import custom_preprocess_b
+
+        self._binarise_image = custom_preprocess_b.binarise_image
+        self.journals = {}  # run journal path -> run_journal.RunJournal
+
+        print("Loading SBB binarisation model")
+        self.binarizer = SbbBinarizer(model_dir)
+        if warmup:
+            self._warmup()
+
+        self.jobs = queue.Queue()
+        self.results_lock = threading.Lock()
+        self.completed = []
+        self.failed = {}
+
+        threading.Thread(target=self._run_jobs, daemon=True).start()
+
+    def _warmup(self):
+        import numpy as np
+        import cv2
+
+        with tempfile.TemporaryDirectory() as warmup_dir:
+            warmup_image_path = os.path.join(warmup_dir, "warmup.png")
+            cv2.imwrite(warmup_image_path, np.full((512, 512, 3), 255, np.uint8))
+            self.binarizer.run(image_path=warmup_image_path, save=warmup_image_path)
+
+    def submit(self, image_path, journal_path=None, handoff_dir=None):
+        """
+        Queues an image to be binarised.
+        :param image_path: [string] Filepath to an image prepared by dd_preprocessor.process_before_sbb.
+        :param journal_path: [string] Optional path to the run journal of the run the image belongs to.
+        :param handoff_dir: [string] Optional folder the prepared image may have been handed off in.
+        """
+        self.jobs.put((image_path, journal_path, handoff_dir))
+
+    def wait(self):
+        """
+        Blocks until all queued images have been binarised.
+        :return: [tuple] (list of binarised image filepaths, dict mapping failed input filepaths to error messages),
+        covering jobs finished since the previous call.
+        """
+        self.jobs.join()
+        with self.results_lock:
+            completed, failed = self.completed, self.failed
+            self.completed, self.failed = [], {}
+
+        return completed, failed
+
+    def _get_journal(self, journal_path):
+        """
+        :param journal_path: [string] Path to a run journal.
+        :return: [run_journal.RunJournal] The journal, loaded again if its file has been replaced since it was loaded
+        (a run which is not resumed starts a new journal at the same path), so stages recorded by an earlier run are
+        never taken as done in a later one.
+        """
+        journal = self.journals.get(journal_path)
+        if journal is None or journal.is_stale():
+            if journal is not None:
+                journal.close()
+            journal = self.journals[journal_path] = run_journal.RunJournal(journal_path)
+
+        return journal
+
+    def _run_jobs(self):
+        while True:
+            image_path, journal_path, handoff_dir = self.jobs.get()
+            try:
+                journal = self._get_journal(journal_path) if journal_path is not None else None
+
+                output_image_path = self._binarise_image(self.binarizer, image_path, journal=journal,
+                                                         handoff_dir=handoff_dir)
+                with self.results_lock:
+                    self.completed.append(output_image_path)
+            except Exception as sbb_binarisation_error:
+                print(f"Error binarising image {os.path.basename(image_path)}: {sbb_binarisation_error}")
+                with self.results_lock:
+                    self.failed[image_path] = str(sbb_binarisation_error)
+            finally:
+                self.jobs.task_done()
+
+
+class SbbWorkerRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Reads JSON requests line by line from a client connection and answers each with a JSON reply.
+    """
+
+    def handle(self):
+        worker = self.server.worker
+
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                cmd = request.get("cmd")
+
+                if cmd == "binarise":
+                    worker.submit(request["path"], request.get("journal"), request.get("handoff_dir"))
+                    reply = {"status": "queued"}
+                elif cmd == "wait":
+                    completed, failed = worker.wait()
+                    reply = {"status": "done", "completed": completed, "failed": failed}
+                elif cmd == "ping":
+                    reply = {"status": "ok"}
+                elif cmd == "shutdown":
+                    reply = {"status": "stopping"}
+                    # shutdown() blocks until serve_forever returns, so it must be called from another thread
+                    threading.Thread(target=self.server.shutdown, daemon=True).start()
+                else:
+                    reply = {"status": "error", "error": f"Unknown command: {cmd}"}
+
+            except Exception as request_error:
+                reply = {"status": "error", "error": str(request_error)}
+
+            self.wfile.write((json.dumps(reply) + "\n").encode())
+            self.wfile.flush()
+
+
+class SbbWorkerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(socket_path=DEFAULT_SOCKET_PATH, model_dir=None, warmup=True):
+    """
+    Loads the SBB binarisation model and serves binarisation jobs on a Unix socket until a shutdown request arrives.
+    :param socket_path: [string] Path of the Unix socket to listen on.
+    :param model_dir: [string] Path to the SBB binarisation model directory. Defaults to custom_preprocess_b.model_dir.
+    :param warmup: [bool] If True, runs the model once on a blank image before accepting jobs.
+    """
+    if model_dir is None:
+        import custom_preprocess_b
+        model_dir = custom_preprocess_b.model_dir
+
+    # Remove socket left behind by a worker which did not shut down cleanly
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+
+    worker = SbbWorker(model_dir, warmup=warmup)
+
+    with SbbWorkerServer(socket_path, SbbWorkerRequestHandler) as server:
+        server.worker = worker
+        print(f"SBB binarisation worker listening on {socket_path}")
+        try:
+            server.serve_forever()
+        finally:
+            # Finish any queued jobs before exiting
+            worker.wait()
+            os.remove(socket_path)
+
+    print("SBB binarisation worker stopped")
+
+
+class SbbWorkerClient:
+    """
+    Submits binarisation jobs to a running SBB binarisation worker.
+    """
+
+    def __init__(self, socket_path=DEFAULT_SOCKET_PATH):
+        """
+        :param socket_path: [string] Path of the Unix socket the worker is listening on.
+        """
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_path)
+        self.sock_file = self.sock.makefile("rw")
+
+    def _request(self, request):
+        self.sock_file.write(json.dumps(request) + "\n")
+        self.sock_file.flush()
+        reply = json.loads(self.sock_file.readline())
+
+        if reply.get("status") == "error":
+            raise RuntimeError(f"SBB binarisation worker error: {reply.get('error')}")
+
+        return reply
+
+    def submit(self, image_path, journal_path=None, handoff_dir=None):
+        """
+        Queues an image to be binarised, deskewed and compressed by the worker. Returns without waiting for the job.
+        :param image_path: [string] Filepath to an image prepared by dd_preprocessor.process_before_sbb.
+        :param journal_path: [string] Optional path to the run journal in which to record the image's stages.
+        :param handoff_dir: [string] Optional folder the prepared image may have been handed off in.
+        """
+        # The worker may be running from a different working directory
+        request = {"cmd": "binarise", "path": os.path.abspath(image_path)}
+        if journal_path is not None:
+            request["journal"] = os.path.abspath(journal_path)
+        if handoff_dir is not None:
+            request["handoff_dir"] = os.path.abspath(handoff_dir)
+        self._request(request)
+
+    def wait(self):
+        """
+        Blocks until the worker has finished every queued job.
+        :return: [tuple] (list of binarised image filepaths, dict mapping failed input filepaths to error messages)
+        """
+        reply = self._request({"cmd": "wait"})
+
+        return reply["completed"], reply["failed"]
+
+    def ping(self):
+        return self._request({"cmd": "ping"})["status"] == "ok"
+
+    def shutdown(self):
+        self._request({"cmd": "shutdown"})
+
+    def close(self):
+        self.sock_file.close()
+        self.sock.close()
+
+
+def worker_is_running(socket_path=DEFAULT_SOCKET_PATH):
+    """
+    :param socket_path: [string] Path of the Unix socket the worker listens on.
+    :return: [bool] True if a worker is accepting requests on socket_path.
+    """
+    try:
+        client = SbbWorkerClient(socket_path)
+    except OSError:
+        return False
+
+    try:
+        return client.ping()
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Long-lived SBB binarisation worker which keeps the model loaded "
+                                                 "between images and runs.")
+    parser.add_argument("--socket", "-s", type=str, default=DEFAULT_SOCKET_PATH,
+                        help=f"Path of the Unix socket to listen on (default: {DEFAULT_SOCKET_PATH})")
+    parser.add_argument("--model_dir", "-m", type=str, default=None,
+                        help="Path to the SBB binarisation model directory (default: ./saved_model_2020_01_16)")
+    parser.add_argument("--no_warmup",
+                        help="Use flag to skip running the model on a blank image before accepting jobs.",
+                        action="store_true")
+    parser.add_argument("--ping",
+                        help="Use flag to check whether a worker is running on the socket, then exit. Exit status "
+                             "is 0 if it is.",
+                        action="store_true")
+    parser.add_argument("--stop",
+                        help="Use flag to stop a worker running on the socket once its queued jobs are finished.",
+                        action="store_true")
+
+    args = parser.parse_args()
+
+    if args.ping:
+        raise SystemExit(0 if worker_is_running(args.socket) else 1)
+
+    elif args.stop:
+        stop_client = SbbWorkerClient(args.socket)
+        stop_client.shutdown()
+        stop_client.close()
+
+    else:
+        serve(args.socket, model_dir=args.model_dir, warmup=not args.no_warmup)
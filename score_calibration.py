@@ -0,0 +1,215 @@
+"""
+Checks how well downscaled quality scoring (custom_preprocess_a.py --score_short_side) and the statistical
+pre-classifier (--preclassify_confidence) agree with full-size scoring on a sample of a collection, before using them
+for a whole run.
+
+Each sample image is prepared as in custom_preprocess_a.py (meet_upload_reqs) and scored at full size, then scored
+again from a reduced copy decoded straight from the source image at each shorter side given. The report gives, for
+each shorter side, the share of images routed the same way ('good' -> SBB, 'bad' -> Sauvola) as full-size scoring at
+the given threshold, the images routed differently, how far scores moved and the time taken to score an image
+(including decoding), and the share of images the statistical pre-classifier (preclassifier.py) would route at the
+given confidence, with how often it routes them the same way as full-size scoring. maniqa-koniq averages the scores
+of random crops, so scores vary slightly even between two full-size runs - the random seed is reset before each score
+so every image is scored with the same crops.
+
+Usage:
+
+python score_calibration.py path/to/source/directory [--sample 50] [--short_sides 512 768 1024]
+                            [--goodbad_threshold 0.335] [--preclassify_confidence 0.95]
+                            [--output score_calibration.json]
+
+Runs in the custom_preprocess_a environment.
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+
+import torch
+from tqdm import tqdm
+
+import dd_preprocess
+import discovery
+import preclassifier
+import quality_scorer
+
+SCORING_METRIC = "maniqa-koniq"
+DEFAULT_GOODBAD_THRESHOLD = 0.335  # as custom_preprocess_a.DEFAULT_GOODBAD_THRESHOLD
+DEFAULT_SHORT_SIDES = [512, 768, 1024]
+
+
+def find_calibration_sample(source_folder, sample=50, seed=0):
+    """
+    Picks a random sample of the images in a collection, so pages from every part of it are represented.
+    :param source_folder: [string] Path to the folder containing the images (including sub-folders).
+    :param sample: [int] Number of images to pick.
+    :param seed: [int] Random seed, so the same sample is picked each time.
+    :return: [list] Filepaths of the sample images, sorted.
+    """
+    image_paths = sorted(entry.src for entry in discovery.build_manifest(source_folder))
+    if sample < len(image_paths):
+        image_paths = sorted(random.Random(seed).sample(image_paths, sample))
+
+    return image_paths
+
+
+def timed_score(iqa_metric, score_input, seed=0):
+    """
+    :param iqa_metric: pyiqa metric object, see quality_scorer.get_metric.
+    :param score_input: [function] Returns the metric's input (a filepath or a batched tensor).
+    :param seed: [int] Random seed set before scoring, so crops taken by the metric are the same for every score.
+    :return: [tuple] (score, seconds taken to prepare the input and score it)
+    """
+    start = time.perf_counter()
+    torch.manual_seed(seed)
+    score = float(quality_scorer.run_metric(iqa_metric, score_input()))
+
+    return score, time.perf_counter() - start
+
+
+def calibrate(image_paths, short_sides, goodbad_threshold=DEFAULT_GOODBAD_THRESHOLD, metric=SCORING_METRIC,
+              preclassify_confidence=preclassifier.DEFAULT_CONFIDENCE):
+    """
+    Scores each image at full size and at each shorter side, and pre-classifies it.
+    :param image_paths: [list] Filepaths of the source images to score.
+    :param short_sides: [list] Shorter sides of the reduced copies to score.
+    :param goodbad_threshold: [float] Threshold used as score boundary between 'good' and 'bad' quality.
+    :param metric: [string] Name of the pyiqa metric.
+    :param preclassify_confidence: [float] Confidence the pre-classifier needs to route an image.
+    :return: [dict] Calibration report, see summarise.
+    """
+    iqa_metric = quality_scorer.get_metric(metric)
+    results = []
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        prepared_image_path = os.path.join(work_dir, "prepared.jpg")
+
+        for src_image_path in tqdm(image_paths, desc="Calibrating downscaled scoring", unit="image"):
+            # Full-size score of the prepared image, as scored by default
+            if not dd_preprocess.meet_upload_reqs(src_image_path, prepared_image_path, False):
+                continue
+
+            try:
+                result = {"src": src_image_path, "scores": {}, "seconds": {}}
+                result["scores"]["full"], result["seconds"]["full"] = timed_score(
+                    iqa_metric, lambda: prepared_image_path)
+
+                for short_side in short_sides:
+                    def reduced_input(short_side=short_side):
+                        reduced = quality_scorer.load_reduced_image(src_image_path, short_side)
+                        return quality_scorer.image_tensor(reduced).unsqueeze(0).to(quality_scorer.DEVICE)
+
+                    result["scores"][str(short_side)], result["seconds"][str(short_side)] = timed_score(
+                        iqa_metric, reduced_input)
+
+                # Pre-classified from the prepared image, as in a run
+                quality, confidence = preclassifier.preclassify(prepared_image_path, preclassify_confidence)
+                result["preclass"] = {"quality": quality, "confidence": confidence}
+
+                results.append(result)
+
+            except Exception as scoring_error:
+                print(f"Error scoring image {os.path.basename(src_image_path)}: {scoring_error}")
+
+    return summarise(results, short_sides, goodbad_threshold, iqa_metric.lower_better, metric, preclassify_confidence)
+
+
+def summarise(results, short_sides, goodbad_threshold, lower_better=False, metric=SCORING_METRIC,
+              preclassify_confidence=preclassifier.DEFAULT_CONFIDENCE):
+    """
+    :param results: [list] {"src": filepath, "scores": {...}, "seconds": {...}, "preclass": {...}} for each image,
+    scores and seconds keyed by "full" and by each shorter side, preclass giving the pre-classifier's quality class
+    (None if the image was left to be scored) and confidence.
+    :param short_sides: [list] Shorter sides scored.
+    :param goodbad_threshold: [float] Threshold used as score boundary between 'good' and 'bad' quality.
+    :param lower_better: [bool] True when lower score indicates better quality image for the metric.
+    :param metric: [string] Name of the metric.
+    :param preclassify_confidence: [float] Confidence the pre-classifier needed to route an image.
+    :return: [dict] Report with the routing agreement, score differences and timings of each shorter side, the share
+    of images routed by the pre-classifier and its routing agreement, plus the scores of each image.
+    """
+    def route(score):
+        return quality_scorer.TREATMENTS[quality_scorer.quality_class(score, goodbad_threshold, lower_better)]
+
+    full_seconds = statistics.median(result["seconds"]["full"] for result in results) if results else None
+    report = {"metric": metric,
+              "goodbad_threshold": goodbad_threshold,
+              "images": len(results),
+              "full_size": {"median_s": full_seconds},
+              "short_sides": {},
+              "preclassifier": {},
+              "scores": results}
+
+    for short_side in short_sides:
+        key = str(short_side)
+        if not results:
+            break
+
+        differences = [abs(result["scores"][key] - result["scores"]["full"]) for result in results]
+        rerouted = [result["src"] for result in results
+                    if route(result["scores"][key]) != route(result["scores"]["full"])]
+        median_s = statistics.median(result["seconds"][key] for result in results)
+
+        report["short_sides"][key] = {"routing_agreement": 1 - len(rerouted) / len(results),
+                                      "routed_differently": rerouted,
+                                      "mean_abs_score_difference": statistics.mean(differences),
+                                      "max_abs_score_difference": max(differences),
+                                      "median_s": median_s,
+                                      "speedup": full_seconds / median_s if median_s > 0 else None}
+
+    preclassified = [result for result in results if result["preclass"]["quality"] is not None]
+    misrouted = [result["src"] for result in preclassified
+                 if quality_scorer.TREATMENTS[result["preclass"]["quality"]] != route(result["scores"]["full"])]
+    report["preclassifier"] = {"confidence": preclassify_confidence,
+                               "share_routed": len(preclassified) / len(results) if results else None,
+                               "routing_agreement": 1 - len(misrouted) / len(preclassified) if preclassified else None,
+                               "routed_differently": misrouted}
+
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares good/bad routing from downscaled quality scoring with "
+                                                 "full-size scoring on a sample of images, to choose "
+                                                 "--score_short_side.")
+    parser.add_argument("source_folder", type=str, help="Path to the folder containing the images")
+    parser.add_argument("--sample", "-n", type=int, default=50,
+                        help="Number of images to sample from the source folder (default: 50)")
+    parser.add_argument("--short_sides", "-s", type=int, nargs="+", default=DEFAULT_SHORT_SIDES,
+                        help=f"Shorter sides to score reduced copies at "
+                             f"(default: {' '.join(str(side) for side in DEFAULT_SHORT_SIDES)})")
+    parser.add_argument("--goodbad_threshold", "-gb", type=float, default=DEFAULT_GOODBAD_THRESHOLD,
+                        help=f"Image quality score to use as threshold between 'good' and 'bad' quality "
+                             f"(default: {DEFAULT_GOODBAD_THRESHOLD})")
+    parser.add_argument("--preclassify_confidence", "-pc", type=float, default=preclassifier.DEFAULT_CONFIDENCE,
+                        help=f"Confidence the statistical pre-classifier needs to route an image "
+                             f"(default: {preclassifier.DEFAULT_CONFIDENCE})")
+    parser.add_argument("--output", "-o", type=str, default="score_calibration.json",
+                        help="Path of the JSON report (default: score_calibration.json)")
+
+    args = parser.parse_args()
+
+    # Scoring is the only work running, so it may use every available core
+    quality_scorer.configure_cpu_inference()
+
+    calibration = calibrate(find_calibration_sample(args.source_folder, args.sample), args.short_sides,
+                            args.goodbad_threshold, preclassify_confidence=args.preclassify_confidence)
+
+    with open(args.output, "w") as report_file:
+        json.dump(calibration, report_file, indent=1)
+
+    print(f"Scored {calibration['images']} images, full size median {calibration['full_size']['median_s']}s")
+    for short_side, summary in calibration["short_sides"].items():
+        print(f"short side {short_side}: {summary['routing_agreement']:.1%} routed the same, "
+              f"mean score difference {summary['mean_abs_score_difference']:.4f}, "
+              f"median {summary['median_s']:.3f}s per image ({summary['speedup']:.1f}x)")
+    preclassified = calibration["preclassifier"]
+    if preclassified["routing_agreement"] is not None:
+        print(f"pre-classifier at confidence {preclassified['confidence']}: routes {preclassified['share_routed']:.1%} "
+              f"of images, {preclassified['routing_agreement']:.1%} of them the same as full-size scoring")
+    else:
+        print(f"pre-classifier at confidence {preclassified['confidence']}: routes no images")
+    print(f"Report written to {args.output}")
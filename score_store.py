@@ -0,0 +1,266 @@
+"""
+SQLite stores for image quality scores: the per-run score store, replacing the shelve file previously used by
+quality_scorer, and a persistent score cache shared between runs.
+
+Scores are written in WAL mode and committed in batches, so saving a score costs the same however many images have
+already been scored (a shelve file opened with writeback re-serialises every cached entry on each sync). Each row holds
+the image filepath (unique, indexed), the metric used, the score (NULL if the image could not be scored), a hash of the
+image's contents and when it was scored. Pages routed by the pre-classifier (see preclassifier.py) have no score -
+their quality class and the pre-classifier's confidence are saved instead. Classifying images as good or bad quality is
+a single query.
+
+The score cache keeps scores keyed by the hash of the image's contents, the metric and the pyiqa version, so an image
+which is unchanged since an earlier run (e.g. a collection re-run with a different threshold or Sauvola setting) is
+never scored twice. The least recently used scores are evicted once the cache holds more than its maximum number of
+entries.
+
+Only uses the standard library.
+"""
+import hashlib
+import os
+import sqlite3
+import time
+
+SCORE_STORE_FILENAME = "image_scores.sqlite"
+
+# Shared by every run of the pipeline for this user
+DEFAULT_SCORE_CACHE_PATH = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+                                        "dd_custom_preprocess", "score_cache.sqlite")
+DEFAULT_SCORE_CACHE_SIZE = 500000  # entries (roughly 100 bytes each)
+
+
+def hash_bytes(image_bytes):
+    """
+    :param image_bytes: [bytes] Contents of an image file.
+    :return: [string] BLAKE2b hex digest of the contents, as returned by image_hash.
+    """
+    return hashlib.blake2b(image_bytes, digest_size=20).hexdigest()
+
+
+def image_hash(image_path, chunk_size=1 << 20):
+    """
+    Hashes the contents of an image file, so a score can be matched to the exact image it was computed from.
+    :param image_path: [string] Filepath of the image.
+    :param chunk_size: [int] Number of bytes read at a time.
+    :return: [string] BLAKE2b hex digest of the file's contents.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    with open(image_path, "rb") as image_file:
+        for chunk in iter(lambda: image_file.read(chunk_size), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def remove_store(db_path):
+    """
+    Deletes a score store, including the write-ahead log files SQLite keeps alongside it.
+    :param db_path: [string] Path to the SQLite database file.
+    """
+    for path in (db_path, db_path + "-wal", db_path + "-shm"):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class ScoreStore:
+    """
+    Image quality scores keyed by image filepath, saved to an SQLite database.
+    """
+
+    def __init__(self, db_path, commit_every=200):
+        """
+        Opens (creating if necessary) the score store at db_path.
+        :param db_path: [string] Path to the SQLite database file.
+        :param commit_every: [int] Number of scores saved between commits. Scores saved since the last commit are lost
+        if the run stops midway, and are re-scored when it is resumed.
+        """
+        self.db_path = db_path
+        self.commit_every = commit_every
+        self._uncommitted = 0
+
+        self.connection = sqlite3.connect(db_path)
+        # WAL lets commits append to a log rather than rewrite the database, and readers don't block the writer.
+        # synchronous=NORMAL only syncs at checkpoints, which is still safe against the process being killed.
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS scores (
+                path TEXT NOT NULL,
+                metric TEXT NOT NULL,
+                score REAL,
+                image_hash TEXT,
+                scored_at REAL NOT NULL,
+                preclass TEXT,
+                preclass_confidence REAL
+            )""")
+        # Stores written before pages could be pre-classified (kept when resuming a run) lack the preclass columns
+        columns = {row[1] for row in self.connection.execute("PRAGMA table_info(scores)")}
+        for column, column_type in (("preclass", "TEXT"), ("preclass_confidence", "REAL")):
+            if column not in columns:
+                self.connection.execute(f"ALTER TABLE scores ADD COLUMN {column} {column_type}")
+        self.connection.execute("CREATE UNIQUE INDEX IF NOT EXISTS scores_path ON scores (path)")
+        self.connection.commit()
+
+    def __contains__(self, image_path):
+        return self.connection.execute("SELECT 1 FROM scores WHERE path = ?", (image_path,)).fetchone() is not None
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM scores").fetchone()[0]
+
+    def save(self, image_path, score, metric, image_hash=None, preclass=None, preclass_confidence=None):
+        """
+        Saves the score of an image, replacing any earlier score. Committed in batches of commit_every.
+        :param image_path: [string] Filepath of the image.
+        :param score: [float] Quality score, or None if the image could not be scored (or was pre-classified).
+        :param metric: [string] Name of the metric the image was scored with.
+        :param image_hash: [string] Optional hash of the image's contents, see image_hash.
+        :param preclass: [string] 'good' or 'bad' if the image was routed by the pre-classifier rather than scored.
+        :param preclass_confidence: [float] Confidence of the pre-classifier in preclass.
+        """
+        self.connection.execute("INSERT OR REPLACE INTO scores (path, metric, score, image_hash, scored_at, preclass, "
+                                "preclass_confidence) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                (image_path, metric, score, image_hash, time.time(), preclass, preclass_confidence))
+
+        self._uncommitted += 1
+        if self._uncommitted >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        self.connection.commit()
+        self._uncommitted = 0
+
+    def get_score(self, image_path):
+        """
+        :param image_path: [string] Filepath of the image.
+        :return: [float] Score of the image, or None if it has no score.
+        """
+        row = self.connection.execute("SELECT score FROM scores WHERE path = ?", (image_path,)).fetchone()
+        return row[0] if row is not None else None
+
+    def get_preclass(self, image_path):
+        """
+        :param image_path: [string] Filepath of the image.
+        :return: [string] 'good' or 'bad' if the image was routed by the pre-classifier, otherwise None.
+        """
+        row = self.connection.execute("SELECT preclass FROM scores WHERE path = ?", (image_path,)).fetchone()
+        return row[0] if row is not None else None
+
+    def scores(self):
+        """
+        :return: [dict] Score of each image filepath (None where the image could not be scored).
+        """
+        return dict(self.connection.execute("SELECT path, score FROM scores"))
+
+    def classify(self, goodbad_threshold, lower_better=False, metric=None):
+        """
+        Classifies every scored image as 'good' or 'bad' quality in a single query. Images which could not be scored
+        are classed as 'bad'. Images routed by the pre-classifier keep the class it gave them.
+        :param goodbad_threshold: [float] Threshold used as score boundary between 'good' and 'bad' classes.
+        :param lower_better: [bool] True when lower score indicates better quality image for the metric.
+        :param metric: [string] If given, only images scored with this metric (or pre-classified) are classified.
+        :return: [dict] 'good' or 'bad' for each image filepath.
+        """
+        comparison = "<=" if lower_better else ">="
+        query = (f"SELECT path, CASE WHEN preclass IS NOT NULL THEN preclass "
+                 f"WHEN score {comparison} ? THEN 'good' ELSE 'bad' END FROM scores")
+        parameters = [goodbad_threshold]
+        if metric is not None:
+            query += " WHERE (metric = ? OR preclass IS NOT NULL)"
+            parameters.append(metric)
+
+        # NULL scores compare as neither true nor false, so fall through to 'bad'
+        return dict(self.connection.execute(query, parameters))
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+
+class ScoreCache:
+    """
+    Persistent cache of image quality scores keyed by (image content hash, metric, pyiqa version).
+    """
+
+    def __init__(self, db_path=DEFAULT_SCORE_CACHE_PATH, max_entries=DEFAULT_SCORE_CACHE_SIZE, pyiqa_version=""):
+        """
+        Opens (creating if necessary) the score cache at db_path.
+        :param db_path: [string] Path to the SQLite database file.
+        :param max_entries: [int] Maximum number of scores kept. The least recently used scores beyond this are evicted
+        when the cache is closed.
+        :param pyiqa_version: [string] Version of pyiqa used for scoring. Scores from other versions are not used, as
+        a metric's weights or preprocessing may differ between versions.
+        """
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.pyiqa_version = pyiqa_version
+
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        # Several runs may share the cache, so wait for another run's write to finish rather than failing
+        self.connection = sqlite3.connect(db_path, timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS score_cache (
+                image_hash TEXT NOT NULL,
+                metric TEXT NOT NULL,
+                pyiqa_version TEXT NOT NULL,
+                score REAL NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (image_hash, metric, pyiqa_version)
+            )""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS score_cache_last_used ON score_cache (last_used)")
+        self.connection.commit()
+
+    def get_many(self, image_hashes, metric):
+        """
+        Looks up the cached scores of several images, marking them as recently used.
+        :param image_hashes: [list] Content hashes of the images, see image_hash.
+        :param metric: [string] Name of the metric (and scoring variant) the scores must come from.
+        :return: [dict] Cached score for each image hash found in the cache.
+        """
+        cached_scores = {}
+        unique_hashes = list(set(image_hashes))
+        # Looked up in chunks to stay under SQLite's limit on query parameters
+        for start in range(0, len(unique_hashes), 500):
+            chunk = unique_hashes[start:start + 500]
+            cached_scores.update(self.connection.execute(
+                f"SELECT image_hash, score FROM score_cache WHERE metric = ? AND pyiqa_version = ? "
+                f"AND image_hash IN ({', '.join('?' * len(chunk))})",
+                [metric, self.pyiqa_version] + chunk))
+
+        now = time.time()
+        self.connection.executemany("UPDATE score_cache SET last_used = ? "
+                                    "WHERE image_hash = ? AND metric = ? AND pyiqa_version = ?",
+                                    [(now, image_hash, metric, self.pyiqa_version) for image_hash in cached_scores])
+        self.connection.commit()
+
+        return cached_scores
+
+    def put(self, image_hash, metric, score):
+        """
+        Adds the score of an image to the cache. Committed when the cache is closed or next read from.
+        :param image_hash: [string] Content hash of the image, see image_hash.
+        :param metric: [string] Name of the metric (and scoring variant) the image was scored with.
+        :param score: [float] Quality score.
+        """
+        self.connection.execute("INSERT OR REPLACE INTO score_cache (image_hash, metric, pyiqa_version, score, "
+                                "last_used) VALUES (?, ?, ?, ?, ?)",
+                                (image_hash, metric, self.pyiqa_version, score, time.time()))
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM score_cache").fetchone()[0]
+
+    def evict(self):
+        """
+        Removes the least recently used scores beyond max_entries.
+        :return: [int] Number of scores removed.
+        """
+        evicted = self.connection.execute("DELETE FROM score_cache WHERE rowid IN (SELECT rowid FROM score_cache "
+                                          "ORDER BY last_used DESC LIMIT -1 OFFSET ?)", (self.max_entries,)).rowcount
+        self.connection.commit()
+
+        return evicted
+
+    def close(self):
+        self.evict()
+        self.connection.close()
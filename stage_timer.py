@@ -0,0 +1,208 @@
+"""
+Per-stage timing instrumentation for the preprocessing pipeline. Stage functions are wrapped with @timed and stages
+inside functions with "with stage(...)". Once enable() has been called, every stage records its duration against the
+image being processed. write_report then writes a JSON report with per-stage totals and latency percentiles, and a
+per-image breakdown.
+
+Stages nest (e.g. preprocess_image includes denoise, sauvola and rotate_image), so per-stage totals are not additive.
+
+Timing is off by default and costs a single flag check per stage when off. Only uses the standard library so it can be
+used from both the custom_preprocess_a and custom_preprocess_b environments.
+"""
+import functools
+import inspect
+import json
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+_enabled = False
+_enabled_at = None
+
+_records = []  # (stage name, image filepath or None, seconds)
+_records_lock = threading.Lock()
+
+_current = threading.local()  # image currently being processed by this thread
+
+
+def enable():
+    """
+    Starts recording stage timings in this process.
+    """
+    global _enabled, _enabled_at
+    _enabled = True
+    _enabled_at = time.perf_counter()
+
+
+def is_enabled():
+    return _enabled
+
+
+def record(stage_name, seconds, image_path=None):
+    """
+    Records the duration of a stage.
+    :param stage_name: [string] Name of the stage.
+    :param seconds: [float] Duration of the stage.
+    :param image_path: [string] Image the stage was run on. Defaults to the image set by current_image.
+    """
+    if image_path is None:
+        image_path = getattr(_current, "image_path", None)
+
+    with _records_lock:
+        _records.append((stage_name, image_path, seconds))
+
+
+@contextmanager
+def current_image(image_path):
+    """
+    Context manager which attributes stages run inside it (in this thread) to image_path.
+    :param image_path: [string] Filepath of the image being processed.
+    """
+    previous_image_path = getattr(_current, "image_path", None)
+    _current.image_path = image_path
+    try:
+        yield
+    finally:
+        _current.image_path = previous_image_path
+
+
+@contextmanager
+def stage(stage_name, image_path=None):
+    """
+    Context manager which records the time taken by the code inside it as a stage.
+    :param stage_name: [string] Name of the stage.
+    :param image_path: [string] Image the stage is run on. Defaults to the image set by current_image.
+    """
+    if not _enabled:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage_name, time.perf_counter() - start, image_path)
+
+
+def timed(stage_name, image_arg=None):
+    """
+    Decorator which records each call of a function as a stage.
+    :param stage_name: [string] Name of the stage.
+    :param image_arg: [string] Name of the function argument holding the filepath of the image being processed. If
+    given, the call and any stages nested inside it are attributed to that image.
+    """
+    def decorator(function):
+        signature = inspect.signature(function) if image_arg else None
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+
+            if image_arg is None:
+                with stage(stage_name):
+                    return function(*args, **kwargs)
+
+            image_path = signature.bind(*args, **kwargs).arguments.get(image_arg)
+            with current_image(image_path), stage(stage_name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def drain():
+    """
+    Removes and returns all timings recorded so far in this process.
+    :return: [list] List of (stage name, image filepath, seconds) tuples.
+    """
+    global _records
+    with _records_lock:
+        records, _records = _records, []
+
+    return records
+
+
+def merge(records):
+    """
+    Adds timings recorded in another process (e.g. a worker process, see call_with_timings) to this process.
+    :param records: [list] List of (stage name, image filepath, seconds) tuples.
+    """
+    with _records_lock:
+        _records.extend(records)
+
+
+def call_with_timings(enabled, function, *args, **kwargs):
+    """
+    Calls function in a worker process and returns its result along with the timings recorded during the call, so
+    that the parent process can merge them into its own report. Worker processes don't share the parent's timings.
+    Only for use inside worker processes, as any timings already recorded in the calling process are discarded.
+    :param enabled: [bool] Whether timing is enabled in the parent process.
+    :param function: Function to call. Must be defined at module level so that it can be sent to worker processes.
+    :return: [tuple] (result of function, list of (stage name, image filepath, seconds) tuples)
+    """
+    if enabled and not _enabled:
+        enable()
+
+    drain()
+    result = function(*args, **kwargs)
+
+    return result, drain()
+
+
+def percentile(sorted_values, percent):
+    """
+    Linearly interpolated percentile of a sorted list of values.
+    :param sorted_values: [list] Values sorted in ascending order.
+    :param percent: [float] Percentile to compute (0-100).
+    :return: [float] The percentile value.
+    """
+    position = (len(sorted_values) - 1) * percent / 100
+    lower, upper = math.floor(position), math.ceil(position)
+
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+def summarise():
+    """
+    Summarises the timings recorded so far.
+    :return: [dict] Per-stage totals and latency percentiles, and per-image time spent in each stage.
+    """
+    with _records_lock:
+        records = list(_records)
+
+    stage_durations = {}
+    image_durations = {}
+    for stage_name, image_path, seconds in records:
+        stage_durations.setdefault(stage_name, []).append(seconds)
+        if image_path is not None:
+            image_stages = image_durations.setdefault(image_path, {})
+            image_stages[stage_name] = image_stages.get(stage_name, 0.0) + seconds
+
+    stages = {}
+    for stage_name, durations in stage_durations.items():
+        durations.sort()
+        stages[stage_name] = {"count": len(durations),
+                              "total_s": sum(durations),
+                              "mean_s": sum(durations) / len(durations),
+                              "p50_s": percentile(durations, 50),
+                              "p95_s": percentile(durations, 95),
+                              "p99_s": percentile(durations, 99),
+                              "max_s": durations[-1]}
+
+    return {"wall_time_s": time.perf_counter() - _enabled_at if _enabled_at is not None else None,
+            "stages": stages,
+            "images": image_durations}
+
+
+def write_report(report_path):
+    """
+    Writes a JSON report of the timings recorded so far.
+    :param report_path: [string] Path of the JSON file to write.
+    """
+    with open(report_path, "w") as report_file:
+        json.dump(summarise(), report_file, indent=2)
+
+    print(f"Timing report written to {report_path}")
@@ -0,0 +1,7 @@
+"""
+The preprocessing scripts are top-level modules rather than a package, so make them importable from the tests.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
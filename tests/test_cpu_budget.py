@@ -0,0 +1,30 @@
+"""
+Checks that cpu_budget.split_cpus never gives quality scoring and the worker processes more threads between them than
+there are cores, unless every one of them is already down to a single thread.
+"""
+import pytest
+
+import cpu_budget
+
+
+@pytest.mark.parametrize("cpus", [1, 2, 4, 8, 16, 64])
+@pytest.mark.parametrize("workers", [1, 2, 3, 4, 8, 16])
+def test_scoring_alongside_workers_fits_the_cores(monkeypatch, cpus, workers):
+    monkeypatch.setattr(cpu_budget, "available_cpus", lambda: cpus)
+
+    scoring_threads, worker_threads = cpu_budget.split_cpus(workers, scoring_alongside=True)
+
+    assert scoring_threads >= 1 and worker_threads >= 1
+    assert scoring_threads + workers * worker_threads <= max(cpus, 1 + workers)
+
+
+def test_explicit_scoring_threads_leave_the_rest_to_workers(monkeypatch):
+    monkeypatch.setattr(cpu_budget, "available_cpus", lambda: 16)
+
+    assert cpu_budget.split_cpus(4, scoring_alongside=True, scoring_threads=8) == (8, 2)
+
+
+def test_scoring_and_workers_taking_turns_each_get_every_core(monkeypatch):
+    monkeypatch.setattr(cpu_budget, "available_cpus", lambda: 16)
+
+    assert cpu_budget.split_cpus(4) == (16, 4)
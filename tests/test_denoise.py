@@ -0,0 +1,46 @@
+"""
+Checks that dd_preprocess.denoise_tiled stitches tiles back together exactly, and that the tile threads denoise with
+OpenCV's own thread pool turned off, so the two don't multiply each other's threads.
+"""
+import cv2
+import numpy as np
+import pytest
+
+import benchmark
+import dd_preprocess
+
+
+@pytest.fixture(scope="module")
+def page():
+    return benchmark.make_page(500, 700)
+
+
+def test_tiled_matches_single_call(page):
+    single = dd_preprocess.denoise_image(page, contrast_enhance=False)
+    tiled = dd_preprocess.denoise_image(page, contrast_enhance=False, tile_size=128, threads=2)
+
+    assert np.array_equal(tiled, single)
+
+
+def test_tiles_denoised_with_one_opencv_thread(page, monkeypatch):
+    opencv_threads = []
+    fast_nl_means_denoising = cv2.fastNlMeansDenoising
+
+    def recording_denoising(*args, **kwargs):
+        opencv_threads.append(cv2.getNumThreads())
+        return fast_nl_means_denoising(*args, **kwargs)
+
+    monkeypatch.setattr(cv2, "fastNlMeansDenoising", recording_denoising)
+    previous_threads = cv2.getNumThreads()
+    try:
+        cv2.setNumThreads(4)
+        dd_preprocess.denoise_tiled(page, tile_size=256, workers=2)
+        assert cv2.getNumThreads() == 4
+
+        dd_preprocess.denoise_image(page, contrast_enhance=False, threads=3)
+        assert cv2.getNumThreads() == 4
+    finally:
+        cv2.setNumThreads(previous_threads)
+
+    # Tiles of the 500x700 page, then the single call limited to its 3 threads
+    assert opencv_threads == [1] * 6 + [3]
@@ -0,0 +1,36 @@
+"""
+Checks the angle searches dd_preprocess.rotate_image uses to deskew pages (dd_preprocess.DESKEW_SEARCHES) find the
+skew of binarised synthetic pages, and leave straight pages alone.
+"""
+import numpy as np
+import pytest
+
+import benchmark
+import dd_preprocess
+
+SEARCHES = ["pyramid", "shear"]
+
+
+def binarised_page(skew, seed):
+    """
+    :return: (np.ndarray) synthetic microfiche-sized page rotated by skew degrees, denoised and binarised as in
+    preprocess_image, with 2% of pixels flipped to black as speckle
+    """
+    page = benchmark.make_page(*benchmark.PAGE_SIZES["microfiche_frame"], skew=skew, seed=seed)
+    binarised = dd_preprocess.binarise_sauvola_opencv(dd_preprocess.denoise_image(page, contrast_enhance=False),
+                                                      window_size=21, k_val=0.14)
+    binarised[np.random.default_rng(seed).random(binarised.shape) < 0.02] = 0
+    return binarised
+
+
+@pytest.mark.parametrize("search", SEARCHES)
+@pytest.mark.parametrize("seed", range(4))
+def test_straight_page_is_not_rotated(search, seed):
+    assert dd_preprocess.DESKEW_SEARCHES[search](binarised_page(0, seed)) == 0
+
+
+@pytest.mark.parametrize("search", SEARCHES)
+@pytest.mark.parametrize("skew", [1.5, -0.7])
+def test_skew_is_found(search, skew):
+    # The angle found is the rotation which straightens the page
+    assert dd_preprocess.DESKEW_SEARCHES[search](binarised_page(skew, seed=0)) == pytest.approx(-skew)
@@ -0,0 +1,40 @@
+"""
+Checks that when an image kills its worker process, which breaks the process pool, dd_preprocessor.process_sauvola
+still processes every other image. Sauvola preprocessing itself is replaced by writing a marker file, and relies on
+worker processes being forked so they see the replacement.
+"""
+import multiprocessing
+import os
+
+import pytest
+
+import dd_preprocess
+import dd_preprocessor
+
+pytestmark = pytest.mark.skipif(multiprocessing.get_start_method() != "fork",
+                                reason="worker processes must inherit the replaced preprocess_image")
+
+
+def fake_preprocess_image(src_image_path, dest_image_path, **kwargs):
+    if "crash" in os.path.basename(src_image_path):
+        # As if the worker process was killed, e.g. for running out of memory
+        os._exit(1)
+    open(dest_image_path + ".done", "w").close()
+
+
+def test_only_the_image_which_kills_its_worker_fails(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(dd_preprocess, "preprocess_image", fake_preprocess_image)
+    names = [f"page_{index}.jpg" for index in range(9)]
+    names.insert(4, "crash.jpg")
+    filepaths = [str(tmp_path / name) for name in names]
+
+    # The crashing image shares its chunk with other images, and breaks the pool with images left in other chunks
+    dd_preprocessor.process_sauvola(filepaths, sauvola_k_val=0.24, sauvola_window_size=11, contrast_enhance=False,
+                                    workers=2, chunksize=3)
+
+    output = capsys.readouterr().out
+    assert "Preprocessing of bad quality images completed" in output
+    assert f"Error preprocessing image {filepaths[4]}: worker process died" in output
+    assert output.count("Error preprocessing image") == 1
+
+    assert [file for file in filepaths if not os.path.exists(file + ".done")] == [filepaths[4]]
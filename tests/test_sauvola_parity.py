@@ -0,0 +1,48 @@
+"""
+Checks that the opencv Sauvola engine (dd_preprocess.binarise_sauvola_opencv, float32 box filters) binarises pages the
+same way as the skimage engine (filters.threshold_sauvola in float64), as used by dd_preprocess.preprocess_image.
+"""
+import cv2
+import numpy as np
+import pytest
+from skimage import color, filters
+
+import benchmark
+import dd_preprocess
+
+# Share of pixels allowed to be binarised differently, for float32 rounding where a pixel lies on its threshold
+MAX_DIFFERING = 1e-5
+
+
+@pytest.fixture(scope="module")
+def denoised_page():
+    # A synthetic microfiche-sized page, denoised as in preprocess_image
+    page = benchmark.make_page(*benchmark.PAGE_SIZES["microfiche_frame"])
+    return dd_preprocess.denoise_image(page, contrast_enhance=False)
+
+
+def skimage_binarised(image, window_size, k_val):
+    """
+    :return: (np.ndarray) bool image, True where preprocess_image's skimage engine binarises the pixel as white
+    """
+    greyscale = color.rgb2gray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+    return greyscale > filters.threshold_sauvola(greyscale, window_size=window_size, k=k_val)
+
+
+@pytest.mark.parametrize("window_size, k_val", [(11, 0.24), (21, 0.14), (101, 0.2), (301, 0.22)])
+def test_opencv_matches_skimage(denoised_page, window_size, k_val):
+    binarised = dd_preprocess.binarise_sauvola_opencv(denoised_page, window_size=window_size, k_val=k_val)
+
+    assert binarised.dtype == np.uint8
+    assert set(np.unique(binarised)) <= {0, 255}
+
+    differing = np.mean((binarised > 0) != skimage_binarised(denoised_page, window_size, k_val))
+    assert differing <= MAX_DIFFERING
+
+
+def test_opencv_matches_skimage_at_borders(denoised_page):
+    # A window larger than the page exercises the reflected borders everywhere
+    small_page = np.ascontiguousarray(denoised_page[:200, :150])
+    binarised = dd_preprocess.binarise_sauvola_opencv(small_page, window_size=301, k_val=0.22)
+
+    assert np.mean((binarised > 0) != skimage_binarised(small_page, 301, 0.22)) <= MAX_DIFFERING
@@ -0,0 +1,97 @@
+"""
+Runs the same output folder through one long-lived SBB binarisation worker twice, as two runs of custom_preprocess_a.py
+which are not resumed would. SBB binarisation itself is replaced by a simple threshold, so TensorFlow and the model are
+not needed.
+"""
+import os
+import sys
+import types
+
+import cv2
+import numpy as np
+import pytest
+
+import run_journal
+
+
+class FakeSbbBinarizer:
+    """
+    Stands in for sbb_binarize.SbbBinarizer: thresholds the image and saves it, counting the images binarised.
+    """
+
+    def __init__(self, model_dir):
+        self.binarised = []
+
+    def run(self, image=None, image_path=None, save=None):
+        if image is None:
+            image = cv2.imread(image_path)
+        self.binarised.append(image_path)
+        cv2.imwrite(save, np.where(image[..., 0] > 128, 255, 0).astype(np.uint8))
+
+
+@pytest.fixture
+def worker(monkeypatch):
+    sbb_binarize = types.ModuleType("sbb_binarize")
+    sbb_binarize.sbb_binarize = types.ModuleType("sbb_binarize.sbb_binarize")
+    sbb_binarize.sbb_binarize.SbbBinarizer = FakeSbbBinarizer
+    monkeypatch.setitem(sys.modules, "sbb_binarize", sbb_binarize)
+    monkeypatch.setitem(sys.modules, "sbb_binarize.sbb_binarize", sbb_binarize.sbb_binarize)
+
+    import sbb_worker
+    return sbb_worker.SbbWorker("unused_model_dir", warmup=False)
+
+
+def prepare_run(output_folder):
+    """
+    Starts a run which is not resumed: a new journal replaces the last run's, and the image is prepared again.
+    :return: [tuple] (journal path, prepared image filepath)
+    """
+    journal_path = os.path.join(output_folder, run_journal.JOURNAL_FILENAME)
+    if os.path.exists(journal_path):
+        os.remove(journal_path)
+
+    image_path = os.path.join(output_folder, "page.jpg")
+    page = np.full((400, 300, 3), 255, np.uint8)
+    page[100:110, 50:250] = 0
+    cv2.imwrite(image_path, page)
+
+    journal = run_journal.RunJournal(journal_path)
+    journal.record(image_path, run_journal.PREPARED)
+    journal.record(image_path, run_journal.DENOISED)
+    journal.close()
+
+    return journal_path, image_path
+
+
+def test_second_run_in_same_folder_is_binarised_again(worker, tmp_path):
+    for run in range(2):
+        journal_path, image_path = prepare_run(str(tmp_path))
+
+        worker.submit(image_path, journal_path=journal_path)
+        completed, failed = worker.wait()
+
+        assert failed == {}
+        assert completed == [str(tmp_path / "page.png")]
+        assert len(worker.binarizer.binarised) == run + 1
+        # The prepared image has been replaced by the binarised image
+        assert not os.path.exists(image_path)
+        assert os.path.exists(tmp_path / "page.png")
+
+        # Stages are recorded in this run's journal, not the deleted one
+        journal = run_journal.RunJournal(journal_path)
+        for stage in (run_journal.BINARISED, run_journal.DESKEWED, run_journal.COMPRESSED):
+            assert journal.is_done(image_path, stage)
+
+
+def test_journal_is_stale_once_replaced(tmp_path):
+    journal_path = str(tmp_path / run_journal.JOURNAL_FILENAME)
+    journal = run_journal.RunJournal(journal_path)
+    journal.record("page.jpg", run_journal.PREPARED)
+    assert not journal.is_stale()
+
+    os.remove(journal_path)
+    assert journal.is_stale()
+
+    run_journal.RunJournal(journal_path).record("page.jpg", run_journal.PREPARED)
+    assert journal.is_stale()
+    journal.close()